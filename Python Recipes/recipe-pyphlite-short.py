@@ -6,11 +6,8 @@ from pyphlite import *
 
 proj = PhProject('<SECRET API KEY>', 'tqql73HM3EBX8Bxa3knM10n5') #API key redacted
 
-latest_data = proj.get_last_ready_data(format='json')
-with open('latest_data.json', 'w+') as f:
-    f.write(str(latest_data))
-
-current_data = proj.run().get_data(format='csv')
-with open('current_data.csv', 'w+') as f:
-    f.write(str(current_data))
+#save_* streams the download straight to disk instead of holding it in memory
+proj.save_last_ready_data('latest_data.json', format='json')
 
+#a path ending in .gz keeps the data gzip-compressed, as downloaded (read it back with read_chunks)
+proj.run().save_data('current_data.csv.gz', format='csv')
@@ -1,6 +1,8 @@
 from __future__ import print_function
 
-from pyphlite import PhAccount, PhProject, PhRun
+import time
+
+from pyphlite import PhAccount, PhProject, PhRun, ProjectIndex
 
 # Parsehub Sample Recipe
 # - Requires PyPhLite (pyphlite.py) from:
@@ -54,6 +56,27 @@ print('\tIdentified by title: Project(token="%s", title="%s")"' %
     (target_project.token, target_project.title))
 print('')
 
+#2c. OR: Find a project by its title in a local index (kept in parsehub.db between runs of this script)
+
+print('2c. Finding project with title="%s" in the local index...' % target_title)
+
+INDEX_MAX_AGE = 24 * 3600 #seconds; an older index is refreshed, as is one missing the title (added or renamed since)
+
+with ProjectIndex(API_KEY, 'parsehub.db') as index:
+    indexed_project = index.project_by_title(target_title)
+    if indexed_project is None or time.time() - index.refreshed_at > INDEX_MAX_AGE:
+        print('\tRefreshing the local index...')
+        index.refresh(runs=False)
+        indexed_project = index.project_by_title(target_title)
+
+if indexed_project is None:
+    print('\tNo project with that title, keeping the one found in 2b.')
+else:
+    target_project = indexed_project
+    print('\tIdentified by title: Project(token="%s", title="%s")"' %
+        (target_project.token, target_project.title))
+print('')
+
 #3. Download the latest ready data for that project
 
 print('3. Downloading latest ready data for target project...', end=' ')
@@ -1,13 +1,65 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import array
+import base64
+import bisect
+import calendar
+import codecs
+import collections
+import copy
+import csv
+import email.utils
+import gzip
+import hashlib
+import heapq
+import hmac
 import json
 import logging
+import mmap
+import os
+import random
 import requests
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
 import time
+import urllib3.connection
+import urllib3.connectionpool
+import zlib
+
+try:
+    import queue
+except ImportError: #Py2
+    import Queue as queue
+
+try:
+    from urllib.parse import parse_qsl, urlencode, urlparse
+except ImportError: #Py2
+    from urllib import urlencode
+    from urlparse import parse_qsl, urlparse
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError: #Py2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+try:
+    import fcntl
+except ImportError: #not available on Windows; only FileRateLimiter needs it
+    fcntl = None
+
+PY2 = sys.version_info[0] == 2
 
 logging.basicConfig(level=logging.WARN, format='%(asctime)s - %(levelname)s - %(message)s')
 
+#Messages are passed as a format string and arguments, so nothing is formatted unless the level is enabled
+logger = logging.getLogger('pyphlite')
+
 def dict_except(d, blocked_keys):
     ret = {}
     for k in d.keys():
@@ -17,11 +69,1661 @@ def dict_except(d, blocked_keys):
             ret[k] = d[k]
     return ret
 
+#Log argument that only calls dict_except() if the record is actually formatted
+class LazyDictExcept(object):
+    __slots__ = ('d', 'blocked_keys')
+
+    def __init__(self, d, blocked_keys):
+        self.d = d
+        self.blocked_keys = blocked_keys
+
+    def __str__(self):
+        return str(dict_except(self.d, self.blocked_keys))
+
+API_BASE_URL = 'https://www.parsehub.com/api/v2'
+
+PROJECT_PAGE_SIZE = 20 #projects fetched per /projects request (the API's offset/limit paging)
+
+RUN_UPDATE_FREE_LIMIT = 25        #ParseHub allows this many updates of a run at any rate...
+RUN_UPDATE_LIMITED_INTERVAL = 180 #...and one update every 180s after that
+TERMINAL_RUN_STATUSES = ('cancelled', 'error')
+
+DEFAULT_CHUNK_SIZE = 64 * 1024 #bytes held in memory at a time by the streaming download functions
+
+def iter_response(req, chunk_size=DEFAULT_CHUNK_SIZE, decode_content=True):
+    #yield the (already decompressed) body of a stream=True response, releasing the connection when done
+    # - decode_content=False yields the body as it was sent instead, e.g. still gzip-compressed (a body that
+    #   was already read, e.g. by a Cassette, can only be yielded decompressed)
+    try:
+        if decode_content or req.raw is None or req._content_consumed:
+            chunks = req.iter_content(chunk_size=chunk_size)
+        else:
+            chunks = req.raw.stream(chunk_size, decode_content=False)
+        for chunk in chunks:
+            if chunk:
+                yield chunk
+    finally:
+        req.close()
+
+#Run data is negotiated gzip-compressed (PhSession(compress=True)) and can be kept that way:
+# - gzip_chunks/gunzip_chunks turn byte chunks into gzip and back, streaming; both recognise data that is
+#   already in the form they produce (by the gzip magic number, which no run data format starts with) and
+#   pass it through, so the server's gzip bytes are stored as received and never recompressed
+# - save_data/save_last_ready_data write gzip when the path ends in .gz (or compress=True), and
+#   DatasetCache(compress=True) keeps its entries compressed; read_chunks reads both kinds of file back
+GZIP_MAGIC = b'\x1f\x8b'
+
+def _peek_gzip(chunks):
+    #(whether the chunks start with GZIP_MAGIC, the same chunks)
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= len(GZIP_MAGIC):
+            break
+    def rejoined():
+        if head:
+            yield head
+        for chunk in chunks:
+            yield chunk
+    return head[:len(GZIP_MAGIC)] == GZIP_MAGIC, rejoined()
+
+def gzip_chunks(chunks, compresslevel=6):
+    #gzip-compress byte chunks, or pass them through when they already are gzip
+    is_gzip, chunks = _peek_gzip(chunks)
+    for chunk in chunks if is_gzip else _gzip_chunks(chunks, compresslevel):
+        yield chunk
+
+def _gzip_chunks(chunks, compresslevel):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def gunzip_chunks(chunks):
+    #decompress gzip byte chunks (concatenated gzip members included), or pass them through when they aren't gzip
+    is_gzip, chunks = _peek_gzip(chunks)
+    for chunk in _gunzip_chunks(chunks) if is_gzip else chunks:
+        yield chunk
+
+def _gunzip_chunks(chunks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            chunk = decompressor.unused_data
+            if chunk: #the next gzip member
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if not decompressor.eof:
+        raise ValueError('Truncated gzip data.')
+
+def _gzip_path(f):
+    return not hasattr(f, 'write') and not hasattr(f, 'read') and f.endswith('.gz')
+
+def read_chunks(f, chunk_size=DEFAULT_CHUNK_SIZE):
+    #yield the contents of a binary file-like object or a file path in chunks, decompressed if it is gzip
+    if not hasattr(f, 'read'):
+        with open(f, 'rb') as fobj:
+            for chunk in read_chunks(fobj, chunk_size):
+                yield chunk
+        return
+    for chunk in gunzip_chunks(iter(lambda: f.read(chunk_size), b'')):
+        yield chunk
+
+def write_chunks(chunks, f):
+    #write byte chunks to a binary file-like object, or to a file path; returns the number of bytes written
+    if not hasattr(f, 'write'):
+        with open(f, 'wb') as fobj:
+            return write_chunks(chunks, fobj)
+
+    written = 0
+    for chunk in chunks:
+        f.write(chunk)
+        written += len(chunk)
+    return written
+
+class _JsonTextStream(object):
+    #Text cursor over a stream of utf-8 byte chunks; only the unparsed tail is kept in memory
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._eof = False
+        self.buf = ''
+        self.pos = 0
+
+    def _fill(self):
+        if self._eof:
+            return False
+        try:
+            text = self._utf8.decode(next(self._chunks))
+        except StopIteration:
+            text = self._utf8.decode(b'', True)
+            self._eof = True
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        #next non-whitespace character ('' at the end of the stream), without consuming it
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def take(self, expected):
+        c = self.peek()
+        if c not in expected:
+            raise ValueError('Malformed JSON run data: expected one of "%s" but found "%s".' % (expected, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            #a number is only complete when a delimiter follows it, e.g. "2001" may be "2001.5" cut by a chunk
+            if (self.buf[self.pos] in '-0123456789' and (end == len(self.buf) or self.buf[end] not in ',]} \t\n\r')
+                    and self._fill()):
+                continue
+            self.pos = end
+            return obj
+
+def iter_json_records(chunks, base_list=None):
+    #Incrementally parse ParseHub JSON run data from byte chunks, yielding the records of one top-level list
+    # - base_list is the top-level key holding the records (e.g. 'movies'); None picks the first top-level list
+    # - each record is fully decoded, nested selections included; other top-level values are skipped
+    records = _iter_json_list(chunks, base_list)
+    next(records)
+    for record in records:
+        yield record
+
+def _iter_json_list(chunks, base_list=None):
+    #iter_json_records, yielding the list's key first (None when there is no top-level list)
+    stream = _JsonTextStream(chunks)
+    stream.take('{')
+    if stream.peek() != '}':
+        while True:
+            key = stream.value()
+            stream.take(':')
+            if stream.peek() == '[' and (base_list is None or key == base_list):
+                yield key
+                stream.take('[')
+                if stream.peek() == ']':
+                    return
+                while True:
+                    yield stream.value()
+                    if stream.take(',]') == ']':
+                        return
+            stream.value()
+            if stream.take(',}') == '}':
+                break
+
+    if base_list is not None:
+        raise KeyError('Run data has no top-level list "%s".' % base_list)
+    yield None
+
+def iter_text_lines(chunks, encoding='utf-8'):
+    #decode byte chunks into '\n'-terminated lines (line endings kept) without joining the whole stream
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    pending += decoder.decode(b'', True)
+    if pending:
+        yield pending
+
+def iter_csv_rows(chunks, as_dict=False, encoding='utf-8-sig'):
+    #Parse ParseHub CSV run data from byte chunks, one row at a time
+    # - quoted fields spanning several lines are handled by the csv module
+    # - as_dict=False yields tuples (header row first, like csv.reader); as_dict=True yields dicts keyed by the header
+    # - the default encoding also drops a leading byte order mark
+    lines = iter_text_lines(chunks, encoding)
+    if PY2: #Py2's csv module only reads byte strings
+        lines = (line.encode('utf-8') for line in lines)
+        if as_dict:
+            for row in csv.DictReader(lines):
+                yield dict((k.decode('utf-8'), v.decode('utf-8')) for k, v in row.items())
+        else:
+            for row in csv.reader(lines):
+                yield tuple(v.decode('utf-8') for v in row)
+    elif as_dict:
+        for row in csv.DictReader(lines):
+            yield row
+    else:
+        for row in csv.reader(lines):
+            yield tuple(row)
+
+#Local conversion of run data between formats, so that one download serves all of them:
+#       chunks = convert_run_data(run.iter_data(format='json'), 'json', 'csv')
+# - 'json' and 'csv' are laid out as ParseHub serves them; 'ndjson' is one JSON record per line and 'phb'
+#   a compact binary stream of records (see _phb_encode). ParseHub doesn't serve those two (LOCAL_FORMATS),
+#   so PhRun/PhProject download JSON and convert it when they are asked for them
+# - records stream through one at a time; writing CSV spools its rows to a temporary file, because the
+#   header (every column of every record) is only known at the end
+# - CSV columns are <list>_<key>, nested objects add _<key>, and the items of a nested list take one row
+#   each, the first next to the rest of the record and the others below it with the record's cells empty
+# - JSON, ndjson and phb convert into each other losslessly; CSV can't tell numbers from text or hold
+#   nested lists, so it converts to flat records of strings (empty cells left out)
+# - ndjson has no name for its list: base_list names it ('records' by default); otherwise base_list picks
+#   the list to read from JSON data, or the CSV column prefix
+RUN_DATA_FORMATS = ('json', 'csv', 'ndjson', 'phb')
+LOCAL_FORMATS = ('ndjson', 'phb')
+NDJSON_LIST_NAME = 'records'
+
+_text_type = unicode if PY2 else str
+_integer_types = (int, long) if PY2 else (int,)
+
+def convert_run_data(chunks, from_format, to_format, base_list=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    #byte chunks of run data converted from from_format to to_format (passed through when they are the same)
+    for output_format in (from_format, to_format):
+        if output_format not in RUN_DATA_FORMATS:
+            raise ValueError('Unknown run data format "%s"; expected one of %s.' % (output_format, ', '.join(RUN_DATA_FORMATS)))
+    if from_format == to_format:
+        return iter(chunks)
+    return _convert_run_data(chunks, from_format, to_format, base_list, chunk_size)
+
+def _convert_run_data(chunks, from_format, to_format, base_list, chunk_size):
+    chunks = iter(chunks)
+    records = _RUN_DATA_READERS[from_format](chunks, base_list)
+    name = next(records)
+    for chunk in _join_chunks(_RUN_DATA_WRITERS[to_format](name, records), chunk_size):
+        yield chunk
+    for chunk in chunks: #the rest of the input (e.g. JSON after the list), so a DatasetCache.store completes
+        pass
+
+def iter_run_data_records(chunks, output_format='json', base_list=None):
+    #the records of run data in any of RUN_DATA_FORMATS (see iter_json_records for JSON)
+    records = _RUN_DATA_READERS[output_format](chunks, base_list)
+    next(records)
+    return records
+
+def _join_chunks(pieces, chunk_size):
+    buf = []
+    size = 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield b''.join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield b''.join(buf)
+
+def _read_ndjson(chunks, base_list):
+    yield base_list or NDJSON_LIST_NAME
+    for line in iter_text_lines(chunks):
+        if line.strip():
+            yield json.loads(line)
+
+def _read_csv(chunks, base_list):
+    rows = iter_csv_rows(chunks)
+    header = next(rows, None)
+    if header is None:
+        yield base_list
+        return
+    name = base_list or header[0].split('_', 1)[0]
+    keys = [column[len(name) + 1:] if column.startswith(name + '_') else column for column in header]
+    yield name
+    for row in rows:
+        record = collections.OrderedDict((key, value) for key, value in zip(keys, row) if value != '')
+        if record:
+            yield record
+
+def _write_json(name, records):
+    if name is None:
+        yield b'{}'
+        return
+    yield ('{%s: [' % json.dumps(name)).encode('utf-8')
+    separator = ''
+    for record in records:
+        yield (separator + json.dumps(record)).encode('utf-8')
+        separator = ', '
+    yield b']}'
+
+def _write_ndjson(name, records):
+    for record in records:
+        yield (json.dumps(record) + '\n').encode('utf-8')
+
+def _csv_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, _text_type):
+        return value
+    return json.dumps(value)
+
+def _csv_field(text):
+    if any(c in text for c in ',"\r\n'):
+        return '"%s"' % text.replace('"', '""')
+    return text
+
+def _csv_flatten(column, value):
+    #the CSV rows ({column: text}) of one value, laid out as described above
+    if isinstance(value, dict):
+        rows = [{}]
+        for key, item in value.items():
+            for i, row in enumerate(_csv_flatten('%s_%s' % (column, key), item)):
+                if i == len(rows):
+                    rows.append({})
+                rows[i].update(row)
+        return rows
+    if isinstance(value, list):
+        rows = []
+        for item in value:
+            rows.extend(_csv_flatten(column, item))
+        return rows or [{}]
+    return [{column: _csv_text(value)}]
+
+def _write_csv(name, records):
+    columns = collections.OrderedDict()
+    with tempfile.TemporaryFile() as spool:
+        for record in records:
+            for row in _csv_flatten(name, record):
+                for column in row:
+                    columns.setdefault(column, len(columns))
+                spool.write((json.dumps(row) + '\n').encode('utf-8'))
+        if columns:
+            yield (','.join(_csv_field(column) for column in columns) + '\n').encode('utf-8')
+        spool.seek(0)
+        for line in spool:
+            row = json.loads(line.decode('utf-8'))
+            yield (','.join(_csv_field(row.get(column, '')) for column in columns) + '\n').encode('utf-8')
+
+#phb ("pyphlite binary"): b'PHB1', the list's name, then every record, each as one tagged value:
+# - a tag byte, then: nothing for None/False/True, a zigzag varint for integers, 8 little-endian bytes for
+#   floats, a varint length and utf-8 bytes for strings, a varint count and the items for lists, and a
+#   varint count and key/value pairs for objects
+# - object keys are numbered in order of first use: a key is varint(number + 1), or 0 followed by the
+#   key's length and utf-8 bytes the first time it occurs, so repeated keys cost a byte or two
+PHB_MAGIC = b'PHB1'
+_PHB_NONE, _PHB_FALSE, _PHB_TRUE, _PHB_INT, _PHB_FLOAT, _PHB_STR, _PHB_LIST, _PHB_DICT = range(8)
+
+def _varint(n, out):
+    while n > 0x7f:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _phb_encode(value, out, keys):
+    if value is None:
+        out.append(_PHB_NONE)
+    elif isinstance(value, bool):
+        out.append(_PHB_TRUE if value else _PHB_FALSE)
+    elif isinstance(value, _integer_types):
+        out.append(_PHB_INT)
+        _varint(value * 2 if value >= 0 else -value * 2 - 1, out)
+    elif isinstance(value, float):
+        out.append(_PHB_FLOAT)
+        out += struct.pack('<d', value)
+    elif isinstance(value, _text_type):
+        data = value.encode('utf-8')
+        out.append(_PHB_STR)
+        _varint(len(data), out)
+        out += data
+    elif isinstance(value, list):
+        out.append(_PHB_LIST)
+        _varint(len(value), out)
+        for item in value:
+            _phb_encode(item, out, keys)
+    elif isinstance(value, dict):
+        out.append(_PHB_DICT)
+        _varint(len(value), out)
+        for key, item in value.items():
+            if key in keys:
+                _varint(keys[key] + 1, out)
+            else:
+                keys[key] = len(keys)
+                data = key.encode('utf-8')
+                out.append(0)
+                _varint(len(data), out)
+                out += data
+            _phb_encode(item, out, keys)
+    else:
+        raise TypeError('Cannot encode %s in phb run data.' % type(value).__name__)
+
+def _write_phb(name, records):
+    keys = {}
+    out = bytearray(PHB_MAGIC)
+    _phb_encode(name, out, keys)
+    yield bytes(out)
+    for record in records:
+        out = bytearray()
+        _phb_encode(record, out, keys)
+        yield bytes(out)
+
+class _PhbReader(object):
+    #Decodes phb values from a stream of byte chunks
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = bytearray()
+        self._pos = 0
+        self._keys = []
+
+    def _more(self):
+        for chunk in self._chunks:
+            if chunk:
+                del self._buf[:self._pos]
+                self._pos = 0
+                self._buf += chunk
+                return True
+        return False
+
+    def at_end(self):
+        return self._pos == len(self._buf) and not self._more()
+
+    def read(self, n):
+        while len(self._buf) - self._pos < n:
+            if not self._more():
+                raise ValueError('Truncated phb run data.')
+        data = bytes(self._buf[self._pos:self._pos + n])
+        self._pos += n
+        return data
+
+    def byte(self):
+        if self._pos == len(self._buf) and not self._more():
+            raise ValueError('Truncated phb run data.')
+        self._pos += 1
+        return self._buf[self._pos - 1]
+
+    def varint(self):
+        n = shift = 0
+        while True:
+            b = self.byte()
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def value(self):
+        tag = self.byte()
+        if tag == _PHB_NONE:
+            return None
+        if tag in (_PHB_FALSE, _PHB_TRUE):
+            return tag == _PHB_TRUE
+        if tag == _PHB_INT:
+            n = self.varint()
+            return -((n + 1) >> 1) if n & 1 else n >> 1
+        if tag == _PHB_FLOAT:
+            return struct.unpack('<d', self.read(8))[0]
+        if tag == _PHB_STR:
+            return self.read(self.varint()).decode('utf-8')
+        if tag == _PHB_LIST:
+            return [self.value() for i in range(self.varint())]
+        if tag == _PHB_DICT:
+            obj = {}
+            for i in range(self.varint()):
+                key = self.varint()
+                if key == 0:
+                    self._keys.append(self.read(self.varint()).decode('utf-8'))
+                    key = len(self._keys)
+                obj[self._keys[key - 1]] = self.value()
+            return obj
+        raise ValueError('Malformed phb run data: unknown tag %s.' % tag)
+
+def _read_phb(chunks, base_list):
+    reader = _PhbReader(chunks)
+    if reader.read(len(PHB_MAGIC)) != PHB_MAGIC:
+        raise ValueError('Not phb run data.')
+    yield reader.value()
+    while not reader.at_end():
+        yield reader.value()
+
+_RUN_DATA_READERS = {'json': _iter_json_list, 'csv': _read_csv, 'ndjson': _read_ndjson, 'phb': _read_phb}
+_RUN_DATA_WRITERS = {'json': _write_json, 'csv': _write_csv, 'ndjson': _write_ndjson, 'phb': _write_phb}
+
+#How to wait for a run: how often to poll it, for how long, and how to behave when rate limited
+# - interval: seconds before the first re-poll; multiplied by backoff after every poll, capped at max_interval
+# - jitter: +/- fraction of randomness applied to every delay, so many waiters don't poll in lockstep
+# - timeout: wall-clock seconds (request latency included) before giving up; None waits forever
+# - free_updates/limited_interval: ParseHub's per-run update budget; once spent, polls are spaced limited_interval apart
+# - max_429_retries: how many HTTP 429 responses to wait out (honoring Retry-After) before raising
+class PollPolicy(object):
+    def __init__(self, interval=5, backoff=1.0, max_interval=None, jitter=0.0, timeout=None,
+                 free_updates=RUN_UPDATE_FREE_LIMIT, limited_interval=RUN_UPDATE_LIMITED_INTERVAL, max_429_retries=3):
+        self.interval = interval
+        self.backoff = backoff
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.timeout = timeout
+        self.free_updates = free_updates
+        self.limited_interval = limited_interval
+        self.max_429_retries = max_429_retries
+
+    def __repr__(self):
+        return ('<PollPolicy(interval=%s, backoff=%s, max_interval=%s, jitter=%s, timeout=%s, free_updates=%s, '
+                'limited_interval=%s, max_429_retries=%s)>' %
+                (self.interval, self.backoff, self.max_interval, self.jitter, self.timeout, self.free_updates,
+                 self.limited_interval, self.max_429_retries))
+
+    def deadline(self, start_time):
+        return None if self.timeout is None else start_time + self.timeout
+
+    def next_delay(self, attempt, update_count=0, last_update_time=None, now=None):
+        #seconds to wait before re-poll number attempt (0-based) of a run that has been updated update_count times
+        #(now: the clock last_update_time was taken from, default time.time())
+        delay = self.interval * (self.backoff ** attempt)
+        if self.max_interval is not None:
+            delay = min(delay, self.max_interval)
+        if self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        if update_count >= self.free_updates and last_update_time is not None:
+            delay = max(delay, last_update_time + self.limited_interval - (time.time() if now is None else now))
+        return max(delay, 0)
+
+    def retry_after(self, req, retries):
+        #seconds to wait before retrying a 429 response, or None once max_429_retries have been used
+        if retries >= self.max_429_retries:
+            return None
+        header = req.headers.get('Retry-After')
+        if header:
+            try:
+                return max(float(header), 0)
+            except ValueError:
+                parsed = email.utils.parsedate_tz(header)
+                if parsed is not None:
+                    return max(email.utils.mktime_tz(parsed) - time.time(), 0)
+        return self.limited_interval
+
+#Token bucket allowing rate requests per second on average and bursts of up to burst requests
+# - reserve() takes the tokens immediately and returns how long the caller must wait before using them,
+#   so the same limiter works for blocking (acquire) and asyncio (asyncio.sleep(reserve())) callers
+# - thread-safe; share one instance between sessions/threads to share its budget
+class RateLimiter(object):
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self._tokens = self.burst
+        self._time = time.time()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<%s(rate=%s, burst=%s)>' % (self.__class__.__name__, self.rate, self.burst)
+
+    def _take(self, tokens, available, last_time):
+        #returns (tokens left, wait in seconds); tokens left goes negative while requests are queued
+        now = time.time()
+        available = min(self.burst, available + (now - last_time) * self.rate) - tokens
+        return available, now, (0 if available >= 0 else -available / self.rate)
+
+    def reserve(self, tokens=1):
+        with self._lock:
+            self._tokens, self._time, wait = self._take(tokens, self._tokens, self._time)
+        return wait
+
+    def acquire(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            logger.debug('%s.acquire: Throttling for %ss...', self.__class__.__name__, wait)
+            time.sleep(wait)
+        return wait
+
+#RateLimiter whose bucket lives in a small file, so every process on the host using the same path shares it
+# - POSIX only (uses fcntl.flock)
+class FileRateLimiter(RateLimiter):
+    def __init__(self, path, rate, burst=None):
+        if fcntl is None:
+            raise Exception('FileRateLimiter requires fcntl, which is not available on this platform.')
+        super(FileRateLimiter, self).__init__(rate, burst)
+        self.path = path
+
+    def __repr__(self):
+        return '<FileRateLimiter(path="%s", rate=%s, burst=%s)>' % (self.path, self.rate, self.burst)
+
+    @classmethod
+    def for_api_key(cls, api_key, endpoint, rate, burst=None, directory=None):
+        #one bucket file per (API key, endpoint class) in directory (default: the system temp directory)
+        digest = hashlib.sha1(api_key.encode('utf-8')).hexdigest()[:16]
+        path = os.path.join(directory or tempfile.gettempdir(), 'pyphlite-%s-%s.bucket' % (digest, endpoint.replace('*', 'all')))
+        return cls(path, rate, burst)
+
+    def reserve(self, tokens=1):
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                state = os.read(fd, 64).split()
+                if len(state) == 2:
+                    available, last_time = float(state[0]), float(state[1])
+                else:
+                    available, last_time = self.burst, time.time()
+                available, now, wait = self._take(tokens, available, last_time)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, ('%r %r' % (available, now)).encode('ascii'))
+            finally:
+                os.close(fd) #also releases the lock
+        return wait
+
+def endpoint_class(method, path):
+    #which rate limit bucket a request counts against: 'data', 'run', 'status' or 'other'
+    if path.endswith('/data'):
+        return 'data'
+    elif method == 'POST' and path.endswith('/run'):
+        return 'run'
+    elif method == 'GET' and path.startswith('/runs/'):
+        return 'status'
+    else:
+        return 'other'
+
+def throttle_wait(rate_limits, method, path):
+    #reserve a token from the endpoint class's limiter and from the '*' (every request) limiter;
+    #returns how long to wait before sending the request
+    wait = 0
+    if rate_limits:
+        for key in (endpoint_class(method, path), '*'):
+            limiter = rate_limits.get(key)
+            if limiter is not None:
+                wait = max(wait, limiter.reserve())
+    return wait
+
+def response_json(req):
+    #parse a JSON response once per Response object (MetadataCache hands every hit its own copy)
+    jdata = getattr(req, '_pyphlite_jdata', None)
+    if jdata is None:
+        start = time.time()
+        jdata = json.loads(req.text)
+        req._pyphlite_jdata = jdata
+        event = getattr(req, '_pyphlite_event', None)
+        if event is not None:
+            event['parse'] = time.time() - start
+            notify(req._pyphlite_instruments, 'after_parse', event)
+    return jdata
+
+#Request instrumentation, used by PhSession(instruments=[...]) and AsyncPhSession(instruments=[...])
+# - an instrument is any object with before_request(event), after_request(event) and/or after_parse(event)
+#   methods (missing ones are skipped); with no instruments no events are built at all
+# - event is a dict; before_request gets method, path, endpoint (e.g. 'GET /runs/{run_token}'), endpoint_class,
+#   project_token, run_token and retries (how many times this request has been retried so far)
+# - after_request adds status_code, error (the exception, if the request raised), from_cache, bytes (body bytes
+#   read off the wire, or Content-Length for streamed responses) and latencies in seconds: throttle (client-side
+#   rate limit wait), connect (opening new connections, 0 on a reused one), ttfb (until the response headers)
+#   and total (until request() returned)
+# - after_parse adds parse, the time response_json() spent decoding the body
+def endpoint_name(method, path):
+    parts = path.split('/')
+    if len(parts) > 2 and parts[1] in ('projects', 'runs'):
+        parts[2] = '{project_token}' if parts[1] == 'projects' else '{run_token}'
+    return '%s %s' % (method, '/'.join(parts))
+
+def request_event(method, path, retries=0):
+    parts = path.split('/')
+    token = parts[2] if len(parts) > 2 else None
+    return {
+        'method': method,
+        'path': path,
+        'endpoint': endpoint_name(method, path),
+        'endpoint_class': endpoint_class(method, path),
+        'project_token': token if parts[1] == 'projects' else None,
+        'run_token': token if parts[1] == 'runs' else None,
+        'retries': retries,
+        'status_code': None,
+        'error': None,
+        'from_cache': False,
+        'bytes': None,
+        'throttle': 0,
+        'connect': None,
+        'ttfb': None,
+        'total': None,
+        'parse': None,
+    }
+
+def notify(instruments, hook, event):
+    for instrument in instruments:
+        fn = getattr(instrument, hook, None)
+        if fn is not None:
+            fn(event)
+
+#Instrument keeping request counters and latency histograms in memory, e.g.
+#       metrics = MetricsCollector()
+#       session = PhSession(API_KEY, instruments=[metrics])
+#       ...
+#       metrics.dump()              -> plain dict (e.g. for json.dumps)
+#       metrics.prometheus_text()   -> Prometheus text format, to serve from a scrape endpoint
+# - counters by endpoint: requests (also by status), errors, cache_hits, retries (requests that were
+#   retries) and bytes; by project token: project_requests and project_bytes
+# - histograms by endpoint: throttle/connect/ttfb/total/parse seconds; by project token: project_total seconds
+class MetricsCollector(object):
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = collections.defaultdict(int) #(name, labels): value
+            self.histograms = {} #(name, labels): [count per bucket..., count above the last bucket, sum]
+
+    def _count(self, name, labels, value=1):
+        self.counters[(name, labels)] += value
+
+    def _observe(self, name, labels, seconds):
+        hist = self.histograms.get((name, labels))
+        if hist is None:
+            hist = self.histograms[(name, labels)] = [0] * (len(self.buckets) + 1) + [0.0]
+        hist[bisect.bisect_left(self.buckets, seconds)] += 1
+        hist[-1] += seconds
+
+    def after_request(self, event):
+        endpoint = (('endpoint', event['endpoint']),)
+        with self._lock:
+            self._count('requests', endpoint + (('status', str(event['status_code'])),))
+            if event['error'] is not None:
+                self._count('errors', endpoint)
+            if event['from_cache']:
+                self._count('cache_hits', endpoint)
+            if event['retries']:
+                self._count('retries', endpoint)
+            if event['bytes']:
+                self._count('bytes', endpoint, event['bytes'])
+            for phase in ('throttle', 'connect', 'ttfb', 'total'):
+                if event[phase] is not None:
+                    self._observe(phase, endpoint, event[phase])
+
+            if event['project_token'] is not None:
+                project = (('project_token', event['project_token']),)
+                self._count('project_requests', project)
+                if event['bytes']:
+                    self._count('project_bytes', project, event['bytes'])
+                self._observe('project_total', project, event['total'])
+
+    def after_parse(self, event):
+        with self._lock:
+            self._observe('parse', (('endpoint', event['endpoint']),), event['parse'])
+
+    def dump(self):
+        with self._lock:
+            return {
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'histograms': [
+                    {'name': name + '_seconds', 'labels': dict(labels), 'buckets': list(self.buckets),
+                     'counts': hist[:-1], 'count': sum(hist[:-1]), 'sum': hist[-1]}
+                    for (name, labels), hist in sorted(self.histograms.items())
+                ],
+            }
+
+    def prometheus_text(self, prefix='pyphlite_'):
+        lines = []
+        with self._lock:
+            last_name = None
+            for (name, labels), value in sorted(self.counters.items()):
+                name = '%s%s_total' % (prefix, name)
+                if name != last_name:
+                    lines.append('# TYPE %s counter' % name)
+                    last_name = name
+                lines.append('%s%s %s' % (name, _prometheus_labels(labels), value))
+
+            for (name, labels), hist in sorted(self.histograms.items()):
+                name = '%s%s_seconds' % (prefix, name)
+                if name != last_name:
+                    lines.append('# TYPE %s histogram' % name)
+                    last_name = name
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), hist[:-1]):
+                    cumulative += count
+                    lines.append('%s_bucket%s %s' % (name, _prometheus_labels(labels + (('le', bound),)), cumulative))
+                lines.append('%s_sum%s %r' % (name, _prometheus_labels(labels), hist[-1]))
+                lines.append('%s_count%s %s' % (name, _prometheus_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+def _prometheus_labels(labels):
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, ('%s' % value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+
+#Connections that record how long connect() (TCP connect + TLS handshake) took, for the instrumentation events
+_connect_timer = threading.local()
+
+class _TimedHTTPConnection(urllib3.connection.HTTPConnection):
+    def connect(self):
+        start = time.time()
+        try:
+            return super(_TimedHTTPConnection, self).connect()
+        finally:
+            _connect_timer.seconds = getattr(_connect_timer, 'seconds', 0) + time.time() - start
+
+class _TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    def connect(self):
+        start = time.time()
+        try:
+            return super(_TimedHTTPSConnection, self).connect()
+        finally:
+            _connect_timer.seconds = getattr(_connect_timer, 'seconds', 0) + time.time() - start
+
+class _TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+class _TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+class _TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super(_TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _TimedHTTPConnectionPool, 'https': _TimedHTTPSConnectionPool}
+
+def _body_bytes(resp, stream):
+    if stream:
+        length = resp.headers.get('Content-Length')
+        return int(length) if length is not None else None
+    try:
+        return resp.raw.tell() #before any Content-Encoding is undone
+    except Exception:
+        return len(resp.content)
+
+#In-process TTL + LRU cache of project/account/run metadata responses, used by PhSession(cache=...)
+# - a GET younger than ttl seconds is answered from memory; an older one is revalidated with
+#   If-None-Match/If-Modified-Since when the cached response carried an ETag/Last-Modified
+# - at most max_entries responses are kept, least recently used first out
+# - run/cancel/delete requests made through the session invalidate the entries they affect
+# - entries are keyed per account (by a digest of the api_key), and every hit hands out its own copy of the
+#   response, so callers never share (or mutate) one parsed jdata
+class MetadataCache(object):
+    def __init__(self, ttl=30, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict() #key: (stored_time, response)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<MetadataCache(ttl=%s, max_entries=%s, entries=%s)>' % (self.ttl, self.max_entries, len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(path, params=None):
+        params = params or {}
+        api_key = params.get('api_key')
+        account = hashlib.sha1(api_key.encode('utf-8')).hexdigest() if api_key else None
+        return (path, account, tuple(sorted((k, '%s' % v) for k, v in params.items() if k != 'api_key')))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry #most recently used
+        stored_time, response = entry
+        #a pickled copy keeps only the body and headers, so response_json() parses a fresh jdata for it
+        return stored_time, copy.copy(response)
+
+    def put(self, key, response):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), response)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, path_prefix=''):
+        with self._lock:
+            for key in [k for k in self._entries if k[0].startswith(path_prefix)]:
+                del self._entries[key]
+
+    def clear(self):
+        self.invalidate()
+
+#Persistent on-disk cache of run datasets, used by PhSession(dataset_cache=...)
+# - a data_ready run's data never changes, so it is stored once per (run token, format) and every later
+#   get_data/iter_data/iter_records/... for it is served from disk without any API request
+# - files are named by a hash of their key, written to a temporary file and renamed into place (atomic),
+#   read back through mmap, and evicted least recently used first once the cache exceeds max_bytes
+# - convert=True only ever downloads JSON: other formats are converted from it locally (see
+#   convert_run_data) and cached too; ParseHub's own CSV is then never requested
+# - compress=True stores new entries gzip-compressed (as the server sent them, when it sent gzip);
+#   read/iter_chunks decompress either kind of entry, and max_bytes counts the bytes on disk
+class DatasetCache(object):
+    def __init__(self, directory, max_bytes=10 * 1024 ** 3, convert=False, compress=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.convert = convert
+        self.compress = compress
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __repr__(self):
+        return '<DatasetCache(directory="%s", max_bytes=%s, convert=%s, compress=%s)>' % (
+            self.directory, self.max_bytes, self.convert, self.compress)
+
+    def path(self, run_token, output_format='json'):
+        digest = hashlib.sha1(('%s\0%s' % (run_token, output_format)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.data')
+
+    def contains(self, run_token, output_format='json'):
+        return os.path.exists(self.path(run_token, output_format))
+
+    def _open(self, run_token, output_format):
+        #returns (file, mmap or None for empty files) and marks the entry as recently used, or None on a miss
+        path = self.path(run_token, output_format)
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        if os.fstat(f.fileno()).st_size == 0:
+            return f, None
+        return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, run_token, output_format='json'):
+        opened = self._open(run_token, output_format)
+        if opened is None:
+            return None
+        f, mm = opened
+        try:
+            return b''.join(gunzip_chunks([mm[:] if mm is not None else b'']))
+        finally:
+            if mm is not None:
+                mm.close()
+            f.close()
+
+    def iter_chunks(self, run_token, output_format='json', chunk_size=DEFAULT_CHUNK_SIZE, compressed=False):
+        #iterator over the cached bytes (gzip-compressed if compressed), or None on a miss
+        opened = self._open(run_token, output_format)
+        if opened is None:
+            return None
+        logger.debug('DatasetCache.iter_chunks: Hit for run_token="%s", format="%s".', run_token, output_format)
+        chunks = self._iter_mmap(opened[0], opened[1], chunk_size)
+        return gzip_chunks(chunks) if compressed else gunzip_chunks(chunks)
+
+    @staticmethod
+    def _iter_mmap(f, mm, chunk_size):
+        try:
+            if mm is not None:
+                for i in range(0, len(mm), chunk_size):
+                    yield mm[i:i + chunk_size]
+        finally:
+            if mm is not None:
+                mm.close()
+            f.close()
+
+    def store(self, run_token, output_format, chunks):
+        #pass chunks through while writing them to the cache; the entry only appears once every chunk was read
+        fd, tmp_path = tempfile.mkstemp(suffix='.part', dir=self.directory)
+        complete = False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+                f.flush()
+                os.fsync(f.fileno())
+            getattr(os, 'replace', os.rename)(tmp_path, self.path(run_token, output_format))
+            complete = True
+        finally:
+            if not complete:
+                os.remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.data'):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logger.debug('DatasetCache.evict: Removing "%s" (%s bytes).', name, size)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+#Record/replay of API traffic, used by PhSession(cassette=...):
+#       PhSession(API_KEY, cassette=Cassette('tests/project.json'))     #records on first use, replays afterwards
+# - mode 'record' always sends requests and writes every response; 'replay' never touches the network and
+#   raises for a request that was not recorded; 'once' (default) replays if the file exists, records otherwise
+# - requests are matched on method, path and query (without api_key); repeated requests, e.g. polling a
+#   run, get the recorded responses in order and then the last one again, so polling sequences replay as
+#   recorded; a replaying session's sleep() only advances its clock, so waits take no time
+# - the api_key is scrubbed from URLs, headers and bodies; bodies are stored once per distinct content
+#   (gzip-compressed when the path ends in .gz)
+# - recorded interactions are written by save(), which PhSession.close() calls
+CASSETTE_SCRUBBED_KEY = '<API_KEY>'
+CASSETTE_DROPPED_HEADERS = ('connection', 'content-encoding', 'content-length', 'keep-alive', 'set-cookie',
+                            'transfer-encoding')
+
+class Cassette(object):
+    def __init__(self, path, mode='once'):
+        if mode not in ('once', 'record', 'replay'):
+            raise ValueError('Unknown cassette mode "%s".' % mode)
+        if mode == 'once':
+            mode = 'replay' if os.path.exists(path) else 'record'
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._interactions = []
+        self._bodies = {} #sha1: body bytes
+        self._played = {} #match key: responses replayed so far
+        if mode == 'replay':
+            self._load()
+
+    def __repr__(self):
+        return '<Cassette(path="%s", mode="%s", interactions=%s)>' % (self.path, self.mode, len(self._interactions))
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def _open(self, path, mode):
+        if self.path.endswith('.gz'):
+            return gzip.open(path, mode)
+        return open(path, mode)
+
+    def _load(self):
+        with self._open(self.path, 'rb') as f:
+            jdata = json.loads(f.read().decode('utf-8'))
+        for digest, body in jdata['bodies'].items():
+            self._bodies[digest] = base64.b64decode(body['base64']) if 'base64' in body else body['text'].encode('utf-8')
+        self._interactions = jdata['interactions']
+
+    def save(self):
+        if self.mode != 'record':
+            return
+        with self._lock:
+            bodies = {}
+            for digest, body in self._bodies.items():
+                try:
+                    bodies[digest] = {'text': body.decode('utf-8')}
+                except UnicodeDecodeError:
+                    bodies[digest] = {'base64': base64.b64encode(body).decode('ascii')}
+            data = json.dumps({'version': 1, 'interactions': self._interactions, 'bodies': bodies},
+                              sort_keys=True, separators=(',', ':'))
+        tmp_path = self.path + '.part'
+        with self._open(tmp_path, 'wb') as f:
+            f.write(data.encode('utf-8'))
+        getattr(os, 'replace', os.rename)(tmp_path, self.path)
+
+    @staticmethod
+    def match_key(method, url):
+        url = urlparse(url)
+        query = sorted((k, v) for k, v in parse_qsl(url.query, keep_blank_values=True) if k != 'api_key')
+        return '%s %s?%s' % (method, url.path, urlencode(query))
+
+    def record(self, method, url, status_code, reason, headers, body, api_key=None):
+        scrub = lambda text: text.replace(api_key, CASSETTE_SCRUBBED_KEY) if api_key else text
+        if api_key:
+            body = body.replace(api_key.encode('utf-8'), CASSETTE_SCRUBBED_KEY.encode('utf-8'))
+        digest = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            self._bodies[digest] = body
+            self._interactions.append({
+                'request': scrub(self.match_key(method, url)),
+                'status': status_code,
+                'reason': reason,
+                'headers': dict((k, scrub(v)) for k, v in headers.items() if k.lower() not in CASSETTE_DROPPED_HEADERS),
+                'body': digest,
+            })
+
+    def play(self, method, url):
+        #(status, reason, headers, body) of the next recorded response to this request
+        key = self.match_key(method, url)
+        with self._lock:
+            matches = [i for i in self._interactions if i['request'] == key]
+            if not matches:
+                raise Exception('Cassette "%s" has no recorded response for %s.' % (self.path, key))
+            played = self._played.get(key, 0)
+            self._played[key] = played + 1
+            interaction = matches[min(played, len(matches) - 1)]
+        return interaction['status'], interaction['reason'], interaction['headers'], self._bodies[interaction['body']]
+
+class _CassetteAdapter(requests.adapters.BaseAdapter):
+    #Transport adapter recording the responses of the wrapped adapter, or replaying them without it
+    def __init__(self, cassette, api_key, adapter):
+        super(_CassetteAdapter, self).__init__()
+        self.cassette = cassette
+        self.api_key = api_key
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        if self.cassette.replaying:
+            status, reason, headers, body = self.cassette.play(request.method, request.url)
+            resp = requests.Response()
+            resp.status_code = status
+            resp.reason = reason
+            resp.headers = requests.structures.CaseInsensitiveDict(headers)
+            resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+            resp.url = request.url
+            resp.request = request
+        else:
+            resp = self.adapter.send(request, **kwargs)
+            body = resp.content #a streamed response is read here, and then served from memory
+            self.cassette.record(request.method, request.url, resp.status_code, resp.reason, resp.headers, body, self.api_key)
+        resp._content = body
+        resp._content_consumed = True
+        return resp
+
+    def close(self):
+        self.adapter.close()
+
+def _form_value(value):
+    #webhook form fields are all strings; booleans and integers are restored so jdata reads like the API's JSON
+    if value in ('true', 'True'):
+        return True
+    if value in ('false', 'False'):
+        return False
+    if value in ('null', 'None'):
+        return None
+    if value.isdigit() and (value == '0' or value[0] != '0'):
+        return int(value)
+    return value
+
+class _WebhookServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        url = urlparse(self.path)
+        if url.path.rstrip('/') != receiver.path.rstrip('/'):
+            return self._reply(404, {'error': 'not found'})
+        if receiver.secret is not None and not hmac.compare_digest(
+                dict(parse_qsl(url.query)).get('secret', '').encode('utf-8'), receiver.secret.encode('utf-8')):
+            return self._reply(403, {'error': 'invalid secret'})
+        try:
+            text = body.decode('utf-8')
+            if 'json' in (self.headers.get('Content-Type') or ''):
+                jdata = json.loads(text)
+            else:
+                jdata = dict((k, _form_value(v)) for k, v in parse_qsl(text, keep_blank_values=True))
+            if not isinstance(jdata, dict) or not jdata.get('run_token'):
+                raise ValueError('no run_token')
+        except ValueError as e:
+            logger.warning('WebhookReceiver: Ignoring a malformed notification (%s).', e)
+            return self._reply(400, {'error': 'expected a run object'})
+        receiver.notify(jdata)
+        self._reply(200, {'ok': True})
+
+#Local HTTP server receiving ParseHub's run status webhooks, so waiting runs don't have to poll
+#       with WebhookReceiver(host='0.0.0.0', port=8000, public_url='https://example.com/parsehub', secret='s3cret') as receiver:
+#           session = PhSession(API_KEY, webhook=receiver) #point the projects' webhook at receiver.url
+#           run = PhProject(API_KEY, token, session=session).run().wait_until_ready()
+# - ParseHub POSTs the run object (form encoded) to a project's webhook URL whenever a run's status
+#   changes; every notification is kept by run token (the latest max_runs runs) and passed to callbacks
+# - PhRun.wait_until_ready and iter_completed_runs on a session with a webhook wake up as soon as a
+#   notification for their run arrives; they still poll, but no more often than every fallback_interval
+#   seconds, in case a notification is lost
+# - secret: when set, notifications must carry it as ?secret=... (receiver.url includes it), and the run
+#   object they carry is used as is. Without a secret anyone who can reach the receiver could send one, so
+#   a notification only wakes its run's waiters, which poll the run once to confirm it
+# - host: only local requests are accepted by default, host='0.0.0.0' accepts them from anywhere
+# - callbacks(jdata) run on the server's request thread, so they must be quick and thread-safe
+class WebhookReceiver(object):
+    def __init__(self, host='127.0.0.1', port=0, path='/', secret=None, public_url=None, fallback_interval=300,
+                 max_runs=10000, callbacks=None):
+        logger.debug('WebhookReceiver.__init__(self, host="%s", port=%s, path="%s", public_url="%s", '
+                     'fallback_interval=%s, max_runs=%s).', host, port, path, public_url, fallback_interval, max_runs)
+        self.path = path
+        self.secret = secret
+        self.public_url = public_url
+        self.fallback_interval = fallback_interval
+        self.max_runs = max_runs
+        self.callbacks = list(callbacks or [])
+        self._host, self._port = host, port
+        self._runs = collections.OrderedDict() #run token: (seq, jdata) of its latest notification
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._server = None
+
+    def __repr__(self):
+        return '<WebhookReceiver(url="%s")>' % self.url
+
+    @property
+    def url(self):
+        #the URL to set as the projects' webhook
+        if self.public_url is not None:
+            base = self.public_url
+        else:
+            host = self._host if self._host not in ('', '0.0.0.0') else '127.0.0.1'
+            base = 'http://%s:%s%s' % (host, self._server.server_port if self._server else self._port, self.path)
+        return base if self.secret is None else '%s%ssecret=%s' % (base, '&' if '?' in base else '?', self.secret)
+
+    def start(self):
+        self._server = _WebhookServer((self._host, self._port), _WebhookHandler)
+        self._server.receiver = self
+        thread = threading.Thread(target=self._server.serve_forever, name='pyphlite-webhook')
+        thread.daemon = True
+        thread.start()
+        logger.info('WebhookReceiver.start: Listening on port %s.', self._server.server_port)
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def notify(self, jdata):
+        #record a run status notification and wake its waiters (called for every webhook POST)
+        run_token = jdata['run_token']
+        logger.debug('WebhookReceiver.notify: Run "%s" is "%s" (data_ready=%s).', run_token, jdata.get('status'), jdata.get('data_ready'))
+        with self._cond:
+            self._seq += 1
+            self._runs.pop(run_token, None)
+            self._runs[run_token] = (self._seq, jdata)
+            while len(self._runs) > self.max_runs:
+                self._runs.popitem(last=False)
+            self._cond.notify_all()
+        for callback in list(self.callbacks):
+            try:
+                callback(jdata)
+            except Exception:
+                logger.exception('WebhookReceiver.notify: Callback "%s" failed.', callback)
+
+    def latest(self, run_token):
+        #the latest notified jdata of a run, or None
+        with self._cond:
+            return self._runs.get(run_token, (0, None))[1]
+
+    def updates(self, after=0, timeout=0):
+        #(seq, {run token: jdata}) of the runs notified since seq after, waiting up to timeout seconds for one
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._seq <= after:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return after, {}
+                self._cond.wait(remaining)
+            return self._seq, dict((token, jdata) for token, (seq, jdata) in self._runs.items() if seq > after)
+
+    def wait_for(self, run_token, timeout=0, after=0):
+        #(seq, jdata) of the first notification of run_token since seq after, waiting up to timeout seconds for
+        #one; (after, None) if none came
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                seq, jdata = self._runs.get(run_token, (0, None))
+                if seq > after:
+                    return seq, jdata
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return after, None
+                self._cond.wait(remaining)
+
+def _pushed_jdata(run, jdata):
+    #a run's jdata updated with a webhook notification, which may not carry every field
+    merged = dict(run._jdata or {})
+    merged.update(jdata)
+    return merged
+
+def _notified_jdata(run, webhook, pushed, poll_policy, deadline=None):
+    #a run's jdata after a webhook notification: the notified run object when the receiver checks a secret,
+    #otherwise a poll (the notification may be forged)
+    if webhook.secret is not None:
+        return _pushed_jdata(run, pushed)
+    return run._fetch_jdata(poll_policy, deadline, revalidate=True)
+
+#Pooled, keep-alive HTTP session shared by every object of one API key:
+# - PhSession.for_api_key() returns the same session for the same key
+# - PhAccount/PhProject/PhRun hand their session down to every object they create
+# - rate_limits maps an endpoint class ('status', 'data', 'run', 'other', or '*' for every request)
+#   to a RateLimiter consulted before each request, e.g. {'status': RateLimiter(2), '*': RateLimiter(5)}
+# - cache is an optional MetadataCache for project/account/run metadata; responses served from memory
+#   have from_cache=True, and revalidate=True skips the TTL (still sending conditional headers)
+# - dataset_cache is an optional DatasetCache that keeps downloaded run data on disk
+# - instruments is a list of objects notified before/after each request, e.g. [MetricsCollector()]
+# - cassette is an optional Cassette that records the session's traffic or replays it offline;
+#   waits go through the session's time()/sleep(), which a replaying cassette makes instant
+# - compress asks for gzip-encoded responses (Accept-Encoding: gzip), compress=False for uncompressed ones
+# - webhook is an optional WebhookReceiver whose notifications wake runs waiting for their data
+class PhSession(object):
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, api_key=None, base_url=API_BASE_URL, pool_connections=4, pool_maxsize=16,
+                 pool_block=False, max_retries=0, keep_alive=True, headers=None, rate_limits=None, cache=None,
+                 dataset_cache=None, instruments=None, cassette=None, compress=True, webhook=None):
+        logger.debug('PhSession.__init__(self, api_key="%s", base_url="%s", pool_connections=%s, pool_maxsize=%s, '
+                     'pool_block=%s, max_retries=%s, keep_alive=%s, rate_limits="%s", cache="%s", dataset_cache="%s", '
+                     'instruments="%s", cassette="%s", compress=%s, webhook="%s").',
+                     api_key, base_url, pool_connections, pool_maxsize, pool_block, max_retries, keep_alive, rate_limits,
+                     cache, dataset_cache, instruments, cassette, compress, webhook)
+        self._api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.rate_limits = dict(rate_limits or {})
+        self.cache = cache
+        self.dataset_cache = dataset_cache
+        self.instruments = list(instruments or [])
+        self.cassette = cassette
+        self.webhook = webhook
+        self._clock_offset = 0 #seconds a replaying session has skipped
+
+        adapter = _TimedHTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+            max_retries=max_retries
+        )
+        if cassette is not None:
+            adapter = _CassetteAdapter(cassette, api_key, adapter)
+        self._http = requests.Session()
+        self._http.mount('https://', adapter)
+        self._http.mount('http://', adapter)
+        if not keep_alive:
+            self._http.headers['Connection'] = 'close'
+        self._http.headers['Accept-Encoding'] = 'gzip' if compress else 'identity'
+        if headers is not None:
+            self._http.headers.update(headers)
+
+    def __repr__(self):
+        return '<PhSession(api_key="%s", base_url="%s")>' % (self._api_key, self.base_url)
+
+    @classmethod
+    def for_api_key(cls, api_key, **kwargs): #kwargs only apply when the session is first created
+        with cls._registry_lock:
+            session = cls._registry.get(api_key)
+            if session is None:
+                session = cls(api_key, **kwargs)
+                cls._registry[api_key] = session
+            return session
+
+    def time(self):
+        return time.time() + self._clock_offset
+
+    def sleep(self, seconds):
+        if self.cassette is not None and self.cassette.replaying:
+            self._clock_offset += seconds
+        else:
+            time.sleep(seconds)
+
+    def request(self, method, path, revalidate=False, retries=0, **kwargs):
+        #retries: how many times the caller has already retried this request, reported to instruments
+        if not self.instruments:
+            return self._request(method, path, revalidate, None, **kwargs)
+
+        event = request_event(method, path, retries)
+        notify(self.instruments, 'before_request', event)
+        start = time.time()
+        _connect_timer.seconds = 0
+        try:
+            resp = self._request(method, path, revalidate, event, **kwargs)
+            resp._pyphlite_event = event
+            resp._pyphlite_instruments = self.instruments
+            event['from_cache'] = resp.from_cache
+            if event['status_code'] is None:
+                event['status_code'] = resp.status_code
+            return resp
+        except Exception as e:
+            event['error'] = e
+            raise
+        finally:
+            event['total'] = time.time() - start
+            event['connect'] = _connect_timer.seconds
+            notify(self.instruments, 'after_request', event)
+
+    def _request(self, method, path, revalidate, event, **kwargs):
+        cache_key = cached = None
+        if self.cache is not None and method == 'GET' and not kwargs.get('stream') and endpoint_class(method, path) != 'data':
+            cache_key = self.cache.key(path, kwargs.get('params'))
+            entry = self.cache.get(cache_key)
+            if entry is not None:
+                stored_time, cached = entry
+                if not revalidate and time.time() - stored_time < self.cache.ttl:
+                    logger.debug('PhSession.request: %s %s served from cache.', method, path)
+                    cached.from_cache = True
+                    return cached
+                validators = {}
+                if 'ETag' in cached.headers:
+                    validators['If-None-Match'] = cached.headers['ETag']
+                if 'Last-Modified' in cached.headers:
+                    validators['If-Modified-Since'] = cached.headers['Last-Modified']
+                if validators:
+                    kwargs['headers'] = dict(kwargs.get('headers') or {}, **validators)
+                else:
+                    cached = None
+
+        wait = throttle_wait(self.rate_limits, method, path)
+        if wait > 0:
+            logger.debug('PhSession.request: Throttling %s %s for %ss...', method, path, wait)
+            self.sleep(wait)
+        resp = self._http.request(method, self.base_url + path, **kwargs)
+        resp.from_cache = False
+
+        if event is not None:
+            event['throttle'] = wait
+            event['status_code'] = resp.status_code
+            event['ttfb'] = resp.elapsed.total_seconds()
+            event['bytes'] = _body_bytes(resp, kwargs.get('stream'))
+            event['retries'] += len(getattr(getattr(resp.raw, 'retries', None), 'history', None) or ())
+
+        if cache_key is not None:
+            if resp.status_code == 304 and cached is not None:
+                logger.debug('PhSession.request: %s %s revalidated (304).', method, path)
+                cached.from_cache = False
+                self.cache.put(cache_key, cached)
+                return cached
+            elif resp.status_code == 200:
+                self.cache.put(cache_key, resp)
+        elif self.cache is not None and method != 'GET':
+            #starting, cancelling or deleting a run changes project listings and the run itself
+            self.cache.invalidate('/projects')
+            if path.startswith('/runs/'):
+                self.cache.invalidate('/runs/%s' % path.split('/')[2])
+        return resp
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def close(self):
+        logger.debug('PhSession.close(self).')
+        self._http.close()
+        if self.cassette is not None:
+            self.cassette.save()
+        with PhSession._registry_lock:
+            if PhSession._registry.get(self._api_key) is self:
+                del PhSession._registry[self._api_key]
+
+class _Prefetch(object):
+    #Calls fn(*args) on a background thread; result() waits for it and returns its value or re-raises its error
+    def __init__(self, fn, *args):
+        self._value = self._error = None
+        self._thread = threading.Thread(target=self._call, args=(fn, args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _call(self, fn, args):
+        try:
+            self._value = fn(*args)
+        except Exception as e:
+            self._error = e
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+#One call made by a FanOut: item is the argument, value what the call returned, error what it raised (or None)
+CallResult = collections.namedtuple('CallResult', ['index', 'item', 'value', 'error'])
+
+#Calls fn(item) for every item on a bounded pool of threads (started right away), e.g.
+#       for result in FanOut(fetch, tokens, max_workers=8, ordered=False):
+#           if result.error is None: ...
+# - iterating yields one CallResult per item, in the order of items (ordered=True) or as calls complete
+# - an exception raised by fn is reported in its CallResult instead of stopping the other calls
+# - requests made through a PhSession still go through its rate_limits, so throttling holds across workers
+#   (the default pool_maxsize of 16 connections covers the default 8 workers)
+# - cancel(), or leaving a loop over it early, stops the calls that have not started yet (their results
+#   carry an error instead)
+# - results are kept, so it can be iterated again (e.g. list(fan_out) and then a loop): later iterations
+#   replay them and wait only for calls still running
+class FanOut(object):
+    def __init__(self, fn, items, max_workers=8, ordered=True):
+        logger.info('FanOut.__init__(self, fn="%s", items="...", max_workers=%s, ordered=%s).', fn, max_workers, ordered)
+        self.ordered = ordered
+        self._fn = fn
+        self._items = list(items)
+        self._todo = queue.Queue()
+        self._done = queue.Queue()
+        self._results = [] #CallResults taken off _done so far, in the order they completed
+        self._results_lock = threading.Lock()
+        self._cancelled = False
+        for index, item in enumerate(self._items):
+            self._todo.put((index, item))
+        for i in range(min(max_workers, len(self._items))):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def __repr__(self):
+        return '<FanOut(items=%s, ordered=%s)>' % (len(self._items), self.ordered)
+
+    def __len__(self):
+        return len(self._items)
+
+    def _work(self):
+        while True:
+            try:
+                index, item = self._todo.get_nowait()
+            except queue.Empty:
+                return
+            if self._cancelled:
+                self._done.put(CallResult(index, item, None, Exception('Cancelled before the call for "%s" started.' % (item,))))
+                continue
+            try:
+                self._done.put(CallResult(index, item, self._fn(item), None))
+            except Exception as e:
+                self._done.put(CallResult(index, item, None, e))
+
+    def cancel(self):
+        self._cancelled = True
+
+    def _result(self, i):
+        #the i-th call to complete, waiting for it if needed
+        with self._results_lock:
+            while len(self._results) <= i:
+                self._results.append(self._done.get())
+            return self._results[i]
+
+    def __iter__(self):
+        finished = {} #index: CallResult, held back until the ones before it are done (ordered=True)
+        next_index = 0
+        try:
+            for i in range(len(self._items)):
+                result = self._result(i)
+                if not self.ordered:
+                    yield result
+                    continue
+                finished[result.index] = result
+                while next_index in finished:
+                    yield finished.pop(next_index)
+                    next_index += 1
+        finally:
+            self.cancel()
+
+#Read-only attribute for a known ParseHub field, looked up in the object's _jdata only when read
+class JsonField(object):
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        if obj._thin:
+            raise Warning('Attempted to access a non-existance attribute "%s" of a thin object. Running update()...' % self.name)
+        try:
+            return obj._jdata[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+
+#Known fields of the project and run objects returned by the API, see https://www.parsehub.com/docs/ref/api/v2/
+class ProjectFields(object):
+    __slots__ = ()
+    token = JsonField('token')
+    title = JsonField('title')
+    templates_json = JsonField('templates_json')
+    main_template = JsonField('main_template')
+    main_site = JsonField('main_site')
+    options_json = JsonField('options_json')
+    output_type = JsonField('output_type')
+    syntax_version = JsonField('syntax_version')
+    webhook = JsonField('webhook')
+
+class RunFields(object):
+    __slots__ = ()
+    project_token = JsonField('project_token')
+    run_token = JsonField('run_token')
+    status = JsonField('status')
+    data_ready = JsonField('data_ready')
+    start_time = JsonField('start_time')
+    end_time = JsonField('end_time')
+    pages = JsonField('pages')
+    md5sum = JsonField('md5sum')
+    start_url = JsonField('start_url')
+    start_template = JsonField('start_template')
+    start_value = JsonField('start_value')
+    is_empty = JsonField('is_empty')
+    options_json = JsonField('options_json')
+    webhook = JsonField('webhook')
+
+#Objects are slotted: known fields are JsonField descriptors and __getattr__ (only reached when
+#normal lookup fails) reads any other key from _jdata, so plain attribute access costs nothing extra
 class PhBase(object):
-    def __init__(self, api_key, thin=False, jdata=None, req_params=None, **kwargs):
-        logging.debug('PhBase.__init__(self, api_key="%s", thin="%s", initial_jdata="%s", req_params="%s", kwargs="%s").' %
-                      (api_key, thin, ('' if jdata is None else '...'), req_params, dict_except(kwargs, 'jdata')))
+    __slots__ = ('_api_key', '_session', '_thin', '_params', '_req_params', '_jdata')
+
+    def __init__(self, api_key, thin=False, jdata=None, req_params=None, session=None, **kwargs):
+        logger.debug('PhBase.__init__(self, api_key="%s", thin="%s", initial_jdata="%s", req_params="%s", session="%s", kwargs="%s").',
+                     api_key, thin, ('' if jdata is None else '...'), req_params, session, LazyDictExcept(kwargs, 'jdata'))
         self._api_key = api_key
+        self._session = session if session is not None else PhSession.for_api_key(api_key)
         self._thin = thin
         self._params = kwargs
         self._req_params = req_params
@@ -35,33 +1737,21 @@ class PhBase(object):
         return '<PhBase(api_key="%s")>' % self._api_key
 
     def update(self, jdata=None):
-        logging.debug('PhBase.update(self, jdata="%s").' % ('' if jdata is None else '...'))
+        logger.debug('PhBase.update(self, jdata="%s").', ('' if jdata is None else '...'))
         self._thin = False #reminder: set thin to false
         raise NotImplemented
 
-    def __getattribute__(self, name):
-        try:
-            return object.__getattribute__(self, name)
-        except AttributeError:
-
-            logging.debug('PhBase.__getattribute__(self, name="%s"): Not Found.' % name)
-
-            if name == '_thin':
-                raise AttributeError
+    def __getattr__(self, name):
+        if name.startswith('_'): #unset private slot
+            raise AttributeError(name)
 
-            if self._thin:
-                raise Warning('Attempted to access a non-existance attribute "%s" of a thin object. Running update()...' % name)
-                logging.debug('PhBase.__getattribute__(self, name="%s"): Running update...' % name)
-                self.update()
-                self._thin = False #make sure!
+        if self._thin:
+            raise Warning('Attempted to access a non-existance attribute "%s" of a thin object. Running update()...' % name)
 
-            try:
-                retval = self._jdata[name]
-                logging.debug('PhBase.__getattr__(self, name="%s"): Found in _jdata.' % name)
-                return retval
-            except:
-                logging.debug('PhBase.__getattr__(self, name="%s"): Not found in _jdata.' % name)
-                return object.__getattribute__(self, name)
+        try:
+            return self._jdata[name]
+        except (AttributeError, KeyError):
+            raise AttributeError(name)
 
     def _get_req_params(self, req_params=None, default_value=None):
         if req_params is not None:
@@ -74,16 +1764,19 @@ class PhBase(object):
             return {}
 
 class PhAccount(PhBase):
-    def __init__(self, api_key, **kwargs):
-        logging.info('PhAccount.__init__(self, api_key="%s", kwargs="%s").' %
-                     (api_key, dict_except(kwargs, 'jdata')))
+    __slots__ = ('_page_size', 'projects')
+
+    def __init__(self, api_key, page_size=PROJECT_PAGE_SIZE, **kwargs):
+        logger.info('PhAccount.__init__(self, api_key="%s", page_size=%s, kwargs="%s").',
+                    api_key, page_size, LazyDictExcept(kwargs, 'jdata'))
+        self._page_size = page_size
         super(self.__class__, self).__init__(api_key, **kwargs) 
         
     def __repr__(self):
         return '<PhAccount(api_key="%s")>' % self._api_key
     
     def update(self, jdata=None):
-        logging.debug('PhAccount.update(self, jdata="%s").' % '...')
+        logger.debug('PhAccount.update(self, jdata="%s").', '...')
         self.list_all_projects(jdata=jdata, **(self._params))
         self._thin = False
         return self
@@ -91,270 +1784,1362 @@ class PhAccount(PhBase):
     ### DIRECT API FUNCTIONS ###
 
     #Account-Level Functions
-    def list_all_projects(self, jdata=None, req_params=None, **params):
-        logging.info('PhAccount.list_all_projects(self, jdata="%s", req_params="%s", params="%s").' %
-                     (('' if jdata is None else '...'), req_params, params))
-        if jdata is None:
-            params['api_key'] = self._api_key
-            req_params = self._get_req_params(req_params)
-                    
-            logging.debug('PhAccount.list_all_projects: Requesting with params="%s", req_params="%s".' %
-                          (params, req_params))
-            
-            req = requests.get(
-                'https://www.parsehub.com/api/v2/projects', #list all projects
-                params=params,
-                **(req_params)
-            )
-
-            req.raise_for_status()
-            jdata = json.loads(req.text)
-
-        self._jdata = jdata
+    # - returns a lazy PhProjectList: only the first page is requested here, later pages are requested
+    #   (and PhProject objects built) as elements are touched
+    def list_all_projects(self, jdata=None, req_params=None, page_size=None, **params):
+        logger.info('PhAccount.list_all_projects(self, jdata="%s", req_params="%s", page_size=%s, params="%s").',
+                    ('' if jdata is None else '...'), req_params, page_size, params)
+        self.projects = PhProjectList(self, page_size or self._page_size, params, req_params, jdata)
+        self._jdata = self.projects._first_page_jdata
         self._thin = False #in case the user calls get_projects but not update() on a thin object
-        
-        logging.debug('PhAccount.list_all_projects: Parsing project list...')
-        self.projects = [
-            PhProject(self._api_key, proj_jdata['token'], thin=True, jdata=proj_jdata)
-            for proj_jdata in jdata['projects']
-        ]
-        logging.debug('PhAccount.list_all_projects: ... Done.')
         return self.projects
 
+    def _request_projects_page(self, params, req_params, offset, limit):
+        params = dict(params)
+        params['api_key'] = self._api_key
+        params['offset'] = offset
+        params['limit'] = limit
+        req_params = self._get_req_params(req_params)
+
+        logger.debug('PhAccount._request_projects_page: Requesting with params="%s", req_params="%s".',
+                     params, req_params)
+
+        req = self._session.get(
+            '/projects', #list all projects
+            params=params,
+            **(req_params)
+        )
+
+        req.raise_for_status()
+        return response_json(req)
+
     #Project-Level Functions
     def get_a_project(self, project_token, **kwargs):
+        kwargs.setdefault('session', self._session)
         return PhProject(self._api_key, project_token, **kwargs)
     
     def run_a_project(self, project_token, **kwargs):
-        return PhProject(self._api_key, project_token, thin=True).run(**kwargs)
+        return PhProject(self._api_key, project_token, thin=True, session=self._session).run(**kwargs)
     
     def get_last_ready_data(self, project_token, **kwargs):
-        return PhProject(self._api_key, project_token, thin=True).get_last_ready_data(**kwargs)
+        return PhProject(self._api_key, project_token, thin=True, session=self._session).get_last_ready_data(**kwargs)
 
     #Run-Level Functions
     def get_a_run(self, run_token, **kwargs):
+        kwargs.setdefault('session', self._session)
         return PhRun(self._api_key, run_token, **kwargs)
     
     def get_data_for_a_run(self, run_token, **kwargs):
-        return PhRun(self._api_key, run_token, thin=True).get_data(**kwargs)
+        return PhRun(self._api_key, run_token, thin=True, session=self._session).get_data(**kwargs)
     
     def cancel_a_run(self, run_token, **kwargs):
-        return PhRun(self._api_key, run_token, thin=True).cancel(**kwargs)
+        return PhRun(self._api_key, run_token, thin=True, session=self._session).cancel(**kwargs)
     
     def delete_a_run(self, run_token, **kwargs):
-        return PhRun(self._api_key, run_token, thin=True).delete(**kwargs)
+        return PhRun(self._api_key, run_token, thin=True, session=self._session).delete(**kwargs)
+
+    #Bulk Functions
+    # - each returns a FanOut of CallResults (value: what the single-item function above returns), with the
+    #   calls running on up to max_workers threads sharing this account's session
+    # - kwargs are passed to every call
+    def get_projects(self, project_tokens, max_workers=8, ordered=True, **kwargs):
+        return FanOut(lambda token: self.get_a_project(token, **kwargs), project_tokens, max_workers, ordered)
+
+    def run_projects(self, project_tokens, max_workers=8, ordered=True, **kwargs):
+        return FanOut(lambda token: self.run_a_project(token, **kwargs), project_tokens, max_workers, ordered)
+
+    def get_last_ready_data_for_projects(self, project_tokens, max_workers=8, ordered=True, **kwargs):
+        return FanOut(lambda token: self.get_last_ready_data(token, **kwargs), project_tokens, max_workers, ordered)
+
+    def get_data_for_runs(self, runs, max_workers=8, ordered=True, **kwargs):
+        #runs: run tokens or PhRun objects (e.g. the values of run_projects); each call waits for its run's data
+        def get_data(run):
+            if not isinstance(run, PhRun):
+                run = PhRun(self._api_key, run, thin=True, session=self._session)
+            return run.get_data(**kwargs)
+        return FanOut(get_data, runs, max_workers, ordered)
     
-class PhProject(PhBase):
+#Lazy, paginated sequence of an account's projects (what PhAccount.projects holds)
+# - supports len(), indexing, slicing and iteration; pages of (up to) page_size projects are requested with
+#   the API's offset/limit parameters, from the first missing index, the first time one of them is needed
+# - the length is total_projects when the API sends it; otherwise the list ends where a page comes back
+#   empty, so a server that caps limit below page_size only costs more requests
+# - PhProject objects are built on first access and then reused; breaking out of a loop stops paging
+class PhProjectList(object):
+    def __init__(self, account, page_size=PROJECT_PAGE_SIZE, params=None, req_params=None, jdata=None):
+        self._account = account
+        self._page_size = page_size
+        self._params = dict(params or {})
+        self._req_params = req_params
+        self._project_jdata = {} #index: project jdata
+        self._projects = {} #index: PhProject
+        self._loaded = 0 #projects 0 to _loaded - 1 are all in _project_jdata
+        self._total = None
+
+        if jdata is None:
+            jdata = self._fetch_page(0)
+        else: #a complete listing
+            self._store(0, jdata['projects'])
+            self._total = len(jdata['projects'])
+        self._first_page_jdata = jdata
+
+    def __repr__(self):
+        return '<PhProjectList(api_key="%s", loaded=%s, total=%s)>' % (self._account._api_key, len(self._project_jdata), self._total)
+
+    def _store(self, offset, projects):
+        for i, proj_jdata in enumerate(projects):
+            self._project_jdata[offset + i] = proj_jdata
+        while self._loaded in self._project_jdata:
+            self._loaded += 1
+
+    def _fetch_page(self, offset):
+        logger.debug('PhProjectList._fetch_page(self, offset=%s).', offset)
+        jdata = self._account._request_projects_page(self._params, self._req_params, offset, self._page_size)
+        projects = jdata['projects']
+        self._store(offset, projects)
+        if 'total_projects' in jdata:
+            self._total = jdata['total_projects']
+        elif not projects and offset == self._loaded:
+            self._total = offset
+        return jdata
+
+    def _load(self, index):
+        #True if the project at index exists, fetching the page that starts at it if needed
+        if index in self._project_jdata:
+            return True
+        if self._total is not None and index >= self._total:
+            return False
+        self._fetch_page(index)
+        return index in self._project_jdata
+
+    def _project(self, index):
+        project = self._projects.get(index)
+        if project is None:
+            proj_jdata = self._project_jdata[index]
+            project = PhProject(self._account._api_key, proj_jdata['token'], thin=True, jdata=proj_jdata,
+                                session=self._account._session)
+            self._projects[index] = project
+        return project
+
+    def __len__(self):
+        while self._total is None:
+            self._fetch_page(self._loaded) #every page either extends _loaded or ends the list
+        return self._total
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or not self._load(index):
+            raise IndexError('project index out of range')
+        return self._project(index)
+
+    def __iter__(self):
+        index = 0
+        while self._load(index):
+            yield self._project(index)
+            index += 1
+
+class PhProject(PhBase, ProjectFields):
+    __slots__ = ('_project_token', 'last_run', 'last_ready_run', 'run_list')
+
     def __init__(self, api_key, project_token, **kwargs):
-        logging.info('PhProject.__init__(self, api_key="%s", project_token="%s", kwargs="%s").' %
-                     (api_key, project_token, dict_except(kwargs, 'jdata')))
+        logger.info('PhProject.__init__(self, api_key="%s", project_token="%s", kwargs="%s").',
+                    api_key, project_token, LazyDictExcept(kwargs, 'jdata'))
         self._project_token = project_token
         super(self.__class__, self).__init__(api_key, **kwargs)
         
     def __repr__(self):
         title_s = ''
-        if hasattr(self, '_jdata') and self._jdata.has_key('title'):
+        if hasattr(self, '_jdata') and 'title' in self._jdata:
             title_s = ', title="%s"' % self._jdata['title']
         return '<PhProject(api_key="%s", project_token="%s"%s)>' % (self._api_key, self._project_token, title_s)
 
     def update(self, jdata=None):
-        logging.info('PhProject.update(self, jdata="%s").' % ('' if jdata is None else '...'))
+        logger.info('PhProject.update(self, jdata="%s").', ('' if jdata is None else '...'))
         if jdata is None:
             params = self._params
             params['api_key'] = self._api_key
             req_params = self._get_req_params()
             
-            logging.debug('PhProject.update: Requesting with params="%s", req_params="%s".' %
-                          (params, self._req_params))
+            logger.debug('PhProject.update: Requesting with params="%s", req_params="%s".',
+                         params, self._req_params)
             
-            req = requests.get(
-                'https://www.parsehub.com/api/v2/projects/%s' % #get a project
+            req = self._session.get(
+                '/projects/%s' % #get a project
                 self._project_token,
                 params=params,
                 **(req_params)
             )
 
             req.raise_for_status()
-            jdata = json.loads(req.text)
+            jdata = response_json(req)
 
         self._jdata = jdata
         self._thin = False
 
         try:
-            logging.debug('PhProject.update: Attempting to create last_run object...')
+            logger.debug('PhProject.update: Attempting to create last_run object...')
             lr_jdata = jdata['last_run']
-            self.last_run = PhRun(self._api_key, lr_jdata['run_token'], thin=True, jdata=lr_jdata)
-            logging.debug('PhProject.update: ... Success!')
+            self.last_run = PhRun(self._api_key, lr_jdata['run_token'], thin=True, jdata=lr_jdata, session=self._session)
+            logger.debug('PhProject.update: ... Success!')
         except Exception as e:
-            logging.debug('PhProject.update: Error: "%s"' % e)
+            logger.debug('PhProject.update: Error: "%s"', e)
 
         try:
-            logging.debug('PhProject.update: Attempting to create last_ready_run object...')
+            logger.debug('PhProject.update: Attempting to create last_ready_run object...')
             lrr_jdata = jdata['last_ready_run']
-            self.last_ready_run = PhRun(self._api_key, lrr_jdata['run_token'], thin=True, jdata=lrr_jdata)
-            logging.debug('PhProject.update: ... Success!')
+            self.last_ready_run = PhRun(self._api_key, lrr_jdata['run_token'], thin=True, jdata=lrr_jdata, session=self._session)
+            logger.debug('PhProject.update: ... Success!')
         except Exception as e:
-            logging.debug('PhProject.update: Error: "%s"' % e)
+            logger.debug('PhProject.update: Error: "%s"', e)
 
         try:
-            logging.debug('PhProject.update: Attempting to create run_list object...')
+            logger.debug('PhProject.update: Attempting to create run_list object...')
             self.run_list = [
-                PhRun(self._api_key, run_jdata['run_token'], thin=True, jdata=run_jdata)
+                PhRun(self._api_key, run_jdata['run_token'], thin=True, jdata=run_jdata, session=self._session)
                 for run_jdata in jdata['run_list']
             ]
-            logging.debug('PhProject.update: ... Success!')
+            logger.debug('PhProject.update: ... Success!')
         except Exception as e:
-            logging.debug('PhProject.update: Error: "%s"' % e)
+            logger.debug('PhProject.update: Error: "%s"', e)
 
-        
+    def _request_runs_page(self, offset, req_params=None):
+        #The project endpoint returns one page of run_list per request, starting at offset
+        params = dict(self._params)
+        params['api_key'] = self._api_key
+        params['offset'] = offset
+        req = self._session.get(
+            '/projects/%s' % #get a project
+            self._project_token,
+            params=params,
+            **(self._get_req_params(req_params))
+        )
+        req.raise_for_status()
+        return response_json(req).get('run_list') or []
+
+    def iter_runs(self, status=None, since=None, where=None, until=None, prefetch=True, req_params=None):
+        #Yields a thin PhRun per entry of the project's whole run history, newest first.
+        #Only one page of run jdata is held at a time, and PhRun objects are only built for runs that are yielded.
+        #status: a status or tuple of statuses to yield, e.g. 'complete'
+        #since: stop at the first run that started before this ISO timestamp, e.g. '2016-04-11T00:00:00'
+        #where/until: callables on a run's jdata; skip runs where where() is false, stop at the first run where until() is true
+        #prefetch: request the next page in the background while the current one is consumed
+        logger.info('PhProject.iter_runs(self, status="%s", since="%s", prefetch=%s).', status, since, prefetch)
+        if status is not None and not isinstance(status, (list, tuple, set)):
+            status = (status,)
+
+        offset = 0
+        runs = self._request_runs_page(offset, req_params)
+        while runs:
+            offset += len(runs)
+            next_page = _Prefetch(self._request_runs_page, offset, req_params) if prefetch else None
+            logger.debug('PhProject.iter_runs: Got %s runs, next offset %s.', len(runs), offset)
+
+            for run_jdata in runs:
+                if since is not None and (run_jdata.get('start_time') or '') < since:
+                    return
+                if until is not None and until(run_jdata):
+                    return
+                if status is not None and run_jdata.get('status') not in status:
+                    continue
+                if where is not None and not where(run_jdata):
+                    continue
+                yield PhRun(self._api_key, run_jdata['run_token'], thin=True, jdata=run_jdata, session=self._session)
+
+            runs = next_page.result() if prefetch else self._request_runs_page(offset, req_params)
 
     def run(self, req_params=None, **kwargs):
-        logging.info('PhProject.run(self, req_params="%s", kwargs="%s").' %
-                     (req_params, dict_except(kwargs, 'jdata')))
+        logger.info('PhProject.run(self, req_params="%s", kwargs="%s").',
+                    req_params, LazyDictExcept(kwargs, 'jdata'))
         params = kwargs
         params['api_key'] = self._api_key
         req_params = self._get_req_params(req_params)
         
-        logging.debug('PhProject.run: Request(project_token="%s", params="%s", req_params="%s"'
-                      % (self._project_token, params, req_params))
+        logger.debug('PhProject.run: Request(project_token="%s", params="%s", req_params="%s"', self._project_token, params, req_params)
         
-        req = requests.post(
-            'https://www.parsehub.com/api/v2/projects/%s/run' % #run a project
+        req = self._session.post(
+            '/projects/%s/run' % #run a project
             self._project_token,
             params=params,
             **(req_params)
         )
 
         req.raise_for_status()
-        req_jdata = json.loads(req.text)
-        return PhRun(self._api_key, req_jdata['run_token'], thin=True, jdata=req_jdata)
+        req_jdata = response_json(req)
+        return PhRun(self._api_key, req_jdata['run_token'], thin=True, jdata=req_jdata, session=self._session)
     
     def get_last_ready_data(self, req_params=None, **kwargs):
-        logging.info('PhProject.get_last_ready_data(self, req_params="%s", kwargs="%s").' %
-                     (req_params, dict_except(kwargs, 'jdata')))
+        logger.info('PhProject.get_last_ready_data(self, req_params="%s", kwargs="%s").',
+                    req_params, LazyDictExcept(kwargs, 'jdata'))
+        output_format = kwargs.get('format', 'json')
+        if self._session.dataset_cache is not None or output_format in LOCAL_FORMATS:
+            data = b''.join(self.iter_last_ready_data(req_params=req_params, **kwargs))
+            return data if output_format == 'phb' else data.decode('utf-8')
+        return self._last_ready_data_request(req_params, stream=False, **kwargs).text
+
+    def iter_last_ready_data(self, chunk_size=DEFAULT_CHUNK_SIZE, req_params=None, compressed=False, **kwargs):
+        logger.info('PhProject.iter_last_ready_data(self, chunk_size=%s, req_params="%s", compressed=%s, kwargs="%s").',
+                    chunk_size, req_params, compressed, LazyDictExcept(kwargs, 'jdata'))
+        if self._session.dataset_cache is not None:
+            #the data endpoint doesn't say which run it serves, so go through the run itself (cached by run token)
+            self.update()
+            lrr_jdata = self._jdata.get('last_ready_run')
+            if lrr_jdata:
+                return self.last_ready_run.iter_data(chunk_size=chunk_size, req_params=req_params, blocking=False,
+                                                     compressed=compressed, **kwargs)
+        output_format = kwargs.get('format', 'json')
+        if output_format in LOCAL_FORMATS:
+            kwargs['format'] = 'json'
+            chunks = convert_run_data(iter_response(self._last_ready_data_request(req_params, stream=True, **kwargs), chunk_size),
+                                      'json', output_format, chunk_size=chunk_size)
+        else:
+            chunks = iter_response(self._last_ready_data_request(req_params, stream=True, **kwargs), chunk_size,
+                                   decode_content=not compressed)
+        return gzip_chunks(chunks) if compressed else gunzip_chunks(chunks)
+
+    def save_last_ready_data(self, f, chunk_size=DEFAULT_CHUNK_SIZE, req_params=None, compress=None, **kwargs):
+        logger.info('PhProject.save_last_ready_data(self, f="%s", chunk_size=%s, req_params="%s", compress=%s, kwargs="%s").',
+                    f, chunk_size, req_params, compress, LazyDictExcept(kwargs, 'jdata'))
+        compressed = _gzip_path(f) if compress is None else compress
+        return write_chunks(self.iter_last_ready_data(chunk_size=chunk_size, req_params=req_params, compressed=compressed, **kwargs), f)
+
+    def iter_last_ready_records(self, base_list=None, chunk_size=DEFAULT_CHUNK_SIZE, req_params=None, **kwargs):
+        logger.info('PhProject.iter_last_ready_records(self, base_list="%s", chunk_size=%s, req_params="%s", kwargs="%s").',
+                    base_list, chunk_size, req_params, LazyDictExcept(kwargs, 'jdata'))
+        kwargs['format'] = 'json'
+        return iter_json_records(self.iter_last_ready_data(chunk_size=chunk_size, req_params=req_params, **kwargs), base_list)
+
+    def iter_last_ready_csv_rows(self, as_dict=False, encoding='utf-8-sig', chunk_size=DEFAULT_CHUNK_SIZE, req_params=None, **kwargs):
+        logger.info('PhProject.iter_last_ready_csv_rows(self, as_dict=%s, encoding="%s", chunk_size=%s, req_params="%s", kwargs="%s").',
+                    as_dict, encoding, chunk_size, req_params, LazyDictExcept(kwargs, 'jdata'))
+        kwargs['format'] = 'csv'
+        return iter_csv_rows(self.iter_last_ready_data(chunk_size=chunk_size, req_params=req_params, **kwargs), as_dict, encoding)
+
+    def diff_last_ready_runs(self, key=None, base_list=None, removed=True):
+        #What changed between the last two ready runs (see diff_runs), everything 'added' with only one ready run
+        logger.info('PhProject.diff_last_ready_runs(self, key="%s", base_list="%s", removed=%s).', key, base_list, removed)
+        runs = []
+        for run in self.iter_runs(where=lambda run_jdata: run_jdata.get('data_ready')):
+            runs.append(run)
+            if len(runs) == 2:
+                break
+        if not runs:
+            raise Exception('Project has no ready runs.')
+        return diff_runs(runs[1] if len(runs) > 1 else [], runs[0], key, base_list, removed)
+
+    def _last_ready_data_request(self, req_params=None, stream=False, **kwargs):
         params = kwargs
         params['api_key'] = self._api_key
         req_params = self._get_req_params(req_params)
         
+        logger.debug('PhProject._last_ready_data_request: Requesting with params="%s", req_params="%s", stream=%s.',
+                     params, req_params, stream)
         
-        req = requests.get(
-            'https://www.parsehub.com/api/v2/projects/%s/last_ready_run/data' % #run a project
+        req = self._session.get(
+            '/projects/%s/last_ready_run/data' % #get data for the last ready run
             self._project_token,
             params=params,
+            stream=stream,
             **(req_params)
         )
 
+        if not req.ok:
+            req.close()
         req.raise_for_status()
-        return req.text
+        return req
+
 
+class PhRun(PhBase, RunFields):
+    __slots__ = ('_run_token', '_poll_policy', '_update_count', '_last_update_time')
 
-class PhRun(PhBase):
-    def __init__(self, api_key, run_token, **kwargs):
-        logging.info('PhRun.__init__(self, api_key="%s", run_token="%s", kwargs="%s").' %
-                     (api_key, run_token, dict_except(kwargs, 'jdata')))
+    def __init__(self, api_key, run_token, poll_policy=None, **kwargs):
+        logger.info('PhRun.__init__(self, api_key="%s", run_token="%s", poll_policy="%s", kwargs="%s").',
+                    api_key, run_token, poll_policy, LazyDictExcept(kwargs, 'jdata'))
         self._run_token = run_token
+        self._poll_policy = poll_policy
+        self._update_count = 0 #network updates so far, see RUN_UPDATE_FREE_LIMIT
+        self._last_update_time = None
         super(self.__class__, self).__init__(api_key, **kwargs)
         
     def __repr__(self):
         return '<PhRun(api_key="%s", run_token="%s")>' % (self._api_key, self._run_token)
 
-    def update(self, jdata=None):
-        logging.info('PhRun.update(self, jdata="%s").' % ('' if jdata is None else '...'))
+    def update(self, jdata=None, poll_policy=None):
+        logger.info('PhRun.update(self, jdata="%s", poll_policy="%s").', ('' if jdata is None else '...'), poll_policy)
         if jdata is None:
-            params = self._params
-            params['api_key'] = self._api_key
-            req_params = self._get_req_params()
-        
-            logging.debug('PhRun.update: Requesting with params="%s", req_params="%s".' %
-                          (params, self._req_params))
+            jdata = self._fetch_jdata(self._get_poll_policy(poll_policy, max_429_retries=0))
+
+        self._jdata = jdata
+        self._thin = False
+
+    def _get_poll_policy(self, poll_policy=None, wait_increment=5, wait_timeout=None, max_429_retries=3):
+        #one-shot updates pass max_429_retries=0: without a PollPolicy of their own they raise on HTTP 429
+        #rather than sleep limited_interval seconds per retry
+        if poll_policy is not None:
+            return poll_policy
+        elif self._poll_policy is not None:
+            return self._poll_policy
+        else:
+            return PollPolicy(interval=wait_increment, timeout=wait_timeout, max_429_retries=max_429_retries)
+
+    def _fetch_jdata(self, poll_policy, deadline=None, revalidate=False):
+        params = self._params
+        params['api_key'] = self._api_key
+        req_params = self._get_req_params()
+
+        retries = 0
+        while True:
+            logger.debug('PhRun._fetch_jdata: Requesting with params="%s", req_params="%s".',
+                         params, self._req_params)
 
-            req = requests.get(
-                'https://www.parsehub.com/api/v2/runs/%s' % #get a run
+            req = self._session.get(
+                '/runs/%s' % #get a run
                 self._run_token,
                 params=params,
+                revalidate=revalidate,
+                retries=retries,
                 **(req_params)
             )
-            if req.status_code == 429:
-                Warning('Run update limited has been hit -- try sleeping 180s between updates after the first 25 updates for a run...')
-            req.raise_for_status()
-            jdata = json.loads(req.text)
+            if req.from_cache:
+                break
+            self._update_count += 1
+            self._last_update_time = self._session.time()
+            if req.status_code != 429:
+                break
 
-        self._jdata = jdata
-        self._thin = False
+            retry_wait = poll_policy.retry_after(req, retries)
+            if retry_wait is None or (deadline is not None and self._session.time() + retry_wait > deadline):
+                logger.warning('PhRun.update: Run update limit has been hit for run "%s" -- ParseHub allows %s updates per run, then one every %ss.',
+                               self._run_token, poll_policy.free_updates, poll_policy.limited_interval)
+                break
+            logger.info('PhRun._fetch_jdata: Rate limited (HTTP 429), retrying in %ss...', retry_wait)
+            self._session.sleep(retry_wait)
+            retries += 1
+
+        req.raise_for_status()
+        return response_json(req)
+
+    #Block until the run's data is ready, polling as described by poll_policy
+    # - without a poll_policy, polls every wait_increment seconds for at most wait_timeout seconds (wall clock)
+    # - raises if the run ends up cancelled/errored instead, since its data will never be ready
+    def wait_until_ready(self, wait_increment=5, wait_timeout=None, poll_policy=None):
+        poll_policy = self._get_poll_policy(poll_policy, wait_increment, wait_timeout)
+        logger.info('PhRun.wait_until_ready(self, poll_policy="%s").', poll_policy)
+
+        start_time = self._session.time()
+        deadline = poll_policy.deadline(start_time)
+        webhook = self._session.webhook
+        seq, pushed = webhook.wait_for(self._run_token) if webhook is not None else (0, None)
+        if pushed is not None:
+            self.update(jdata=_notified_jdata(self, webhook, pushed, poll_policy, deadline))
+        else:
+            self.update(jdata=self._fetch_jdata(poll_policy, deadline, revalidate=True))
+
+        attempt = 0
+        while not self._jdata.get('data_ready'):
+            if self._jdata.get('status') in TERMINAL_RUN_STATUSES:
+                raise Exception('Run "%s" finished without data (status="%s").' % (self._run_token, self._jdata['status']))
+
+            now = self._session.time()
+            if deadline is not None and now >= deadline:
+                raise Exception('Timed out waiting for data after %ss.' % (now - start_time))
+
+            delay = poll_policy.next_delay(attempt, self._update_count, self._last_update_time, now)
+            if webhook is not None:
+                delay = max(delay, webhook.fallback_interval)
+            if deadline is not None:
+                delay = min(delay, deadline - now)
+            logger.info('PhRun.wait_until_ready: Data not ready, waiting %ss (aggregate: %ss)...',
+                        delay, now - start_time)
+            if webhook is not None:
+                seq, pushed = webhook.wait_for(self._run_token, delay, seq)
+                if pushed is not None:
+                    self.update(jdata=_notified_jdata(self, webhook, pushed, poll_policy, deadline))
+                    continue
+            else:
+                self._session.sleep(delay)
+            attempt += 1
+            self.update(jdata=self._fetch_jdata(poll_policy, deadline, revalidate=True))
+        return self
     
-    def get_data(self, req_params=None, blocking=True, wait_increment=5, wait_timeout=None, connect_timeout=3, download_timeout=600, **kwargs):
-        logging.info('PhRun.get_data(self, req_params="%s", blocking="%s", wait_increment=%ss, ' % (req_params, blocking, wait_increment))
-        logging.info('\twait_timeout=%ss, connect_timeout=%ss, download_timeout=%ss, ' % (wait_timeout, connect_timeout, download_timeout))
-        logging.info('\tkwargs="%s").' % dict_except(kwargs, 'jdata'))
-        
-        params = kwargs
-        params['api_key'] = self._api_key
-        req_params = self._get_req_params(req_params, {'timeout': (connect_timeout, download_timeout)})
+    def get_data(self, req_params=None, blocking=True, wait_increment=5, wait_timeout=None, connect_timeout=3, download_timeout=600, poll_policy=None, **kwargs):
+        logger.info('PhRun.get_data(self, req_params="%s", blocking="%s", wait_increment=%ss, ', req_params, blocking, wait_increment)
+        logger.info('\twait_timeout=%ss, connect_timeout=%ss, download_timeout=%ss, ', wait_timeout, connect_timeout, download_timeout)
+        logger.info('\tpoll_policy="%s", kwargs="%s").', poll_policy, LazyDictExcept(kwargs, 'jdata'))
 
-        logging.debug('PhRun.get_data: Updating run before retrieving data...')
-        self.update()
+        output_format = kwargs.get('format', 'json')
+        if self._session.dataset_cache is not None or output_format in LOCAL_FORMATS:
+            data = b''.join(self.iter_data(DEFAULT_CHUNK_SIZE, req_params, blocking, wait_increment, wait_timeout, connect_timeout,
+                                           download_timeout, poll_policy, **kwargs))
+            return data if output_format == 'phb' else data.decode('utf-8')
+        return self._data_request(req_params, blocking, wait_increment, wait_timeout, connect_timeout, download_timeout,
+                                  poll_policy, stream=False, **kwargs).text
 
-        if not blocking and not self.data_ready:
-            raise Exception('Data not ready (non-blocking call).')
+    #Streaming variants of get_data: the download is never held in memory as a whole
+    # - iter_data returns an iterator of byte chunks (at most chunk_size bytes each, about that many when converted)
+    # - format may also be one of LOCAL_FORMATS ('ndjson', 'phb'), converted from the JSON download (get_data
+    #   returns bytes for 'phb'); with DatasetCache(convert=True), so is 'csv'
+    # - compressed=True yields the data gzip-compressed: the bytes the server sent when it sent gzip (see
+    #   PhSession(compress=...)), so nothing is decompressed and compressed again
+    # - save_data writes those chunks to a path or file-like object and returns the byte count; it writes gzip
+    #   when the path ends in .gz, or as compress says (read the file back with read_chunks)
+    def iter_data(self, chunk_size=DEFAULT_CHUNK_SIZE, req_params=None, blocking=True, wait_increment=5, wait_timeout=None, connect_timeout=3, download_timeout=600, poll_policy=None, compressed=False, **kwargs):
+        logger.info('PhRun.iter_data(self, chunk_size=%s, req_params="%s", blocking="%s", wait_increment=%ss, ', chunk_size, req_params, blocking, wait_increment)
+        logger.info('\twait_timeout=%ss, connect_timeout=%ss, download_timeout=%ss, ', wait_timeout, connect_timeout, download_timeout)
+        logger.info('\tpoll_policy="%s", compressed=%s, kwargs="%s").', poll_policy, compressed, LazyDictExcept(kwargs, 'jdata'))
 
-        current_wait_time = 0
+        dataset_cache = self._session.dataset_cache
+        output_format = kwargs.get('format', 'json')
+        if dataset_cache is not None:
+            cached = dataset_cache.iter_chunks(self._run_token, output_format, chunk_size, compressed)
+            if cached is not None:
+                return cached
 
-        while (blocking and not self.data_ready):
-            logging.info('PhRun.get_data: Blocking and data not ready, waiting %ss (aggregate: %ss)...' %
-                         (wait_increment, current_wait_time))
-            time.sleep(wait_increment)
-            current_wait_time += wait_increment
-            if wait_timeout is not None and current_wait_time >= wait_timeout:
-                raise Exception('Timed out waiting for data after %ss.' % current_wait_time)
-            logging.debug('PhRun.get_data: Updating data_ready flag...')
-            self.update()
+        compress_at_rest = dataset_cache is not None and dataset_cache.compress
+        if output_format in LOCAL_FORMATS or (output_format != 'json' and dataset_cache is not None and dataset_cache.convert):
+            logger.debug('PhRun.iter_data: Converting the JSON data to "%s".', output_format)
+            kwargs['format'] = 'json'
+            chunks = convert_run_data(self.iter_data(chunk_size, req_params, blocking, wait_increment, wait_timeout, connect_timeout,
+                                                     download_timeout, poll_policy, **kwargs), 'json', output_format, chunk_size=chunk_size)
+        else:
+            req = self._data_request(req_params, blocking, wait_increment, wait_timeout, connect_timeout, download_timeout,
+                                     poll_policy, stream=True, **kwargs)
+            chunks = iter_response(req, chunk_size, decode_content=not (compressed or compress_at_rest))
+
+        if dataset_cache is not None:
+            chunks = dataset_cache.store(self._run_token, output_format, gzip_chunks(chunks) if compress_at_rest else chunks)
+        return gzip_chunks(chunks) if compressed else gunzip_chunks(chunks)
+
+    def save_data(self, f, chunk_size=DEFAULT_CHUNK_SIZE, compress=None, **kwargs):
+        logger.info('PhRun.save_data(self, f="%s", chunk_size=%s, compress=%s, kwargs="%s").',
+                    f, chunk_size, compress, LazyDictExcept(kwargs, 'jdata'))
+        compressed = _gzip_path(f) if compress is None else compress
+        return write_chunks(self.iter_data(chunk_size=chunk_size, compressed=compressed, **kwargs), f)
+
+    #Yields the records of the run's JSON data one at a time while it downloads (see iter_json_records)
+    def iter_records(self, base_list=None, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+        logger.info('PhRun.iter_records(self, base_list="%s", chunk_size=%s, kwargs="%s").', base_list, chunk_size, LazyDictExcept(kwargs, 'jdata'))
+        kwargs['format'] = 'json'
+        return iter_json_records(self.iter_data(chunk_size=chunk_size, **kwargs), base_list)
+
+    #Yields the rows of the run's CSV data one at a time while it downloads (see iter_csv_rows)
+    def iter_csv_rows(self, as_dict=False, encoding='utf-8-sig', chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+        logger.info('PhRun.iter_csv_rows(self, as_dict=%s, encoding="%s", chunk_size=%s, kwargs="%s").',
+                    as_dict, encoding, chunk_size, LazyDictExcept(kwargs, 'jdata'))
+        kwargs['format'] = 'csv'
+        return iter_csv_rows(self.iter_data(chunk_size=chunk_size, **kwargs), as_dict, encoding)
+
+    def _data_request(self, req_params, blocking, wait_increment, wait_timeout, connect_timeout, download_timeout, poll_policy=None, stream=False, **kwargs):
+        params = kwargs
+        params['api_key'] = self._api_key
+        req_params = self._get_req_params(req_params, {'timeout': (connect_timeout, download_timeout)})
+
+        if blocking:
+            self.wait_until_ready(wait_increment, wait_timeout, poll_policy)
+        else:
+            logger.debug('PhRun._data_request: Updating run before retrieving data...')
+            self.update(jdata=self._fetch_jdata(self._get_poll_policy(poll_policy, max_429_retries=0), revalidate=True))
+            if not self.data_ready:
+                raise Exception('Data not ready (non-blocking call).')
         
-        logging.debug('PhRun.get_data: Requesting with params="%s", req_params="%s".' % (params, req_params))
+        logger.debug('PhRun._data_request: Requesting with params="%s", req_params="%s", stream=%s.', params, req_params, stream)
         
-        req = requests.get(
-            'https://www.parsehub.com/api/v2/runs/%s/data' % #get data for a run
+        req = self._session.get(
+            '/runs/%s/data' % #get data for a run
             self._run_token,
             params=params,
+            stream=stream,
             **(req_params)
         )
 
+        if not req.ok:
+            req.close()
         req.raise_for_status()
-        return req.text
+        return req
 
     def cancel(self, req_params=None, **kwargs):
-        logging.info('PhRun.cancel(self, req_params="%s", kwargs="%s").' % (req_params, dict_except(kwargs, 'jdata')))
+        logger.info('PhRun.cancel(self, req_params="%s", kwargs="%s").', req_params, LazyDictExcept(kwargs, 'jdata'))
         params = kwargs
         params['api_key'] = self._api_key
         req_params = self._get_req_params(req_params)
         
-        logging.debug('PhRun.cancel: Requesting with params="%s", req_params="%s".' % (params, req_params))
+        logger.debug('PhRun.cancel: Requesting with params="%s", req_params="%s".', params, req_params)
         
-        req = requests.post(
-            'https://www.parsehub.com/api/v2/runs/%s/cancel' % #cancel a run
+        req = self._session.post(
+            '/runs/%s/cancel' % #cancel a run
             self._run_token,
             params=params,
             **(req_params)
         )
 
         req.raise_for_status()
-        req_jdata = json.loads(req.text)
+        req_jdata = response_json(req)
         return req_jdata
 
     def delete(self, req_params=None, **kwargs):
-        logging.info('PhRun.delete(self, req_params="%s", kwargs="%s").' % (req_params, dict_except(kwargs, 'jdata')))
+        logger.info('PhRun.delete(self, req_params="%s", kwargs="%s").', req_params, LazyDictExcept(kwargs, 'jdata'))
         params = kwargs
         params['api_key'] = self._api_key
         req_params = self._get_req_params(req_params)
         
-        logging.debug('PhRun.delete: Requesting with params="%s", req_params="%s".' % (params, req_params))
+        logger.debug('PhRun.delete: Requesting with params="%s", req_params="%s".', params, req_params)
         
-        req = requests.delete(
-            'https://www.parsehub.com/api/v2/runs/%s' % #delete a run
+        req = self._session.delete(
+            '/runs/%s' % #delete a run
             self._run_token,
             params=params,
             **(req_params)
         )
 
         req.raise_for_status()
-        req_jdata = json.loads(req.text)
+        req_jdata = response_json(req)
         return req_jdata
+
+### MULTI-RUN WAITING ###
+
+def _run_finished(run):
+    jdata = getattr(run, '_jdata', None)
+    return jdata is not None and (jdata.get('data_ready') or jdata.get('status') in TERMINAL_RUN_STATUSES)
+
+def iter_completed_runs(runs, wait_increment=5, wait_timeout=None, stagger=True, poll_policy=None):
+    #Wait on many runs from the calling thread, yielding each run as soon as it has finished
+    # - finished means data_ready, or a terminal status ('cancelled'/'error'), so check run.data_ready
+    # - one poll queue for all runs: first polls are spread over the first interval (stagger=True), and each
+    #   run is then re-polled as poll_policy describes, within its ParseHub update budget
+    # - without a poll_policy, polls every wait_increment seconds for at most wait_timeout seconds
+    # - runs sharing an API key share its PhSession, so every poll reuses the same connection pool
+    #   (waits follow the first run's session clock, see PhSession.sleep)
+    # - when the first run's session has a webhook (see WebhookReceiver), runs are updated from its
+    #   notifications while waiting, and re-polled no more often than its fallback_interval
+    if poll_policy is None:
+        poll_policy = PollPolicy(interval=wait_increment, timeout=wait_timeout)
+    logger.info('iter_completed_runs(runs="...", stagger=%s, poll_policy="%s").', stagger, poll_policy)
+    runs = list(runs)
+    clock = runs[0]._session if runs else time
+    webhook = getattr(clock, 'webhook', None)
+    start_time = clock.time()
+    deadline = poll_policy.deadline(start_time)
+
+    heap = [] #(poll time, index, attempt, run)
+    pending = {} #i: run
+    for i, run in enumerate(runs):
+        if _run_finished(run):
+            yield run
+            continue
+        offset = poll_policy.interval * i / float(len(runs)) if stagger else 0
+        heapq.heappush(heap, (start_time + offset, i, 0, run))
+        pending[i] = run
+    seq = 0
+
+    while heap:
+        poll_time, i, attempt, run = heap[0]
+        if i not in pending: #finished by a notification
+            heapq.heappop(heap)
+            continue
+        now = clock.time()
+        if deadline is not None and now >= deadline:
+            raise Exception('Timed out waiting for %s run(s) after %ss.' % (len(pending), now - start_time))
+        if poll_time > now:
+            wait = (poll_time if deadline is None else min(poll_time, deadline)) - now
+            if webhook is None:
+                clock.sleep(wait)
+                continue
+            seq, pushed = webhook.updates(seq, wait)
+            for j, run in sorted(pending.items()):
+                if run._run_token in pushed:
+                    run.update(jdata=_notified_jdata(run, webhook, pushed[run._run_token], poll_policy, deadline))
+                    if _run_finished(run):
+                        del pending[j]
+                        yield run
+            continue
+
+        heapq.heappop(heap)
+        logger.debug('iter_completed_runs: Updating %s (%s runs pending)...', run, len(pending))
+        run.update(jdata=run._fetch_jdata(poll_policy, deadline, revalidate=True))
+        if _run_finished(run):
+            del pending[i]
+            yield run
+        else:
+            now = clock.time()
+            delay = poll_policy.next_delay(attempt, run._update_count, run._last_update_time, now)
+            if webhook is not None:
+                delay = max(delay, webhook.fallback_interval)
+            heapq.heappush(heap, (now + delay, i, attempt + 1, run))
+
+def wait_for_runs(runs, wait_increment=5, wait_timeout=None, stagger=True, poll_policy=None):
+    #Block until every run has finished (see iter_completed_runs); returns the runs in their original order
+    runs = list(runs)
+    for run in iter_completed_runs(runs, wait_increment=wait_increment, wait_timeout=wait_timeout, stagger=stagger,
+                                   poll_policy=poll_policy):
+        pass
+    return runs
+
+### SCHEDULED RUNS ###
+
+_SCHEDULER_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS schedules (
+    name TEXT PRIMARY KEY,
+    project_token TEXT NOT NULL,
+    interval REAL NOT NULL,
+    next_time REAL NOT NULL,
+    params TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project_token TEXT NOT NULL,
+    params TEXT NOT NULL,
+    schedule TEXT,
+    due_time REAL NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_token TEXT,
+    run_jdata TEXT,
+    started_at REAL,
+    polled_at REAL,
+    finished_at REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, due_time);
+'''
+
+#queued -> starting -> running -> ready -> done, or failed; starting and running jobs count against the limits
+JOB_STATES = ('queued', 'starting', 'running', 'ready', 'done', 'failed')
+
+def _utc_iso(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds))
+
+def _utc_seconds(iso):
+    return calendar.timegm(time.strptime(iso[:19], '%Y-%m-%dT%H:%M:%S'))
+
+def _same_json(a, b):
+    try:
+        return json.loads(a) == json.loads(b)
+    except (TypeError, ValueError):
+        return a == b
+
+def _started_by(job, run):
+    #whether run may be the one job's start request started: within a minute of it (allowing for clock skew)
+    #and with its start parameters
+    params = job['params']
+    return (abs(_utc_seconds(run._jdata['start_time']) - job['started_at']) <= 60
+            and all(params[name] == run._jdata.get(name) for name in ('start_url', 'start_template') if name in params)
+            and ('start_value_override' not in params or _same_json(params['start_value_override'], run._jdata.get('start_value'))))
+
+#Persistent queue of project runs, kept in an SQLite file so a restarted scheduler picks up where it stopped
+#       scheduler = RunScheduler(API_KEY, 'runs.db', max_running=5, on_complete=lambda run, job: run.save_data('%s.json.gz' % run.run_token))
+#       scheduler.add_schedule('tProject', 3600, start_url='http://www.example.com') #every hour
+#       scheduler.enqueue('tOtherProject')                                              #once, as soon as possible
+#       scheduler.run_forever()
+# - tick() queues the jobs of due schedules, updates running runs, hands ready runs to on_complete(run, job)
+#   and starts queued jobs, never running more than max_running runs in all, project_limit per project
+# - a schedule with a job still queued or running skips its turn, and turns missed while the scheduler
+#   was down are not caught up; add_schedule with an existing name updates it, so scripts can re-add theirs
+# - run tokens are committed as soon as a run starts, so restarts never lose track of a run. A job left
+#   'starting' (the scheduler died, or the start request failed without an HTTP status) adopts the
+#   untracked run of its project that started within a minute of it with the same start_url,
+#   start_template and start_value_override, if any, and is queued again when there is none
+# - failed starts (an HTTP error, or a job left 'starting' without a run) are retried every retry_delay
+#   seconds; the job fails after max_attempts of them
+# - runs are polled at most every poll_interval seconds (or the fallback_interval of the session's webhook,
+#   see WebhookReceiver); on_complete is retried on the next tick when it raises
+# - one scheduler per database file; its methods may be called from any thread
+class RunScheduler(object):
+    def __init__(self, api_key, path, max_running=5, project_limit=1, poll_interval=60, on_complete=None,
+                 max_attempts=3, retry_delay=60, session=None):
+        logger.info('RunScheduler.__init__(self, api_key="%s", path="%s", max_running=%s, project_limit=%s, '
+                    'poll_interval=%s, on_complete="%s", max_attempts=%s, retry_delay=%s, session="%s").',
+                    api_key, path, max_running, project_limit, poll_interval, on_complete, max_attempts, retry_delay, session)
+        self._api_key = api_key
+        self.path = path
+        self.max_running = max_running
+        self.project_limit = project_limit
+        self.poll_interval = poll_interval
+        self.on_complete = on_complete
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._session = session if session is not None else PhSession.for_api_key(api_key)
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._notified = {} #run token: seq of the last webhook notification seen for it
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(_SCHEDULER_SCHEMA)
+
+    def __repr__(self):
+        return '<RunScheduler(api_key="%s", path="%s")>' % (self._api_key, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.stop()
+        with self._lock:
+            self._db.close()
+
+    def add_schedule(self, project_token, interval, name=None, start_time=None, **params):
+        #run project_token every interval seconds from start_time (default now); params go to PhProject.run
+        name = project_token if name is None else name
+        logger.info('RunScheduler.add_schedule(self, project_token="%s", interval=%s, name="%s", start_time=%s, params="%s").',
+                    project_token, interval, name, start_time, params)
+        with self._lock, self._db:
+            updated = self._db.execute('UPDATE schedules SET project_token = ?, interval = ?, params = ? WHERE name = ?',
+                                       (project_token, interval, json.dumps(params), name)).rowcount
+            if not updated:
+                self._db.execute('INSERT INTO schedules (name, project_token, interval, next_time, params) VALUES (?, ?, ?, ?, ?)',
+                                 (name, project_token, interval, self._session.time() if start_time is None else start_time,
+                                  json.dumps(params)))
+        return name
+
+    def remove_schedule(self, name):
+        #jobs the schedule already queued are kept
+        with self._lock, self._db:
+            return self._db.execute('DELETE FROM schedules WHERE name = ?', (name,)).rowcount > 0
+
+    def schedules(self):
+        with self._lock:
+            rows = self._db.execute('SELECT * FROM schedules ORDER BY name').fetchall()
+        return [dict(row, params=json.loads(row['params'])) for row in rows]
+
+    def enqueue(self, project_token, due_time=None, **params):
+        #queue one run of project_token, started once due_time (default now) has passed; returns the job id
+        logger.info('RunScheduler.enqueue(self, project_token="%s", due_time=%s, params="%s").', project_token, due_time, params)
+        with self._lock, self._db:
+            return self._insert_job(project_token, json.dumps(params), None, self._session.time() if due_time is None else due_time)
+
+    def _insert_job(self, project_token, params, schedule, due_time):
+        return self._db.execute("INSERT INTO jobs (project_token, params, schedule, due_time, state) VALUES (?, ?, ?, ?, 'queued')",
+                                (project_token, params, schedule, due_time)).lastrowid
+
+    def jobs(self, state=None, project_token=None):
+        #the jobs as dicts, oldest first; params and run_jdata are decoded
+        query, args = 'SELECT * FROM jobs WHERE 1', []
+        if state is not None:
+            query += ' AND state = ?'
+            args.append(state)
+        if project_token is not None:
+            query += ' AND project_token = ?'
+            args.append(project_token)
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY id', args).fetchall()
+        return [self._job(row) for row in rows]
+
+    def _job(self, row):
+        job = dict(row)
+        job['params'] = json.loads(job['params'])
+        job['run_jdata'] = json.loads(job['run_jdata']) if job['run_jdata'] else None
+        return job
+
+    def _set_job(self, job_id, **columns):
+        names = sorted(columns)
+        self._db.execute('UPDATE jobs SET %s WHERE id = ?' % ', '.join('%s = ?' % name for name in names),
+                         [columns[name] for name in names] + [job_id])
+        self._db.commit()
+
+    def _run(self, job):
+        return PhRun(self._api_key, job['run_token'], thin=job['run_jdata'] is None, jdata=job['run_jdata'], session=self._session)
+
+    def tick(self, now=None):
+        #one round of scheduling (see the class comment); now defaults to the session's clock
+        now = self._session.time() if now is None else now
+        logger.debug('RunScheduler.tick(self, now=%s).', now)
+        with self._lock:
+            self._queue_scheduled(now)
+            self._recover_starting(now)
+            self._update_running(now)
+            self._hand_off()
+            self._start_due(now)
+
+    def run_forever(self, interval=10):
+        #tick every interval seconds until stop() is called
+        logger.info('RunScheduler.run_forever(self, interval=%s).', interval)
+        self._stopped.clear()
+        while not self._stopped.is_set():
+            try:
+                self.tick()
+            except Exception:
+                logger.exception('RunScheduler.run_forever: Tick failed.')
+            self._stopped.wait(interval)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _queue_scheduled(self, now):
+        due = self._db.execute('SELECT * FROM schedules WHERE next_time <= ?', (now,)).fetchall()
+        for schedule in due:
+            pending = self._db.execute("SELECT COUNT(*) FROM jobs WHERE schedule = ? AND state IN ('queued', 'starting', 'running')",
+                                       (schedule['name'],)).fetchone()[0]
+            if pending:
+                logger.info('RunScheduler: Schedule "%s" skips its turn, its last run is still pending.', schedule['name'])
+            else:
+                self._insert_job(schedule['project_token'], schedule['params'], schedule['name'], now)
+            turns = int((now - schedule['next_time']) // schedule['interval']) + 1
+            self._db.execute('UPDATE schedules SET next_time = ? WHERE name = ?',
+                             (schedule['next_time'] + turns * schedule['interval'], schedule['name']))
+        self._db.commit()
+
+    def _recover_starting(self, now):
+        jobs = [self._job(row) for row in self._db.execute("SELECT * FROM jobs WHERE state = 'starting' ORDER BY id").fetchall()]
+        for job in jobs:
+            tracked = set(row[0] for row in self._db.execute('SELECT run_token FROM jobs WHERE run_token IS NOT NULL'))
+            proj = PhProject(self._api_key, job['project_token'], thin=True, session=self._session)
+            since = _utc_iso(job['started_at'] - 60) #allow for some clock skew
+            try:
+                untracked = [run for run in proj.iter_runs(since=since, prefetch=False)
+                             if run.run_token not in tracked and _started_by(job, run)]
+            except Exception as e:
+                logger.warning('RunScheduler: Could not list the runs of project "%s" (%s).', job['project_token'], e)
+                continue
+            if untracked:
+                run = min(untracked, key=lambda run: abs(_utc_seconds(run._jdata['start_time']) - job['started_at']))
+                logger.info('RunScheduler: Job %s adopts run "%s".', job['id'], run.run_token)
+                self._set_job(job['id'], state='running', run_token=run.run_token, run_jdata=json.dumps(run._jdata), polled_at=now)
+            elif job['attempts'] >= self.max_attempts:
+                logger.warning('RunScheduler: Job %s did not start a run, giving up.', job['id'])
+                self._set_job(job['id'], state='failed', error=job['error'] or 'No run was started.', finished_at=now)
+            else:
+                logger.info('RunScheduler: Job %s did not start a run, retrying in %ss.', job['id'], self.retry_delay)
+                self._set_job(job['id'], state='queued', due_time=now + self.retry_delay)
+
+    def _update_running(self, now):
+        webhook = self._session.webhook
+        interval = self.poll_interval if webhook is None else max(self.poll_interval, webhook.fallback_interval)
+        jobs = [self._job(row) for row in self._db.execute("SELECT * FROM jobs WHERE state = 'running' ORDER BY id").fetchall()]
+        for job in jobs:
+            run = self._run(job)
+            pushed = None
+            if webhook is not None:
+                seq, pushed = webhook.wait_for(job['run_token'], 0, self._notified.get(job['run_token'], 0))
+                self._notified[job['run_token']] = seq
+            if pushed is not None and webhook.secret is not None:
+                run.update(jdata=_pushed_jdata(run, pushed))
+            elif pushed is not None or job['polled_at'] is None or now - job['polled_at'] >= interval: #a notification without a secret is confirmed by a poll
+                try:
+                    run.update(jdata=run._fetch_jdata(run._get_poll_policy(max_429_retries=0), revalidate=True))
+                except Exception as e:
+                    logger.warning('RunScheduler: Could not update run "%s" (%s).', job['run_token'], e)
+                    continue
+                job['polled_at'] = now
+            else:
+                continue
+
+            if run._jdata.get('data_ready'):
+                state, error = 'ready', None
+            elif run._jdata.get('status') in TERMINAL_RUN_STATUSES:
+                state, error = 'failed', 'Run finished without data (status="%s").' % run._jdata['status']
+            else:
+                state, error = 'running', None
+            logger.debug('RunScheduler: Job %s, run "%s" is %s.', job['id'], job['run_token'], state)
+            if state != 'running':
+                self._notified.pop(job['run_token'], None)
+            self._set_job(job['id'], state=state, error=error, run_jdata=json.dumps(run._jdata), polled_at=job['polled_at'],
+                          finished_at=None if state == 'running' else now)
+
+    def _hand_off(self):
+        jobs = [self._job(row) for row in self._db.execute("SELECT * FROM jobs WHERE state = 'ready' ORDER BY id").fetchall()]
+        for job in jobs:
+            if self.on_complete is not None:
+                try:
+                    self.on_complete(self._run(job), job)
+                except Exception:
+                    logger.exception('RunScheduler: on_complete failed for job %s, retrying on the next tick.', job['id'])
+                    continue
+            self._set_job(job['id'], state='done')
+
+    def _start_due(self, now):
+        running = collections.Counter(row[0] for row in self._db.execute(
+            "SELECT project_token FROM jobs WHERE state IN ('starting', 'running')"))
+        queued = [self._job(row) for row in self._db.execute(
+            "SELECT * FROM jobs WHERE state = 'queued' AND due_time <= ? ORDER BY due_time, id", (now,)).fetchall()]
+        for job in queued:
+            if sum(running.values()) >= self.max_running:
+                break
+            if running[job['project_token']] >= self.project_limit:
+                continue
+            self._set_job(job['id'], state='starting', attempts=job['attempts'] + 1, started_at=now)
+            running[job['project_token']] += 1
+            proj = PhProject(self._api_key, job['project_token'], thin=True, session=self._session)
+            try:
+                run = proj.run(**job['params'])
+            except requests.HTTPError as e: #the run was not started
+                running[job['project_token']] -= 1
+                if job['attempts'] + 1 >= self.max_attempts:
+                    logger.warning('RunScheduler: Job %s failed to start (%s), giving up.', job['id'], e)
+                    self._set_job(job['id'], state='failed', error=str(e), finished_at=now)
+                else:
+                    logger.warning('RunScheduler: Job %s failed to start (%s), retrying in %ss.', job['id'], e, self.retry_delay)
+                    self._set_job(job['id'], state='queued', error=str(e), due_time=now + self.retry_delay)
+                continue
+            except Exception as e: #the run may have started anyway; see _recover_starting
+                logger.warning('RunScheduler: Job %s may not have started (%s).', job['id'], e)
+                self._set_job(job['id'], error=str(e))
+                continue
+            logger.info('RunScheduler: Job %s started run "%s".', job['id'], run.run_token)
+            self._set_job(job['id'], state='running', run_token=run.run_token, run_jdata=json.dumps(run._jdata), polled_at=now,
+                          error=None)
+
+### LOCAL PROJECT INDEX ###
+
+_INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS projects (
+    token TEXT PRIMARY KEY,
+    title TEXT,
+    jdata TEXT NOT NULL,
+    refreshed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS projects_title ON projects (title);
+CREATE TABLE IF NOT EXISTS runs (
+    run_token TEXT PRIMARY KEY,
+    project_token TEXT NOT NULL,
+    status TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    pages INTEGER,
+    data_ready INTEGER NOT NULL,
+    jdata TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_project ON runs (project_token, start_time);
+CREATE INDEX IF NOT EXISTS runs_status ON runs (status, start_time);
+CREATE INDEX IF NOT EXISTS runs_start_time ON runs (start_time);
+'''
+
+FINAL_RUN_STATUSES = ('complete',) + TERMINAL_RUN_STATUSES #a run in one of these never changes again
+
+#Local SQLite mirror of an account's projects and runs, for lookups that don't list the account every time
+#       index = ProjectIndex(API_KEY, 'parsehub.db')
+#       index.refresh()                                   #incremental, see below
+#       proj = index.project_by_title('TLP - Part 1')     #a PhProject, without a request
+#       runs = index.runs(status='error', since='2016-04-01T00:00:00')
+# - refresh() lists the projects (paged), then for each project reads its run history newest first, only
+#   down to the first run that was already indexed in a final status (see FINAL_RUN_STATUSES) and is older
+#   than every indexed unfinished run; a project whose last_run is indexed unchanged is skipped entirely
+# - projects that are no longer listed are dropped with their runs; deleted runs are only dropped by
+#   refresh(full=True), which re-reads every project's whole run history
+# - queries return PhProject/PhRun objects built from the indexed jdata (thin=True, jdata=..., as
+#   PhProject.iter_runs does), so they make no request until they are updated; projects get last_run and
+#   last_ready_run from the indexed runs
+# - the index is only as fresh as the last refresh; its methods may be called from any thread
+class ProjectIndex(object):
+    def __init__(self, api_key, path, session=None):
+        logger.info('ProjectIndex.__init__(self, api_key="%s", path="%s", session="%s").', api_key, path, session)
+        self._api_key = api_key
+        self.path = path
+        self._session = session if session is not None else PhSession.for_api_key(api_key)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(_INDEX_SCHEMA)
+
+    def __repr__(self):
+        return '<ProjectIndex(api_key="%s", path="%s")>' % (self._api_key, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM projects').fetchone()[0]
+
+    @property
+    def refreshed_at(self):
+        #session time of the last refresh, None before the first one
+        with self._lock:
+            return self._db.execute('SELECT MAX(refreshed_at) FROM projects').fetchone()[0]
+
+    def refresh(self, runs=True, full=False):
+        #mirror the account's projects and (with runs=True) their runs; returns how many runs were added or changed
+        logger.info('ProjectIndex.refresh(self, runs=%s, full=%s).', runs, full)
+        now = self._session.time()
+        acct = PhAccount(self._api_key, thin=True, session=self._session)
+        projects = [proj._jdata for proj in acct.list_all_projects()]
+        changed = 0
+        with self._lock:
+            listed = set()
+            for proj_jdata in projects:
+                listed.add(proj_jdata['token'])
+                proj_jdata = dict((k, v) for k, v in proj_jdata.items() if k != 'run_list')
+                self._db.execute('INSERT OR REPLACE INTO projects (token, title, jdata, refreshed_at) VALUES (?, ?, ?, ?)',
+                                 (proj_jdata['token'], proj_jdata.get('title'), json.dumps(proj_jdata), now))
+            for (token,) in self._db.execute('SELECT token FROM projects').fetchall():
+                if token not in listed:
+                    logger.debug('ProjectIndex.refresh: Project "%s" is gone.', token)
+                    self._db.execute('DELETE FROM projects WHERE token = ?', (token,))
+                    self._db.execute('DELETE FROM runs WHERE project_token = ?', (token,))
+            self._db.commit()
+
+            if runs:
+                for proj_jdata in projects:
+                    changed += self._refresh_runs(proj_jdata, full)
+        logger.debug('ProjectIndex.refresh: %s projects, %s runs added or changed.', len(projects), changed)
+        return changed
+
+    def _refresh_runs(self, proj_jdata, full):
+        token = proj_jdata['token']
+        indexed = dict((row['run_token'], row) for row in self._db.execute(
+            'SELECT run_token, status, start_time, jdata FROM runs WHERE project_token = ?', (token,)))
+        unfinished = [row['start_time'] or '' for row in indexed.values() if row['status'] not in FINAL_RUN_STATUSES]
+        oldest_unfinished = min(unfinished) if unfinished else None
+
+        last_run = proj_jdata.get('last_run')
+        if not full and last_run and oldest_unfinished is None:
+            row = indexed.get(last_run['run_token'])
+            if row is not None and row['status'] == last_run.get('status'):
+                return 0
+
+        def indexed_before(run_jdata):
+            #every run from here on is indexed and final
+            row = indexed.get(run_jdata['run_token'])
+            return (row is not None and row['status'] in FINAL_RUN_STATUSES and
+                    (oldest_unfinished is None or (run_jdata.get('start_time') or '') < oldest_unfinished))
+
+        proj = PhProject(self._api_key, token, thin=True, session=self._session)
+        seen = set()
+        changed = 0
+        for run in proj.iter_runs(until=None if full else indexed_before, prefetch=False):
+            run_jdata = run._jdata
+            seen.add(run_jdata['run_token'])
+            row = indexed.get(run_jdata['run_token'])
+            if row is not None and (row['status'] in FINAL_RUN_STATUSES or json.loads(row['jdata']) == run_jdata):
+                continue
+            self._db.execute('INSERT OR REPLACE INTO runs (run_token, project_token, status, start_time, end_time, pages, data_ready, jdata) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (run_jdata['run_token'], token, run_jdata.get('status'), run_jdata.get('start_time'),
+                              run_jdata.get('end_time'), run_jdata.get('pages'), bool(run_jdata.get('data_ready')),
+                              json.dumps(run_jdata)))
+            changed += 1
+        if full:
+            for run_token in set(indexed) - seen:
+                self._db.execute('DELETE FROM runs WHERE run_token = ?', (run_token,))
+        self._db.commit()
+        return changed
+
+    def _project(self, row):
+        jdata = json.loads(row['jdata'])
+        for field, query in (('last_run', 'SELECT jdata FROM runs WHERE project_token = ? ORDER BY start_time DESC LIMIT 1'),
+                             ('last_ready_run', 'SELECT jdata FROM runs WHERE project_token = ? AND data_ready ORDER BY start_time DESC LIMIT 1')):
+            run_row = self._db.execute(query, (row['token'],)).fetchone()
+            if run_row is not None:
+                jdata[field] = json.loads(run_row[0])
+        return PhProject(self._api_key, row['token'], thin=True, jdata=jdata, session=self._session)
+
+    def _run(self, row):
+        return PhRun(self._api_key, row['run_token'], thin=True, jdata=json.loads(row['jdata']), session=self._session)
+
+    def project(self, project_token):
+        #the indexed project with this token, or None
+        with self._lock:
+            row = self._db.execute('SELECT * FROM projects WHERE token = ?', (project_token,)).fetchone()
+            return None if row is None else self._project(row)
+
+    def project_by_title(self, title):
+        #the indexed project with this title (the first by token if several share it), or None
+        projects = self.projects(title=title)
+        return projects[0] if projects else None
+
+    def projects(self, title=None, title_like=None):
+        #the indexed projects ordered by title; title_like is an SQL LIKE pattern, e.g. 'TLP - %'
+        query, args = 'SELECT * FROM projects WHERE 1', []
+        if title is not None:
+            query += ' AND title = ?'
+            args.append(title)
+        if title_like is not None:
+            query += ' AND title LIKE ?'
+            args.append(title_like)
+        with self._lock:
+            return [self._project(row) for row in self._db.execute(query + ' ORDER BY title, token', args).fetchall()]
+
+    def run(self, run_token):
+        #the indexed run with this token, or None
+        with self._lock:
+            row = self._db.execute('SELECT run_token, jdata FROM runs WHERE run_token = ?', (run_token,)).fetchone()
+            return None if row is None else self._run(row)
+
+    def runs(self, project_token=None, status=None, since=None, until=None, data_ready=None, limit=None):
+        #the indexed runs, newest first
+        # - status: a status or tuple of statuses
+        # - since/until: ISO timestamps (e.g. '2016-04-11T00:00:00'), runs started at or after since and before until
+        query, args = 'SELECT run_token, jdata FROM runs WHERE 1', []
+        if project_token is not None:
+            query += ' AND project_token = ?'
+            args.append(project_token)
+        if status is not None:
+            statuses = status if isinstance(status, (list, tuple, set)) else (status,)
+            query += ' AND status IN (%s)' % ', '.join('?' * len(statuses))
+            args.extend(statuses)
+        if since is not None:
+            query += ' AND start_time >= ?'
+            args.append(since)
+        if until is not None:
+            query += ' AND start_time < ?'
+            args.append(until)
+        if data_ready is not None:
+            query += ' AND data_ready = ?'
+            args.append(bool(data_ready))
+        query += ' ORDER BY start_time DESC, run_token'
+        if limit is not None:
+            query += ' LIMIT ?'
+            args.append(limit)
+        with self._lock:
+            return [self._run(row) for row in self._db.execute(query, args).fetchall()]
+
+    def last_ready_run(self, project_token):
+        #the project's newest indexed run with data_ready, or None
+        runs = self.runs(project_token, data_ready=True, limit=1)
+        return runs[0] if runs else None
+
+### RUN-TO-RUN DIFF ###
+
+DiffEntry = collections.namedtuple('DiffEntry', ['op', 'key', 'record'])
+
+try:
+    _DIGEST_TYPECODE = str('Q')
+    array.array(_DIGEST_TYPECODE)
+except ValueError: #Python 2 arrays have no 'Q', 'L' is 8 bytes on most 64-bit platforms
+    _DIGEST_TYPECODE = str('L')
+_DIGEST_SIZE = array.array(_DIGEST_TYPECODE).itemsize
+
+def _digest(value):
+    #_DIGEST_SIZE-byte digest of a JSON value, the same for equal values whatever their dict key order
+    text = json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:2 * _DIGEST_SIZE], 16)
+
+def _record_key(key):
+    #key(record) for a field name, a tuple of field names or a callable; None keys records by their whole content
+    if key is None or callable(key):
+        return key
+    if isinstance(key, (list, tuple)):
+        fields = tuple(key)
+        return lambda record: tuple(record.get(field) for field in fields)
+    return lambda record: record.get(key)
+
+def _record_source(source, base_list=None):
+    #a callable returning a fresh iterator over the records of a PhRun, a run data file or a list of records
+    # - files are read as the run data format named by their extension (.json, .csv.gz, ...), JSON otherwise
+    if isinstance(source, PhRun):
+        return lambda: source.iter_records(base_list)
+    if callable(source):
+        return source
+    if isinstance(source, (_text_type, str)):
+        name = source[:-3] if source.endswith('.gz') else source
+        ext = os.path.splitext(name)[1][1:].lower()
+        output_format = ext if ext in RUN_DATA_FORMATS else 'json'
+        return lambda: iter_run_data_records(read_chunks(source), output_format, base_list)
+    return lambda: iter(source)
+
+def _spooled_records(run, base_list, path):
+    #the records of a run's JSON data as it downloads, also written (gzip-compressed) to path for a later pass
+    def chunks():
+        with open(path, 'wb') as f:
+            for chunk in run.iter_data(compressed=True, format='json'):
+                f.write(chunk)
+                yield chunk
+    return iter_json_records(gunzip_chunks(chunks()), base_list)
+
+class RecordIndex(object):
+    #Compact index of a dataset: per record, a digest of its key and one of its whole content
+    # - stored in three flat arrays sorted by key digest (24 bytes per record on 64-bit), never as Python objects
+    # - match() and claim() pair the records of another dataset with these, each indexed record at most once,
+    #   so records that share a key are compared as a multiset
+    __slots__ = ('_key_digests', '_digests', '_ordinals', '_matched')
+
+    def __init__(self, records, key=None):
+        key = _record_key(key)
+        key_digests = array.array(_DIGEST_TYPECODE)
+        digests = array.array(_DIGEST_TYPECODE)
+        for record in records:
+            digest = _digest(record)
+            digests.append(digest)
+            key_digests.append(digest if key is None else _digest(key(record)))
+
+        order = sorted(range(len(digests)), key=key_digests.__getitem__)
+        self._key_digests = array.array(_DIGEST_TYPECODE, (key_digests[i] for i in order))
+        self._digests = array.array(_DIGEST_TYPECODE, (digests[i] for i in order))
+        self._ordinals = array.array(_DIGEST_TYPECODE, order)
+        self._matched = bytearray(len(order)) #by ordinal, the position of the record in the indexed dataset
+
+    def __len__(self):
+        return len(self._digests)
+
+    def _unmatched(self, key_digest):
+        lo = bisect.bisect_left(self._key_digests, key_digest)
+        hi = bisect.bisect_right(self._key_digests, key_digest, lo)
+        return [i for i in range(lo, hi) if not self._matched[self._ordinals[i]]]
+
+    def match(self, key_digest, digest):
+        #for a record of the other dataset: 'unchanged' (claiming the indexed record with its content), 'added'
+        #(no unclaimed record has its key) or 'pending' (it may be 'changed'; see claim)
+        unmatched = self._unmatched(key_digest)
+        for i in unmatched:
+            if self._digests[i] == digest:
+                self._matched[self._ordinals[i]] = 1
+                return 'unchanged'
+        return 'pending' if unmatched else 'added'
+
+    def claim(self, key_digest):
+        #claim an unclaimed record with this key for a 'pending' record, once every record of the other
+        #dataset has been matched (so identical records pair up first whatever their order); False if none is left
+        unmatched = self._unmatched(key_digest)
+        if unmatched:
+            self._matched[self._ordinals[unmatched[0]]] = 1
+        return bool(unmatched)
+
+    def unmatched(self, ordinal):
+        return not self._matched[ordinal]
+
+def diff_runs(old, new, key=None, base_list=None, removed=True):
+    #Yields a DiffEntry(op, key, record) for every record that differs between two datasets
+    # - old/new: a PhRun, a run data file path (e.g. a snapshot written by PhRun.save_data), a list of
+    #   records, or a callable returning an iterator over records
+    # - key: the field (or tuple of fields, or callable) identifying a record; a record of new whose key
+    #   is in old with other content is 'changed', otherwise it is 'added'. None compares whole records,
+    #   so a changed record shows up as 'removed' and 'added'
+    # - only old is indexed (see RecordIndex); new is streamed once, yielding 'added' entries with the new
+    #   record as it goes and holding records whose key is in old with other content until the end, when they
+    #   are yielded as 'changed' (or 'added', once records sharing their key have all been paired up)
+    # - then old is streamed a second time for the 'removed' entries (old records); removed=False skips it.
+    #   A PhRun is downloaded only once: the second pass reads it from the session's dataset_cache, or else
+    #   from a temporary gzip copy spooled while it was indexed
+    logger.info('diff_runs(old="%s", new="%s", key="%s", base_list="%s", removed=%s).', old, new, key, base_list, removed)
+    old_records = _record_source(old, base_list)
+    key_func = _record_key(key)
+    spool = None
+    if removed and isinstance(old, PhRun) and old._session.dataset_cache is None:
+        fd, spool = tempfile.mkstemp(prefix='pyphlite-diff-', suffix='.json.gz')
+        os.close(fd)
+    try:
+        index = RecordIndex(old_records() if spool is None else _spooled_records(old, base_list, spool), key)
+        logger.debug('diff_runs: Indexed %s records.', len(index))
+
+        pending = []
+        for record in _record_source(new, base_list)():
+            digest = _digest(record)
+            key_digest = digest if key_func is None else _digest(key_func(record))
+            op = index.match(key_digest, digest)
+            if op == 'pending':
+                pending.append((key_digest, record))
+            elif op == 'added':
+                yield DiffEntry(op, None if key_func is None else key_func(record), record)
+        for key_digest, record in pending:
+            yield DiffEntry('changed' if index.claim(key_digest) else 'added', key_func(record), record)
+
+        if removed:
+            records = old_records() if spool is None else iter_json_records(read_chunks(spool), base_list)
+            for ordinal, record in enumerate(records):
+                if ordinal >= len(index):
+                    raise Exception('The old dataset changed while it was being compared.')
+                if index.unmatched(ordinal):
+                    yield DiffEntry('removed', None if key_func is None else key_func(record), record)
+    finally:
+        if spool is not None:
+            os.remove(spool)
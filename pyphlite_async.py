@@ -0,0 +1,490 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+
+import aiohttp
+
+from pyphlite import (API_BASE_URL, TERMINAL_RUN_STATUSES, PhBase, PollPolicy,
+                      LazyDictExcept, ProjectFields, RunFields, _pushed_jdata, notify, request_event, throttle_wait)
+
+# Asyncio counterparts of PhAccount/PhProject/PhRun (Python 3 only, requires aiohttp)
+# - Same thin/fat semantics as PhBase; constructing a fat object is done by awaiting it:
+#       proj = PhProject(API_KEY, token)              ->  proj = await AsyncPhProject(API_KEY, token)
+#       data = proj.run().get_data(format='csv')      ->  data = await (await proj.run()).get_data(format='csv')
+# - Waiting for a run uses asyncio.sleep, so one event loop can drive many runs at once
+
+logger = logging.getLogger('pyphlite')
+
+#Pooled aiohttp session shared by every async object of one API key
+# - the underlying aiohttp.ClientSession is bound to an event loop, so it is (re)created
+#   lazily for whichever loop is running when a request is made, closing the previous loop's one
+# - rate_limits works as in PhSession (the same RateLimiter objects may be shared with sync sessions)
+# - instruments works as in PhSession, except that there is no after_parse (bodies are decoded by the
+#   caller) and connect is not measured
+# - webhook works as in PhSession; the receiver's thread wakes waiting runs on their event loop
+class AsyncPhSession(object):
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, api_key=None, base_url=API_BASE_URL, limit=100, limit_per_host=16,
+                 keepalive_timeout=15, headers=None, rate_limits=None, instruments=None, webhook=None):
+        logger.debug('AsyncPhSession.__init__(self, api_key="%s", base_url="%s", limit=%s, limit_per_host=%s, '
+                     'keepalive_timeout=%s, rate_limits="%s", instruments="%s", webhook="%s").',
+                     api_key, base_url, limit, limit_per_host, keepalive_timeout, rate_limits, instruments, webhook)
+        self._api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.rate_limits = dict(rate_limits or {})
+        self.instruments = list(instruments or [])
+        self.webhook = webhook
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._keepalive_timeout = keepalive_timeout
+        self._headers = headers
+        self._http = None
+        self._loop = None
+
+    def __repr__(self):
+        return '<AsyncPhSession(api_key="%s", base_url="%s")>' % (self._api_key, self.base_url)
+
+    @classmethod
+    def for_api_key(cls, api_key, **kwargs): #kwargs only apply when the session is first created
+        with cls._registry_lock:
+            session = cls._registry.get(api_key)
+            if session is None:
+                session = cls(api_key, **kwargs)
+                cls._registry[api_key] = session
+            return session
+
+    async def _client(self):
+        loop = asyncio.get_running_loop()
+        if self._http is not None and not self._http.closed and self._loop is not loop:
+            await self._http.close()
+        if self._http is None or self._http.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+                keepalive_timeout=self._keepalive_timeout
+            )
+            self._http = aiohttp.ClientSession(connector=connector, headers=self._headers)
+            self._loop = loop
+        return self._http
+
+    async def request(self, method, path, raise_for_status=True, retries=0, **kwargs):
+        #returns (response, body) after the body has been read and the connection released
+        event = None
+        if self.instruments:
+            event = request_event(method, path, retries)
+            notify(self.instruments, 'before_request', event)
+        start = time.time()
+        try:
+            wait = throttle_wait(self.rate_limits, method, path)
+            if wait > 0:
+                logger.debug('AsyncPhSession.request: Throttling %s %s for %ss...', method, path, wait)
+                await asyncio.sleep(wait)
+            sent = time.time()
+            http = await self._client()
+            async with http.request(method, self.base_url + path, **kwargs) as resp:
+                if event is not None:
+                    event['throttle'] = wait
+                    event['ttfb'] = time.time() - sent
+                    event['status_code'] = resp.status
+                body = await resp.read()
+                if event is not None:
+                    event['bytes'] = len(body)
+                if raise_for_status:
+                    resp.raise_for_status()
+                return resp, body
+        except Exception as e:
+            if event is not None:
+                event['error'] = e
+            raise
+        finally:
+            if event is not None:
+                event['total'] = time.time() - start
+                notify(self.instruments, 'after_request', event)
+
+    async def get(self, path, **kwargs):
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request('POST', path, **kwargs)
+
+    async def delete(self, path, **kwargs):
+        return await self.request('DELETE', path, **kwargs)
+
+    async def close(self):
+        logger.debug('AsyncPhSession.close(self).')
+        if self._http is not None and not self._http.closed:
+            await self._http.close()
+        with AsyncPhSession._registry_lock:
+            if AsyncPhSession._registry.get(self._api_key) is self:
+                del AsyncPhSession._registry[self._api_key]
+
+def _json_body(body):
+    return json.loads(body.decode('utf-8'))
+
+def _timeout(req_params):
+    #translate requests-style (connect, read) timeout tuples into an aiohttp.ClientTimeout
+    timeout = req_params.get('timeout')
+    if isinstance(timeout, tuple):
+        req_params = dict(req_params)
+        req_params['timeout'] = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+    elif isinstance(timeout, (int, float)):
+        req_params = dict(req_params)
+        req_params['timeout'] = aiohttp.ClientTimeout(total=timeout)
+    return req_params
+
+async def wait_for_webhook(webhook, run_token, timeout=0, after=0):
+    #WebhookReceiver.wait_for without blocking the event loop
+    seq, jdata = webhook.wait_for(run_token, 0, after)
+    if jdata is not None or timeout <= 0:
+        return seq, jdata
+    loop = asyncio.get_running_loop()
+    notified = asyncio.Event()
+    def wake(jdata):
+        if jdata['run_token'] == run_token:
+            loop.call_soon_threadsafe(notified.set)
+    webhook.callbacks.append(wake)
+    try:
+        seq, jdata = webhook.wait_for(run_token, 0, after) #notified between the first check and the callback
+        if jdata is None:
+            try:
+                await asyncio.wait_for(notified.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            seq, jdata = webhook.wait_for(run_token, 0, after)
+        return seq, jdata
+    finally:
+        webhook.callbacks.remove(wake)
+
+#Reuses PhBase's thin-object attribute lookup; update() is a coroutine, so construction never
+#performs I/O -- awaiting the object runs the initial update() when it is not thin
+class AsyncPhBase(PhBase):
+    __slots__ = ('_loaded',)
+
+    def __init__(self, api_key, thin=False, jdata=None, req_params=None, session=None, **kwargs):
+        logger.debug('AsyncPhBase.__init__(self, api_key="%s", thin="%s", initial_jdata="%s", req_params="%s", session="%s", kwargs="%s").',
+                     api_key, thin, ('' if jdata is None else '...'), req_params, session, LazyDictExcept(kwargs, 'jdata'))
+        self._api_key = api_key
+        self._session = session if session is not None else AsyncPhSession.for_api_key(api_key)
+        self._thin = thin
+        self._params = kwargs
+        self._req_params = req_params
+        self._loaded = jdata is not None
+
+        if jdata is not None:
+            self._load(jdata)
+
+    def __await__(self):
+        return self._hydrate().__await__()
+
+    async def _hydrate(self):
+        if not self._thin and not self._loaded:
+            await self.update()
+        return self
+
+    def _load(self, jdata):
+        self._jdata = jdata
+        self._thin = False
+        self._loaded = True
+
+    async def update(self, jdata=None):
+        raise NotImplementedError
+
+class AsyncPhAccount(AsyncPhBase):
+    __slots__ = ('projects',)
+
+    def __init__(self, api_key, **kwargs):
+        logger.info('AsyncPhAccount.__init__(self, api_key="%s", kwargs="%s").',
+                    api_key, LazyDictExcept(kwargs, 'jdata'))
+        super(AsyncPhAccount, self).__init__(api_key, **kwargs)
+
+    def __repr__(self):
+        return '<AsyncPhAccount(api_key="%s")>' % self._api_key
+
+    async def update(self, jdata=None):
+        logger.debug('AsyncPhAccount.update(self, jdata="%s").', '...')
+        await self.list_all_projects(jdata=jdata, **(self._params))
+        return self
+
+    def _load(self, jdata):
+        super(AsyncPhAccount, self)._load(jdata)
+        self.projects = [
+            AsyncPhProject(self._api_key, proj_jdata['token'], thin=True, jdata=proj_jdata, session=self._session)
+            for proj_jdata in jdata['projects']
+        ]
+
+    ### DIRECT API FUNCTIONS ###
+
+    #Account-Level Functions
+    async def list_all_projects(self, jdata=None, req_params=None, **params):
+        logger.info('AsyncPhAccount.list_all_projects(self, jdata="%s", req_params="%s", params="%s").',
+                    ('' if jdata is None else '...'), req_params, params)
+        if jdata is None:
+            params['api_key'] = self._api_key
+            req_params = _timeout(self._get_req_params(req_params))
+            resp, body = await self._session.get(
+                '/projects', #list all projects
+                params=params,
+                **(req_params)
+            )
+            jdata = _json_body(body)
+
+        self._load(jdata)
+        return self.projects
+
+    #Project-Level Functions
+    async def get_a_project(self, project_token, **kwargs):
+        kwargs.setdefault('session', self._session)
+        return await AsyncPhProject(self._api_key, project_token, **kwargs)
+
+    async def run_a_project(self, project_token, **kwargs):
+        return await AsyncPhProject(self._api_key, project_token, thin=True, session=self._session).run(**kwargs)
+
+    async def get_last_ready_data(self, project_token, **kwargs):
+        return await AsyncPhProject(self._api_key, project_token, thin=True, session=self._session).get_last_ready_data(**kwargs)
+
+    #Run-Level Functions
+    async def get_a_run(self, run_token, **kwargs):
+        kwargs.setdefault('session', self._session)
+        return await AsyncPhRun(self._api_key, run_token, **kwargs)
+
+    async def get_data_for_a_run(self, run_token, **kwargs):
+        return await AsyncPhRun(self._api_key, run_token, thin=True, session=self._session).get_data(**kwargs)
+
+    async def cancel_a_run(self, run_token, **kwargs):
+        return await AsyncPhRun(self._api_key, run_token, thin=True, session=self._session).cancel(**kwargs)
+
+    async def delete_a_run(self, run_token, **kwargs):
+        return await AsyncPhRun(self._api_key, run_token, thin=True, session=self._session).delete(**kwargs)
+
+class AsyncPhProject(AsyncPhBase, ProjectFields):
+    __slots__ = ('_project_token', 'last_run', 'last_ready_run', 'run_list')
+
+    def __init__(self, api_key, project_token, **kwargs):
+        logger.info('AsyncPhProject.__init__(self, api_key="%s", project_token="%s", kwargs="%s").',
+                    api_key, project_token, LazyDictExcept(kwargs, 'jdata'))
+        self._project_token = project_token
+        super(AsyncPhProject, self).__init__(api_key, **kwargs)
+
+    def __repr__(self):
+        return '<AsyncPhProject(api_key="%s", project_token="%s")>' % (self._api_key, self._project_token)
+
+    async def update(self, jdata=None):
+        logger.info('AsyncPhProject.update(self, jdata="%s").', ('' if jdata is None else '...'))
+        if jdata is None:
+            params = self._params
+            params['api_key'] = self._api_key
+            req_params = _timeout(self._get_req_params())
+            resp, body = await self._session.get(
+                '/projects/%s' % #get a project
+                self._project_token,
+                params=params,
+                **(req_params)
+            )
+            jdata = _json_body(body)
+
+        self._load(jdata)
+        return self
+
+    def _load(self, jdata):
+        super(AsyncPhProject, self)._load(jdata)
+
+        lr_jdata = jdata.get('last_run')
+        if lr_jdata:
+            self.last_run = AsyncPhRun(self._api_key, lr_jdata['run_token'], thin=True, jdata=lr_jdata, session=self._session)
+
+        lrr_jdata = jdata.get('last_ready_run')
+        if lrr_jdata:
+            self.last_ready_run = AsyncPhRun(self._api_key, lrr_jdata['run_token'], thin=True, jdata=lrr_jdata, session=self._session)
+
+        if 'run_list' in jdata:
+            self.run_list = [
+                AsyncPhRun(self._api_key, run_jdata['run_token'], thin=True, jdata=run_jdata, session=self._session)
+                for run_jdata in jdata['run_list']
+            ]
+
+    async def run(self, req_params=None, **kwargs):
+        logger.info('AsyncPhProject.run(self, req_params="%s", kwargs="%s").',
+                    req_params, LazyDictExcept(kwargs, 'jdata'))
+        params = kwargs
+        params['api_key'] = self._api_key
+        req_params = _timeout(self._get_req_params(req_params))
+        resp, body = await self._session.post(
+            '/projects/%s/run' % #run a project
+            self._project_token,
+            params=params,
+            **(req_params)
+        )
+        req_jdata = _json_body(body)
+        return AsyncPhRun(self._api_key, req_jdata['run_token'], thin=True, jdata=req_jdata, session=self._session)
+
+    async def get_last_ready_data(self, req_params=None, **kwargs):
+        logger.info('AsyncPhProject.get_last_ready_data(self, req_params="%s", kwargs="%s").',
+                    req_params, LazyDictExcept(kwargs, 'jdata'))
+        params = kwargs
+        params['api_key'] = self._api_key
+        req_params = _timeout(self._get_req_params(req_params))
+        resp, body = await self._session.get(
+            '/projects/%s/last_ready_run/data' % #get data for the last ready run
+            self._project_token,
+            params=params,
+            **(req_params)
+        )
+        return body.decode('utf-8')
+
+class AsyncPhRun(AsyncPhBase, RunFields):
+    __slots__ = ('_run_token', '_poll_policy', '_update_count', '_last_update_time')
+
+    def __init__(self, api_key, run_token, poll_policy=None, **kwargs):
+        logger.info('AsyncPhRun.__init__(self, api_key="%s", run_token="%s", poll_policy="%s", kwargs="%s").',
+                    api_key, run_token, poll_policy, LazyDictExcept(kwargs, 'jdata'))
+        self._run_token = run_token
+        self._poll_policy = poll_policy
+        self._update_count = 0
+        self._last_update_time = None
+        super(AsyncPhRun, self).__init__(api_key, **kwargs)
+
+    def __repr__(self):
+        return '<AsyncPhRun(api_key="%s", run_token="%s")>' % (self._api_key, self._run_token)
+
+    async def update(self, jdata=None, poll_policy=None):
+        logger.info('AsyncPhRun.update(self, jdata="%s", poll_policy="%s").', ('' if jdata is None else '...'), poll_policy)
+        if jdata is None:
+            jdata = await self._fetch_jdata(self._get_poll_policy(poll_policy, max_429_retries=0))
+
+        self._load(jdata)
+        return self
+
+    def _get_poll_policy(self, poll_policy=None, wait_increment=5, wait_timeout=None, max_429_retries=3):
+        #see PhRun._get_poll_policy
+        if poll_policy is not None:
+            return poll_policy
+        elif self._poll_policy is not None:
+            return self._poll_policy
+        else:
+            return PollPolicy(interval=wait_increment, timeout=wait_timeout, max_429_retries=max_429_retries)
+
+    async def _fetch_jdata(self, poll_policy, deadline=None):
+        params = self._params
+        params['api_key'] = self._api_key
+        req_params = _timeout(self._get_req_params())
+
+        retries = 0
+        while True:
+            resp, body = await self._session.get(
+                '/runs/%s' % #get a run
+                self._run_token,
+                params=params,
+                raise_for_status=False,
+                retries=retries,
+                **(req_params)
+            )
+            self._update_count += 1
+            self._last_update_time = time.time()
+            if resp.status != 429:
+                break
+
+            retry_wait = poll_policy.retry_after(resp, retries)
+            if retry_wait is None or (deadline is not None and time.time() + retry_wait > deadline):
+                logger.warning('AsyncPhRun.update: Run update limit has been hit for run "%s" -- ParseHub allows %s updates per run, then one every %ss.',
+                               self._run_token, poll_policy.free_updates, poll_policy.limited_interval)
+                break
+            logger.info('AsyncPhRun._fetch_jdata: Rate limited (HTTP 429), retrying in %ss...', retry_wait)
+            await asyncio.sleep(retry_wait)
+            retries += 1
+
+        resp.raise_for_status()
+        return _json_body(body)
+
+    async def wait_until_ready(self, wait_increment=5, wait_timeout=None, poll_policy=None):
+        poll_policy = self._get_poll_policy(poll_policy, wait_increment, wait_timeout)
+        logger.info('AsyncPhRun.wait_until_ready(self, poll_policy="%s").', poll_policy)
+
+        start_time = time.time()
+        deadline = poll_policy.deadline(start_time)
+        webhook = self._session.webhook
+        seq, pushed = webhook.wait_for(self._run_token) if webhook is not None else (0, None)
+        if pushed is not None and webhook.secret is not None:
+            self._load(_pushed_jdata(self, pushed))
+        else: #no notification yet, or one that may be forged
+            self._load(await self._fetch_jdata(poll_policy, deadline))
+
+        attempt = 0
+        while not self._jdata.get('data_ready'):
+            if self._jdata.get('status') in TERMINAL_RUN_STATUSES:
+                raise Exception('Run "%s" finished without data (status="%s").' % (self._run_token, self._jdata['status']))
+
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                raise Exception('Timed out waiting for data after %ss.' % (now - start_time))
+
+            delay = poll_policy.next_delay(attempt, self._update_count, self._last_update_time)
+            if webhook is not None:
+                delay = max(delay, webhook.fallback_interval)
+            if deadline is not None:
+                delay = min(delay, deadline - now)
+            logger.info('AsyncPhRun.wait_until_ready: Data not ready, waiting %ss (aggregate: %ss)...',
+                        delay, now - start_time)
+            if webhook is not None:
+                seq, pushed = await wait_for_webhook(webhook, self._run_token, delay, seq)
+                if pushed is not None:
+                    self._load(_pushed_jdata(self, pushed) if webhook.secret is not None else await self._fetch_jdata(poll_policy, deadline))
+                    continue
+            else:
+                await asyncio.sleep(delay)
+            attempt += 1
+            self._load(await self._fetch_jdata(poll_policy, deadline))
+        return self
+
+    async def get_data(self, req_params=None, blocking=True, wait_increment=5, wait_timeout=None, connect_timeout=3, download_timeout=600, poll_policy=None, **kwargs):
+        logger.info('AsyncPhRun.get_data(self, req_params="%s", blocking="%s", wait_increment=%ss, ', req_params, blocking, wait_increment)
+        logger.info('\twait_timeout=%ss, connect_timeout=%ss, download_timeout=%ss, ', wait_timeout, connect_timeout, download_timeout)
+        logger.info('\tpoll_policy="%s", kwargs="%s").', poll_policy, LazyDictExcept(kwargs, 'jdata'))
+
+        params = kwargs
+        params['api_key'] = self._api_key
+        req_params = _timeout(self._get_req_params(req_params, {'timeout': (connect_timeout, download_timeout)}))
+
+        if blocking:
+            await self.wait_until_ready(wait_increment, wait_timeout, poll_policy)
+        else:
+            await self.update(poll_policy=poll_policy)
+            if not self.data_ready:
+                raise Exception('Data not ready (non-blocking call).')
+
+        resp, body = await self._session.get(
+            '/runs/%s/data' % #get data for a run
+            self._run_token,
+            params=params,
+            **(req_params)
+        )
+        return body.decode('utf-8')
+
+    async def cancel(self, req_params=None, **kwargs):
+        logger.info('AsyncPhRun.cancel(self, req_params="%s", kwargs="%s").', req_params, LazyDictExcept(kwargs, 'jdata'))
+        params = kwargs
+        params['api_key'] = self._api_key
+        req_params = _timeout(self._get_req_params(req_params))
+        resp, body = await self._session.post(
+            '/runs/%s/cancel' % #cancel a run
+            self._run_token,
+            params=params,
+            **(req_params)
+        )
+        return _json_body(body)
+
+    async def delete(self, req_params=None, **kwargs):
+        logger.info('AsyncPhRun.delete(self, req_params="%s", kwargs="%s").', req_params, LazyDictExcept(kwargs, 'jdata'))
+        params = kwargs
+        params['api_key'] = self._api_key
+        req_params = _timeout(self._get_req_params(req_params))
+        resp, body = await self._session.delete(
+            '/runs/%s' % #delete a run
+            self._run_token,
+            params=params,
+            **(req_params)
+        )
+        return _json_body(body)
@@ -0,0 +1,136 @@
+import asyncio
+import threading
+import time
+import unittest
+
+import requests
+
+from pyphlite import MetricsCollector, PollPolicy, WebhookReceiver
+from pyphlite_async import AsyncPhAccount, AsyncPhProject, AsyncPhRun, AsyncPhSession
+from pyphlite_standin import ParseHubStandIn
+
+API_KEY = '<OFFLINE API KEY>' #only ever sent to the local test server
+
+class TestAsyncClient(unittest.TestCase):
+    def setUp(self):
+        self.hub = ParseHubStandIn(projects=1, runs_per_project=1, rows=10).start()
+        self.session = AsyncPhSession(API_KEY, base_url=self.hub.base_url)
+
+    def tearDown(self):
+        self.hub.stop()
+
+    def started_run(self, **options):
+        #a thin AsyncPhRun for a new run of tProject0, options as for ParseHubStandIn.add_run
+        jdata = self.hub.add_run('tProject0', **options)
+        return AsyncPhRun(API_KEY, jdata['run_token'], thin=True, session=self.session)
+
+    def run_async(self, coro):
+        async def wrapped():
+            try:
+                return await coro
+            finally:
+                await self.session.close()
+        return asyncio.run(wrapped())
+
+    def test_thin_and_fat(self):
+        proj = AsyncPhProject(API_KEY, 'tProject0', thin=True, session=self.session)
+        with self.assertRaises(AttributeError):
+            object.__getattribute__(proj, 'run_list')
+        with self.assertRaisesRegex(Warning, 'Attempted to access.*'):
+            proj.title
+
+        proj = self.run_async(AsyncPhProject(API_KEY, 'tProject0', session=self.session))
+        self.assertEqual(proj.title, 'Project 0')
+        self.assertIsInstance(proj.run_list[0], AsyncPhRun)
+        self.assertIs(proj.run_list[0]._session, self.session)
+
+    def test_account_projects(self):
+        acct = self.run_async(AsyncPhAccount(API_KEY, session=self.session))
+        self.assertEqual([p.token for p in acct.projects], ['tProject0'])
+
+    def test_event_loop_change(self):
+        async def project():
+            return await AsyncPhProject(API_KEY, 'tProject0', session=self.session)
+
+        asyncio.run(project())
+        first = self.session._http
+        self.assertEqual(self.run_async(project()).title, 'Project 0')
+        self.assertTrue(first.closed) #the previous loop's session is closed, not leaked
+        self.assertIsNot(self.session._http, first)
+
+    def test_run_and_wait_for_data(self):
+        async def scenario():
+            proj = AsyncPhProject(API_KEY, 'tProject0', thin=True, session=self.session)
+            run = await proj.run()
+            data = await run.get_data(wait_increment=0.01, wait_timeout=5)
+            return run, data
+
+        run, data = self.run_async(scenario())
+        self.assertTrue(run.data_ready)
+        self.assertEqual(data, self.hub.datasets['json'].decode('utf-8'))
+
+    def test_concurrent_runs(self):
+        async def scenario():
+            runs = [self.started_run(polls_until_ready=i % 3) for i in range(10)]
+            return await asyncio.gather(*[r.wait_until_ready(wait_increment=0.01, wait_timeout=5) for r in runs])
+
+        self.assertTrue(all(r.data_ready for r in self.run_async(scenario())))
+
+    def test_poll_policy_and_429(self):
+        async def scenario():
+            jdata = self.hub.add_run('tProject0', limited_polls=2, polls_until_ready=0)
+            run = AsyncPhRun(API_KEY, jdata['run_token'], thin=True, session=self.session,
+                             poll_policy=PollPolicy(interval=0.01, backoff=2, timeout=5))
+            return await run.wait_until_ready()
+
+        run = self.run_async(scenario())
+        self.assertTrue(run.data_ready)
+        self.assertEqual(run._update_count, 3)
+
+    def test_webhook(self):
+        async def scenario(receiver):
+            self.session.webhook = receiver
+            run = AsyncPhRun(API_KEY, run_token, thin=True, session=self.session)
+            notify = threading.Timer(0.2, requests.post, [receiver.url], {'data': {'run_token': run_token, 'status': 'complete', 'data_ready': 'true'}})
+            notify.start()
+            start = time.time()
+            await run.wait_until_ready(wait_increment=0.01)
+            return run, time.time() - start
+
+        run_token = self.hub.add_run('tProject0', polls_until_ready=1000)['run_token'] #never ready by polling
+        with WebhookReceiver(secret='s3cret', fallback_interval=60) as receiver:
+            run, elapsed = self.run_async(scenario(receiver))
+        self.assertTrue(run.data_ready)
+        self.assertEqual(run.project_token, 'tProject0') #kept from the poll, not in the notification
+        self.assertEqual(self.hub.requests.count(('GET', '/runs/%s' % run_token)), 1)
+        self.assertTrue(elapsed < 5)
+
+    def test_non_blocking_not_ready(self):
+        run = self.started_run()
+        with self.assertRaisesRegex(Exception, 'Data not ready.*'):
+            self.run_async(run.get_data(blocking=False))
+
+    def test_cancel_and_delete(self):
+        run_token = self.hub.add_run('tProject0')['run_token']
+        run = AsyncPhRun(API_KEY, run_token, thin=True, session=self.session)
+        self.assertEqual(self.run_async(run.cancel())['status'], 'cancelled')
+        self.assertEqual(self.run_async(run.delete())['run_token'], run_token)
+
+    def test_instruments(self):
+        events = []
+        class Recorder(object):
+            def after_request(self, event):
+                events.append(dict(event))
+        metrics = MetricsCollector()
+        self.session.instruments = [Recorder(), metrics]
+
+        run_token = self.hub.add_run('tProject0', limited_polls=2, polls_until_ready=0)['run_token']
+        run = AsyncPhRun(API_KEY, run_token, thin=True, session=self.session, poll_policy=PollPolicy(interval=0.01))
+        self.run_async(run.wait_until_ready())
+        self.assertEqual([(e['status_code'], e['retries'], e['run_token']) for e in events],
+                         [(429, 0, run_token), (429, 1, run_token), (200, 2, run_token)])
+        self.assertTrue(all(0 < e['ttfb'] <= e['total'] for e in events))
+        self.assertIn('pyphlite_requests_total{endpoint="GET /runs/{run_token}",status="429"} 2\n', metrics.prometheus_text())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,252 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import logging
+import sys
+import time
+import timeit
+
+try:
+    import tracemalloc
+except ImportError: #Py2
+    tracemalloc = None
+
+from pyphlite import PhAccount, PhProject, PhRun, PhSession, PollPolicy, wait_for_runs
+from pyphlite_standin import ParseHubStandIn
+
+# Benchmarks for pyphlite against a local ParseHubStandIn server, run with: python pyphlite_bench.py [options]
+# - listing, hydration, polling and download scenarios report per-operation latency (mean, p50, p95),
+#   throughput and peak traced memory; see --help for dataset sizes, server latency and 429 behaviour
+# - the object model micro-benchmarks compare attribute access and per-object memory with the
+#   previous __getattribute__-based model
+
+BENCH_API_KEY = '<BENCH API KEY>' #never sent anywhere
+
+run_jdata = {
+    'project_token': 'tBenchProject',
+    'run_token': 'tBenchRun',
+    'status': 'complete',
+    'data_ready': True,
+    'start_time': '2016-04-11T15:56:03',
+    'end_time': '2016-04-11T15:57:45',
+    'pages': 25,
+    'md5sum': 'd41d8cd98f00b204e9800998ecf8427e',
+    'start_url': 'http://www.example.com',
+    'start_template': 'main_template',
+    'start_value': '{}',
+    'is_empty': False,
+    'custom_field': 'not one of RunFields',
+}
+
+#The object model before slotted fields: every attribute read goes through __getattribute__
+class LegacyPhRun(object):
+    def __init__(self, api_key, run_token, jdata=None, session=None):
+        self._api_key = api_key
+        self._session = session
+        self._thin = False
+        self._params = {}
+        self._req_params = None
+        self._run_token = run_token
+        self._poll_policy = None
+        self._update_count = 0
+        self._last_update_time = None
+        self._jdata = jdata
+
+    def __getattribute__(self, name):
+        try:
+            return object.__getattribute__(self, name)
+        except AttributeError:
+
+            logging.debug('PhBase.__getattribute__(self, name="%s"): Not Found.' % name)
+
+            if name == '_thin':
+                raise AttributeError
+
+            if self._thin:
+                raise Warning('Attempted to access a non-existance attribute "%s" of a thin object. Running update()...' % name)
+
+            try:
+                retval = self._jdata[name]
+                logging.debug('PhBase.__getattr__(self, name="%s"): Found in _jdata.' % name)
+                return retval
+            except:
+                logging.debug('PhBase.__getattr__(self, name="%s"): Not found in _jdata.' % name)
+                return object.__getattribute__(self, name)
+
+def make_runs(cls, n, session):
+    return [cls(BENCH_API_KEY, 'tBenchRun%s' % i, jdata=dict(run_jdata, run_token='tBenchRun%s' % i), session=session)
+            for i in range(n)]
+
+def bench_attribute_access(cls, session, n=1000, repeat=5):
+    #Best time, in ns, of one read of a known field, a private attribute and an unknown key
+    runs = make_runs(cls, n, session)
+    results = {}
+    for label, read in (('known field', lambda r: r.status),
+                        ('private attribute', lambda r: r._run_token),
+                        ('unknown key', lambda r: r.custom_field)):
+        best = min(timeit.repeat(lambda: [read(r) for r in runs], number=10, repeat=repeat))
+        results[label] = best / (10.0 * n) * 1e9
+    return results
+
+def bench_object_memory(cls, session, n=10000):
+    #Bytes allocated per object, excluding the shared jdata dicts
+    jdatas = [dict(run_jdata, run_token='tBenchRun%s' % i) for i in range(n)]
+    if tracemalloc is None:
+        run = cls(BENCH_API_KEY, 'tBenchRun', jdata=jdatas[0], session=session)
+        return sys.getsizeof(run) + sys.getsizeof(getattr(run, '__dict__', {}))
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    runs = [cls(BENCH_API_KEY, 'tBenchRun%s' % i, jdata=jdata, session=session) for i, jdata in enumerate(jdatas)]
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return allocated / float(len(runs))
+
+def print_object_model():
+    session = PhSession(BENCH_API_KEY)
+    print('%-28s %12s %12s' % ('object model', 'before', 'after'))
+    legacy, slotted = bench_attribute_access(LegacyPhRun, session), bench_attribute_access(PhRun, session)
+    for label in ('known field', 'private attribute', 'unknown key'):
+        print('%-28s %9.1f ns %9.1f ns' % ('read ' + label, legacy[label], slotted[label]))
+    print('%-28s %10.0f B %10.0f B' % ('memory per PhRun', bench_object_memory(LegacyPhRun, session),
+                                       bench_object_memory(PhRun, session)))
+
+### SERVER SCENARIOS ###
+
+#A scenario takes (hub, session, options) and returns a function running one repetition, which returns
+#(operations, bytes) so throughput can be reported per operation and per byte
+
+def scenario_listing(hub, session, options):
+    def listing():
+        acct = PhAccount(BENCH_API_KEY, session=session)
+        return len([p.token for p in acct.projects]), 0
+    return listing
+
+def scenario_hydration(hub, session, options):
+    tokens = list(hub.projects)
+    def hydration():
+        for token in tokens:
+            PhProject(BENCH_API_KEY, token, session=session)
+        return len(tokens), 0
+    return hydration
+
+def scenario_fan_out(hub, session, options):
+    tokens = list(hub.projects)
+    acct = PhAccount(BENCH_API_KEY, thin=True, session=session)
+    def fan_out():
+        return len([r.value for r in acct.get_projects(tokens, max_workers=options.workers)]), 0
+    return fan_out
+
+def scenario_polling(hub, session, options):
+    proj = PhProject(BENCH_API_KEY, list(hub.projects)[0], thin=True, session=session)
+    def polling():
+        runs = [proj.run() for i in range(options.poll_runs)]
+        wait_for_runs(runs, poll_policy=PollPolicy(interval=options.poll_interval, timeout=600))
+        return len(runs), 0
+    return polling
+
+def _download_scenario(output_format, read):
+    def scenario(hub, session, options):
+        run = PhRun(BENCH_API_KEY, list(hub.runs)[0], session=session)
+        def download():
+            read(run, output_format)
+            return 1, len(hub.datasets[output_format])
+        return download
+    return scenario
+
+SCENARIOS = [
+    ('listing', scenario_listing),
+    ('hydration', scenario_hydration),
+    ('fanout hydration', scenario_fan_out),
+    ('polling', scenario_polling),
+    ('get_data json', _download_scenario('json', lambda run, fmt: run.get_data(format=fmt))),
+    ('get_data csv', _download_scenario('csv', lambda run, fmt: run.get_data(format=fmt))),
+    ('iter_records', _download_scenario('json', lambda run, fmt: sum(1 for r in run.iter_records()))),
+    ('iter_csv_rows', _download_scenario('csv', lambda run, fmt: sum(1 for r in run.iter_csv_rows()))),
+]
+
+class RequestTimes(object):
+    #Instrument collecting the total latency of every request
+    def __init__(self):
+        self.times = []
+
+    def after_request(self, event):
+        self.times.append(event['total'])
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))] if values else 0
+
+def run_scenario(make, hub, options):
+    timer = RequestTimes()
+    session = PhSession(BENCH_API_KEY, base_url=hub.base_url, instruments=[timer])
+    try:
+        once = make(hub, session, options)
+        operations = nbytes = 0
+        start = time.time()
+        for i in range(options.repeat):
+            ops, size = once()
+            operations += ops
+            nbytes += size
+        elapsed = time.time() - start
+        requests = len(timer.times)
+
+        peak = None
+        if tracemalloc is not None: #one more repetition, traced (tracing slows it down)
+            tracemalloc.start()
+            once()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    finally:
+        session.close()
+
+    return {
+        'ops_per_s': operations / elapsed,
+        'mb_per_s': nbytes / elapsed / 1e6,
+        'requests': requests,
+        'mean_ms': sum(timer.times[:requests]) / max(requests, 1) * 1e3,
+        'p50_ms': percentile(timer.times[:requests], 50) * 1e3,
+        'p95_ms': percentile(timer.times[:requests], 95) * 1e3,
+        'peak_mb': None if peak is None else peak / 1e6,
+    }
+
+def print_scenarios(options):
+    hub = ParseHubStandIn(projects=options.projects, runs_per_project=options.runs_per_project, rows=options.rows,
+                          latency=options.latency, polls_until_ready=options.polls, limited_polls=options.limited,
+                          gzip=options.gzip)
+    print('%-16s %10s %8s %8s %9s %9s %9s %9s' % ('scenario', 'ops/s', 'MB/s', 'requests', 'mean ms', 'p50 ms', 'p95 ms', 'peak MB'))
+    with hub:
+        for name, make in SCENARIOS:
+            if options.scenario and name.split()[0] not in options.scenario:
+                continue
+            r = run_scenario(make, hub, options)
+            print('%-16s %10.1f %8.2f %8d %9.2f %9.2f %9.2f %9s' % (
+                name, r['ops_per_s'], r['mb_per_s'], r['requests'], r['mean_ms'], r['p50_ms'], r['p95_ms'],
+                '-' if r['peak_mb'] is None else '%.2f' % r['peak_mb']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark pyphlite against a local ParseHub stand-in server.')
+    parser.add_argument('--projects', type=int, default=100, help='projects on the server')
+    parser.add_argument('--runs-per-project', type=int, default=3, help='complete runs per project')
+    parser.add_argument('--rows', type=int, default=20000, help='records in every run\'s dataset')
+    parser.add_argument('--latency', type=float, default=0, help='seconds the server waits before each response')
+    parser.add_argument('--polls', type=int, default=2, help='polls before a started run is ready')
+    parser.add_argument('--limited', type=int, default=0, help='polls of a started run answered with HTTP 429 first')
+    parser.add_argument('--gzip', action='store_true', help='send run data gzip-encoded, as ParseHub does')
+    parser.add_argument('--poll-runs', type=int, default=20, help='runs started and waited for by the polling scenario')
+    parser.add_argument('--poll-interval', type=float, default=0.01, help='PollPolicy interval of the polling scenario')
+    parser.add_argument('--workers', type=int, default=8, help='max_workers of the fanout scenario')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions of every scenario')
+    parser.add_argument('--scenario', action='append', help='only run this scenario (repeatable): ' +
+                        ', '.join(sorted(set(name.split()[0] for name, make in SCENARIOS) | set(['objects']))))
+    options = parser.parse_args(argv)
+
+    if not options.scenario or 'objects' in options.scenario:
+        print_object_model()
+        print()
+    if not options.scenario or set(options.scenario) - set(['objects']):
+        print_scenarios(options)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+import collections
+import json
+import logging
+import re
+from array import array
+
+import numpy as np
+
+from pyphlite import LazyDictExcept, iter_csv_rows, iter_json_records
+
+# Columnar, NumPy-backed datasets of run data (Python 3 only, requires numpy)
+#       ds = run_dataset(run, base_list='movies')
+#       recent = ds.filter((ds['year'] >= 1990) & ds['title'].contains('Godfather'))
+#       for record in recent: ...
+# - every field is stored as one column, its type inferred from all of its values:
+#   - int64 when every value is an integer ("1994"), float64 when they are numbers (ints with
+#     missing values too, NaN marking the missing ones)
+#   - datetime64[D] when they are ISO dates ("2016-04-11"), datetime64[s] when some are date-times
+#     ("2016-04-11T15:56:03")
+#   - otherwise a StringColumn (utf-8 bytes of every value back to back) or, when values repeat a lot,
+#     a CategoryColumn (an int32 code per value); nested lists/dicts and booleans give object arrays
+# - "" counts as a missing value in number and date columns (CSV has no other way to leave one out)
+# - numeric and date columns are plain numpy arrays, string columns support ==, !=, isin() and
+#   contains(); any of them combine into boolean masks for filter()
+# - iterating yields record dicts built on demand, values typed by their column (1994, not "1994");
+#   missing values are left out of the record
+
+logger = logging.getLogger('pyphlite')
+
+CATEGORY_RATIO = 4 #a string column with at most one distinct value per this many values becomes a CategoryColumn
+RECORD_BATCH = 4096 #records converted at a time when iterating
+
+_MISSING = object()
+
+_TEXT_TYPES = collections.OrderedDict((
+    ('int64', re.compile(r'-?(0|[1-9][0-9]*)\Z')),
+    ('float64', re.compile(r'-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?\Z')),
+    ('datetime64[D]', re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}\Z')),
+    ('datetime64[s]', re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}([T ][0-9]{2}:[0-9]{2}(:[0-9]{2}(\.[0-9]+)?)?Z?)?\Z')),
+))
+
+class StringColumn(object):
+    #Strings stored as one utf-8 buffer: value i is data[offsets[i]:offsets[i + 1]], None where valid[i] is False
+    __slots__ = ('data', 'offsets', 'valid')
+
+    def __init__(self, data, offsets, valid=None):
+        self.data = data
+        self.offsets = offsets
+        self.valid = valid #None when no value is missing
+
+    def __repr__(self):
+        return '<StringColumn of %s values, %s bytes>' % (len(self), self.nbytes)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        return len(self.data) + self.offsets.nbytes + (0 if self.valid is None else self.valid.nbytes)
+
+    def _valid_mask(self):
+        return np.ones(len(self), dtype=bool) if self.valid is None else self.valid
+
+    def __getitem__(self, i):
+        if self.valid is not None and not self.valid[i]:
+            return None
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def tolist(self, start=0, stop=None):
+        stop = len(self) if stop is None else stop
+        offsets = self.offsets[start:stop + 1].tolist()
+        values = [self.data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(stop - start)]
+        if self.valid is not None:
+            values = [v if ok else None for v, ok in zip(values, self.valid[start:stop].tolist())]
+        return values
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        starts, lengths = self.offsets[indices], np.diff(self.offsets)[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        gather = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1], dtype=np.int64)
+        data = np.frombuffer(self.data, dtype=np.uint8)[gather].tobytes()
+        return StringColumn(data, offsets, None if self.valid is None else self.valid[indices])
+
+    def __eq__(self, value):
+        value = value.encode('utf-8')
+        rows = np.flatnonzero((np.diff(self.offsets) == len(value)) & self._valid_mask())
+        mask = np.zeros(len(self), dtype=bool)
+        if len(value) and len(rows):
+            chars = np.frombuffer(self.data, dtype=np.uint8)[self.offsets[rows][:, None] + np.arange(len(value))]
+            rows = rows[(chars == np.frombuffer(value, dtype=np.uint8)).all(axis=1)]
+        mask[rows] = True
+        return mask
+
+    def __ne__(self, value):
+        return ~(self == value)
+
+    __hash__ = None
+
+    def isin(self, values):
+        mask = np.zeros(len(self), dtype=bool)
+        for value in values:
+            mask |= self == value
+        return mask
+
+    def contains(self, substring):
+        #rows whose value contains substring; one bytes.find per occurrence in the whole column
+        substring = substring.encode('utf-8')
+        if not substring:
+            return self._valid_mask().copy()
+        found = []
+        pos = self.data.find(substring)
+        while pos != -1:
+            found.append(pos)
+            pos = self.data.find(substring, pos + 1)
+        found = np.array(found, dtype=np.int64)
+        rows = np.searchsorted(self.offsets, found, 'right') - 1
+        mask = np.zeros(len(self), dtype=bool)
+        mask[rows[found + len(substring) <= self.offsets[rows + 1]]] = True
+        return mask & self._valid_mask()
+
+    def value_counts(self):
+        return collections.Counter(v for v in self.tolist() if v is not None)
+
+class CategoryColumn(object):
+    #Repetitive strings: value i is categories[codes[i]], None where codes[i] is -1
+    __slots__ = ('codes', 'categories')
+
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    def __repr__(self):
+        return '<CategoryColumn of %s values, %s categories>' % (len(self), len(self.categories))
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + sum(len(c.encode('utf-8')) for c in self.categories)
+
+    def __getitem__(self, i):
+        code = self.codes[i]
+        return None if code < 0 else self.categories[code]
+
+    def tolist(self, start=0, stop=None):
+        return [None if code < 0 else self.categories[code] for code in self.codes[start:stop].tolist()]
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def take(self, indices):
+        return CategoryColumn(self.codes[np.asarray(indices, dtype=np.int64)], self.categories)
+
+    def _codes_where(self, matches):
+        return np.isin(self.codes, [code for code, category in enumerate(self.categories) if matches(category)])
+
+    def __eq__(self, value):
+        return self._codes_where(lambda category: category == value)
+
+    def __ne__(self, value):
+        return ~(self == value)
+
+    __hash__ = None
+
+    def isin(self, values):
+        values = set(values)
+        return self._codes_where(lambda category: category in values)
+
+    def contains(self, substring):
+        return self._codes_where(lambda category: substring in category)
+
+    def value_counts(self):
+        counts = np.bincount(self.codes[self.codes >= 0], minlength=len(self.categories))
+        return collections.Counter(dict((c, n) for c, n in zip(self.categories, counts.tolist()) if n))
+
+def _column_values(column, start, stop):
+    #python values of rows [start, stop), _MISSING for missing ones
+    if isinstance(column, (StringColumn, CategoryColumn)):
+        return [_MISSING if v is None else v for v in column.tolist(start, stop)]
+    part = column[start:stop]
+    if part.dtype.kind == 'f':
+        return [_MISSING if v != v else v for v in part.tolist()]
+    if part.dtype.kind in 'MO': #NaT and missing objects are None
+        return [_MISSING if v is None else v for v in part.tolist()]
+    return part.tolist()
+
+class _ColumnBuilder(object):
+    #Collects one field's values compactly (as utf-8 text) while narrowing down its type
+    __slots__ = ('_text', '_offsets', '_kinds', '_objects', '_types')
+
+    MISSING, STRING, NUMBER = 0, 1, 2
+
+    def __init__(self, missing=0):
+        self._text = bytearray()
+        self._offsets = array('q', [0] * (missing + 1))
+        self._kinds = array('b', [self.MISSING] * missing)
+        self._objects = None #python values, once a list/dict/bool shows up
+        self._types = list(_TEXT_TYPES)
+
+    def __len__(self):
+        return len(self._kinds)
+
+    def add(self, value):
+        if self._objects is not None:
+            self._objects.append(value)
+            return
+        if value is None:
+            kind, text = self.MISSING, ''
+        elif isinstance(value, str):
+            kind, text = self.STRING, value
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            kind, text = self.NUMBER, json.dumps(value)
+        else:
+            self._objects = self._values()
+            self._objects.append(value)
+            return
+
+        if text and self._types:
+            self._types = [t for t in self._types if _TEXT_TYPES[t].match(text)]
+        self._text += text.encode('utf-8')
+        self._offsets.append(len(self._text))
+        self._kinds.append(kind)
+
+    def _texts(self):
+        text, offsets = bytes(self._text), self._offsets
+        return [text[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(self._kinds))]
+
+    def _values(self):
+        return [None if kind == self.MISSING else json.loads(text) if kind == self.NUMBER else text
+                for kind, text in zip(self._kinds, self._texts())]
+
+    def build(self):
+        if self._objects is not None:
+            column = np.empty(len(self._objects), dtype=object)
+            column[:] = self._objects
+            return column
+
+        texts = self._texts()
+        if any(texts):
+            for dtype in self._types:
+                try:
+                    if dtype == 'int64' and self.MISSING not in self._kinds and '' not in texts:
+                        return np.array([int(t) for t in texts], dtype=np.int64)
+                    if dtype in ('int64', 'float64'):
+                        return np.array([float(t) if t else np.nan for t in texts], dtype=np.float64)
+                    if dtype.startswith('datetime64'):
+                        return np.array([t.rstrip('Z') if t else 'NaT' for t in texts], dtype=dtype)
+                except (ValueError, OverflowError): #e.g. "2016-13-45", or an integer too big for int64
+                    continue
+
+        return self._build_strings()
+
+    def _build_strings(self):
+        valid = np.frombuffer(self._kinds, dtype=np.int8) != self.MISSING
+        categories = {}
+        codes = []
+        text, offsets = bytes(self._text), self._offsets
+        for i, ok in enumerate(valid.tolist()):
+            if ok:
+                codes.append(categories.setdefault(text[offsets[i]:offsets[i + 1]], len(categories)))
+            else:
+                codes.append(-1)
+            if len(categories) * CATEGORY_RATIO > len(valid):
+                return StringColumn(text, np.frombuffer(offsets, dtype=np.int64).copy(), None if valid.all() else valid)
+        return CategoryColumn(np.array(codes, dtype=np.int32), [c.decode('utf-8') for c in categories])
+
+class Dataset(object):
+    #Records of a run as named columns (see the module comment)
+    __slots__ = ('columns', '_length')
+
+    def __init__(self, columns, length=None):
+        self.columns = collections.OrderedDict(columns)
+        if length is None:
+            length = len(next(iter(self.columns.values()))) if self.columns else 0
+        self._length = length
+
+    def __repr__(self):
+        return '<Dataset of %s records: %s>' % (len(self), ', '.join('%s (%s)' % (name, _column_type(c)) for name, c in self.columns.items()))
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    @property
+    def fields(self):
+        return list(self.columns)
+
+    @property
+    def nbytes(self):
+        return sum(c.nbytes for c in self.columns.values())
+
+    @classmethod
+    def from_records(cls, records):
+        #records: an iterable of dicts (e.g. iter_json_records); keys missing from some records are missing values
+        builders = collections.OrderedDict()
+        length = 0
+        for record in records:
+            for name, value in record.items():
+                builder = builders.get(name)
+                if builder is None:
+                    builder = builders[name] = _ColumnBuilder(length)
+                builder.add(value)
+            length += 1
+            for builder in builders.values():
+                if len(builder) < length:
+                    builder.add(None)
+        return cls(((name, b.build()) for name, b in builders.items()), length)
+
+    @classmethod
+    def from_json(cls, chunks, base_list=None):
+        #chunks: JSON run data as bytes or byte chunks; records are parsed one at a time (see iter_json_records)
+        if isinstance(chunks, bytes):
+            chunks = [chunks]
+        return cls.from_records(iter_json_records(chunks, base_list))
+
+    @classmethod
+    def from_csv(cls, chunks, encoding='utf-8-sig'):
+        #chunks: CSV run data as bytes or byte chunks, header row first
+        if isinstance(chunks, bytes):
+            chunks = [chunks]
+        return cls.from_records(iter_csv_rows(chunks, as_dict=True, encoding=encoding))
+
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        return Dataset(((name, c[indices] if isinstance(c, np.ndarray) else c.take(indices)) for name, c in self.columns.items()),
+                       len(indices))
+
+    def filter(self, mask):
+        #the records where the boolean array mask is True
+        return self.take(np.flatnonzero(mask))
+
+    def value_counts(self, name):
+        column = self.columns[name]
+        if isinstance(column, (StringColumn, CategoryColumn)):
+            return column.value_counts()
+        return collections.Counter(v for v in _column_values(column, 0, len(column)) if v is not _MISSING)
+
+    def record(self, i):
+        return next(self._iter_records(i, i + 1))
+
+    def _iter_records(self, start, stop):
+        names = list(self.columns)
+        for batch in range(start, stop, RECORD_BATCH):
+            end = min(stop, batch + RECORD_BATCH)
+            values = [_column_values(self.columns[name], batch, end) for name in names]
+            for row in zip(*values):
+                yield dict((name, v) for name, v in zip(names, row) if v is not _MISSING)
+
+    def __iter__(self):
+        return self._iter_records(0, len(self))
+
+def _column_type(column):
+    if isinstance(column, StringColumn):
+        return 'str'
+    if isinstance(column, CategoryColumn):
+        return 'category'
+    return str(column.dtype)
+
+def run_dataset(run, base_list=None, format='json', **kwargs):
+    #Dataset of a PhRun's data, built while it downloads; kwargs go to run.iter_data (e.g. poll_policy, blocking)
+    logger.info('run_dataset(run="%s", base_list="%s", format="%s", kwargs="%s").',
+                run, base_list, format, LazyDictExcept(kwargs, 'jdata'))
+    kwargs['format'] = format
+    if format == 'csv':
+        return Dataset.from_csv(run.iter_data(**kwargs))
+    return Dataset.from_json(run.iter_data(**kwargs), base_list)
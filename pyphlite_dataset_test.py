@@ -0,0 +1,93 @@
+import datetime
+import json
+import unittest
+
+import numpy as np
+
+from pyphlite import PhRun, PhSession
+from pyphlite_dataset import CategoryColumn, Dataset, StringColumn, run_dataset
+from pyphlite_standin import ParseHubStandIn, make_datasets, make_records
+
+API_KEY = '<OFFLINE API KEY>' #only ever sent to the local test server
+
+records = [
+    {'title': 'The Shawshank Redemption', 'year': '1994', 'rating': '9.3', 'released': '1994-10-14', 'genre': 'Drama'},
+    {'title': 'The Godfather', 'year': '1972', 'rating': '9.2', 'released': '1972-03-24', 'genre': 'Crime'},
+    {'title': 'Amélie', 'year': '2001', 'rating': '', 'released': '2001-04-25', 'genre': 'Comedy', 'cast': [{'name': 'Audrey'}]},
+    {'title': 'The Godfather: Part II', 'year': '1974', 'released': '1974-12-20T19:30', 'genre': 'Crime'},
+    {'title': 'Pulp Fiction', 'year': '1994', 'rating': 8.9, 'released': '', 'genre': 'Crime'},
+    {'title': 'Se7en', 'year': '1995', 'rating': '8.6', 'released': '1995-09-22', 'genre': 'Crime'},
+    {'title': 'Heat', 'year': '1995', 'rating': '8.3', 'released': '1995-12-15', 'genre': 'Crime'},
+    {'title': 'Fargo', 'year': '1996', 'rating': '8.1', 'released': '1996-03-08', 'genre': 'Crime', 'note': None},
+]
+
+class TestDatasetOffline(unittest.TestCase):
+    def setUp(self):
+        self.ds = Dataset.from_json(json.dumps({'url': 'x', 'movies': records}).encode('utf-8'))
+
+    def test_columns(self):
+        ds = self.ds
+        self.assertEqual(len(ds), 8)
+        self.assertEqual(ds.fields, ['title', 'year', 'rating', 'released', 'genre', 'cast', 'note'])
+        self.assertIsInstance(ds['title'], StringColumn)
+        self.assertIsInstance(ds['genre'], StringColumn) #too few values to repeat much
+        self.assertIsInstance(Dataset.from_records(records * 2)['genre'], CategoryColumn)
+        self.assertEqual(ds['year'].dtype, np.int64)
+        self.assertEqual(ds['rating'].dtype, np.float64)
+        self.assertEqual(np.isnan(ds['rating']).sum(), 2)
+        self.assertEqual(ds['released'].dtype, np.dtype('datetime64[s]'))
+        self.assertEqual(ds['cast'].dtype, object)
+        self.assertEqual(ds['title'][2], 'Amélie')
+        self.assertEqual(ds['note'].tolist(), [None] * 8)
+        self.assertEqual(Dataset.from_records([{'zip': '02134'}, {'zip': '10001'}])['zip'].tolist(), ['02134', '10001'])
+        self.assertEqual(Dataset.from_records([{'day': '2016-13-45'}])['day'].tolist(), ['2016-13-45'])
+
+    def test_filters(self):
+        ds = self.ds
+        self.assertEqual((ds['title'] == 'The Godfather').tolist(), [False, True] + [False] * 6)
+        self.assertEqual(ds['title'].contains('Godfather').sum(), 2)
+        self.assertEqual(ds['title'].contains('mption').sum(), 1)
+        self.assertEqual(ds['title'].contains('nShawshank').sum(), 0) #never across two values
+        self.assertEqual(ds['title'].isin(['Heat', 'Fargo', 'Alien']).sum(), 2)
+        self.assertEqual((ds['genre'] != 'Crime').sum(), 2)
+        self.assertEqual(ds['genre'].contains('om').sum(), 1)
+        genres = Dataset.from_records(records * 2)['genre']
+        self.assertEqual((genres != 'Crime').sum(), 4)
+        self.assertEqual(genres.contains('om').sum(), 2)
+        self.assertEqual(genres.isin(['Drama', 'Comedy']).sum(), 4)
+        self.assertEqual(genres.take([0, 1, 1]).tolist(), ['Drama', 'Crime', 'Crime'])
+
+        crime_90s = ds.filter((ds['genre'] == 'Crime') & (ds['year'] >= 1990))
+        self.assertEqual(crime_90s['title'].tolist(), ['Pulp Fiction', 'Se7en', 'Heat', 'Fargo'])
+        self.assertAlmostEqual(float(np.nanmean(crime_90s['rating'])), 8.475)
+        self.assertEqual(crime_90s.value_counts('year'), {1994: 1, 1995: 2, 1996: 1})
+        self.assertEqual(ds.value_counts('genre').most_common(1), [('Crime', 6)])
+        self.assertEqual(ds.filter(ds['released'] < np.datetime64('1980-01-01'))['title'].tolist(),
+                         ['The Godfather', 'The Godfather: Part II'])
+        self.assertEqual(len(ds.filter(ds['year'] > 2020)), 0)
+
+    def test_records(self):
+        ds = self.ds
+        self.assertEqual(ds.record(0), {'title': 'The Shawshank Redemption', 'year': 1994, 'rating': 9.3,
+                                        'released': datetime.datetime(1994, 10, 14), 'genre': 'Drama'})
+        amelie = list(ds)[2]
+        self.assertEqual(amelie['cast'], [{'name': 'Audrey'}])
+        self.assertNotIn('rating', amelie)
+        self.assertEqual([r['title'] for r in ds.take([7, 0])], ['Fargo', 'The Shawshank Redemption'])
+
+    def test_csv_and_run(self):
+        csv_ds = Dataset.from_csv(make_datasets(50)['csv'])
+        self.assertEqual(csv_ds.fields, ['movies_title', 'movies_plot', 'movies_year', 'movies_rating'])
+        self.assertEqual(csv_ds['movies_plot'][3], make_records(50)[3]['plot'])
+
+        with ParseHubStandIn(rows=5000) as hub:
+            session = PhSession(API_KEY, base_url=hub.base_url)
+            ds = run_dataset(PhRun(API_KEY, list(hub.runs)[0], session=session), 'movies')
+            session.close()
+        expected = make_records(5000)
+        self.assertEqual(ds['title'].tolist(), [r['title'] for r in expected])
+        self.assertEqual(ds['year'].tolist(), [int(r['year']) for r in expected])
+        self.assertTrue(ds.nbytes * 4 < len(hub.datasets['json']) * 3) #less than the JSON text itself
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+import json
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from pyphlite import DEFAULT_CHUNK_SIZE, LazyDictExcept, _JsonTextStream
+
+# Parallel parsing of large ParseHub JSON run data on a process pool (Python 3.8+ only)
+#       records = parse_run_records(run, base_list='movies', processes=32)
+#       counts = parse_records(data, aggregate=len) #one len(records) per share, records never leave the workers
+# - the raw bytes are copied once into a multiprocessing.shared_memory block; workers attach to it by
+#   name and decode only their own share, so no copy of the data is pickled to them
+# - the record list is cut into byte ranges; every worker guesses where its first record starts (the
+#   first "}, {" in its range) and parses whole records until the next range. The guesses are checked
+#   against where the previous share really stopped, and a wrong guess (e.g. a "}, {" inside a string
+#   or nested list) is re-parsed in the calling process, so results are always identical to json.loads
+# - aggregate(records) is called in the worker with the records of its share, and its (picklable)
+#   results are returned per share instead of the records; it must be a module-level function
+# - data smaller than two min_share ranges, or processes=1, is parsed in the calling process
+
+logger = logging.getLogger('pyphlite')
+
+MIN_SHARE_BYTES = 1024 * 1024 #smallest byte range handed to a worker
+SHARES_PER_PROCESS = 4        #more, smaller shares even out workers that got slower ranges
+
+_RECORD_START = re.compile(br'\}\s*,\s*\{')
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_decoder = json.JSONDecoder()
+
+def _decode(buf, start, stop):
+    #utf-8 text of buf[start:stop], stop moved forward to a character boundary
+    while stop < len(buf) and buf[stop] & 0xC0 == 0x80:
+        stop += 1
+    return bytes(buf[start:stop]).decode('utf-8'), stop
+
+def _find_records(buf, base_list=None):
+    #byte offset of the first record of the records list (see iter_json_records), None when it is empty
+    fed = [0]
+    def chunks():
+        for offset in range(0, len(buf), DEFAULT_CHUNK_SIZE):
+            chunk = bytes(buf[offset:offset + DEFAULT_CHUNK_SIZE])
+            fed[0] += len(chunk)
+            yield chunk
+
+    stream = _JsonTextStream(chunks())
+    stream.take('{')
+    if stream.peek() != '}':
+        while True:
+            key = stream.value()
+            stream.take(':')
+            if stream.peek() == '[' and (base_list is None or key == base_list):
+                stream.take('[')
+                if stream.peek() == ']':
+                    return None
+                pending = len(stream._utf8.getstate()[0]) + len(stream.buf[stream.pos:].encode('utf-8'))
+                return fed[0] - pending
+            stream.value()
+            if stream.take(',}') == '}':
+                break
+
+    if base_list is not None:
+        raise KeyError('Run data has no top-level list "%s".' % base_list)
+    return None
+
+def _guess_record_start(buf, start, end):
+    #first "{" in [start, end) that follows "}," -- a record's first byte, unless the guess is wrong
+    for match in _RECORD_START.finditer(buf, max(0, start - 4096), end):
+        if match.end() - 1 >= start:
+            return match.end() - 1
+    return None
+
+def _parse_records(buf, start, end):
+    #Parse the records starting at byte start (which must be a record's first byte) until the next record
+    #starts at or after byte end; returns (records, byte offset of that next record or None after the last)
+    decoded = min(len(buf), end + DEFAULT_CHUNK_SIZE)
+    text, decoded = _decode(buf, start, decoded)
+    if end == len(buf):
+        limit = len(text) + 1
+    elif text.isascii():
+        limit = end - start
+    else:
+        limit = len(bytes(buf[start:end]).decode('utf-8', 'ignore'))
+    records = []
+    pos = 0
+    while True:
+        try:
+            record, pos_after = _decoder.raw_decode(text, pos)
+            sep = _WHITESPACE.match(text, pos_after).end()
+            if sep == len(text):
+                raise ValueError('Run data ends in the middle of the records list.')
+            if text[sep] == ',':
+                next_pos = _WHITESPACE.match(text, sep + 1).end()
+                if next_pos == len(text):
+                    raise ValueError('Run data ends in the middle of the records list.')
+        except ValueError:
+            if decoded == len(buf):
+                raise
+            text, decoded = _decode(buf, start, min(len(buf), start + 2 * (decoded - start)))
+            continue
+
+        records.append(record)
+        if text[sep] == ']':
+            return records, None
+        if text[sep] != ',':
+            raise ValueError('Malformed JSON run data: expected one of ",]" but found "%s".' % text[sep])
+        pos = next_pos
+        if pos >= limit:
+            return records, start + (pos if text.isascii() else len(text[:pos].encode('utf-8')))
+
+def _parse_share(name, size, start, end, exact, aggregate):
+    #Worker: (first record's offset or None, next share's first record or None, records or aggregate, ok)
+    shm = shared_memory.SharedMemory(name=name)
+    buf = shm.buf[:size]
+    try:
+        if not exact:
+            start = _guess_record_start(buf, start, end)
+            if start is None:
+                return None, None, None, False
+        try:
+            records, stop = _parse_records(buf, start, end)
+        except ValueError: #a wrong guess, or malformed data that the calling process will report
+            return start, None, None, False
+        return start, stop, records if aggregate is None else aggregate(records), True
+    finally:
+        buf.release()
+        shm.close()
+
+def parse_records(data, base_list=None, processes=None, aggregate=None, executor=None, min_share=MIN_SHARE_BYTES):
+    #Parse ParseHub JSON run data (bytes-like) on a process pool
+    # - returns the records of the top-level list base_list (None picks the first top-level list), or
+    #   with aggregate, a list of aggregate(records) for consecutive shares of those records
+    # - executor: a concurrent.futures executor to reuse; by default a ProcessPoolExecutor with processes
+    #   workers (os.cpu_count() by default) is started and shut down on every call
+    logger.info('parse_records(data=<%s bytes>, base_list="%s", processes=%s, aggregate="%s", executor="%s", min_share=%s).',
+                len(data), base_list, processes, aggregate, executor, min_share)
+    data = memoryview(data).cast('B')
+    size = len(data)
+    processes = processes or os.cpu_count() or 1
+    first = _find_records(data, base_list)
+    if first is None:
+        return [] if aggregate is None else [aggregate([])]
+
+    shares = max(1, min(processes * SHARES_PER_PROCESS, (size - first) // max(min_share, 1)))
+    if processes == 1 or shares == 1:
+        records = _parse_records(data, first, size)[0]
+        return records if aggregate is None else [aggregate(records)]
+
+    bounds = [first + i * (size - first) // shares for i in range(shares)] + [size]
+    logger.debug('parse_records: %s shares of %s bytes on %s processes.', shares, (size - first) // shares, processes)
+
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    buf = shm.buf[:size]
+    own_executor = executor is None
+    try:
+        buf[:] = data
+        if own_executor:
+            executor = ProcessPoolExecutor(processes)
+        futures = [executor.submit(_parse_share, shm.name, size, bounds[i], bounds[i + 1], i == 0, aggregate)
+                   for i in range(shares)]
+
+        #Chain the shares: a share is kept when it started exactly where the kept ones before it stopped;
+        #a gap before the next guessed start is parsed here
+        results = []
+        expected = first
+        for future in futures:
+            start, stop, payload, ok = future.result()
+            if expected is None:
+                continue
+            if not ok:
+                continue
+            if start > expected:
+                logger.debug('parse_records: re-parsing bytes %s to %s.', expected, start)
+                records, expected = _parse_records(buf, expected, start)
+                results.append(records if aggregate is None else aggregate(records))
+            if start == expected:
+                results.append(payload)
+                expected = stop
+        if expected is not None:
+            logger.debug('parse_records: re-parsing bytes %s to the end.', expected)
+            records, expected = _parse_records(buf, expected, size)
+            results.append(records if aggregate is None else aggregate(records))
+    finally:
+        if own_executor and executor is not None:
+            executor.shutdown()
+        buf.release()
+        shm.close()
+        shm.unlink()
+
+    if aggregate is not None:
+        return results
+    return [record for records in results for record in records]
+
+def parse_run_records(run, base_list=None, processes=None, aggregate=None, executor=None, min_share=MIN_SHARE_BYTES, **kwargs):
+    #parse_records for a PhRun's JSON data; kwargs go to run.iter_data (e.g. poll_policy, blocking)
+    logger.info('parse_run_records(run="%s", base_list="%s", processes=%s, aggregate="%s", kwargs="%s").',
+                run, base_list, processes, aggregate, LazyDictExcept(kwargs, 'jdata'))
+    kwargs['format'] = 'json'
+    data = bytearray()
+    for chunk in run.iter_data(**kwargs):
+        data += chunk
+    return parse_records(data, base_list, processes, aggregate, executor, min_share)
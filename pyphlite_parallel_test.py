@@ -0,0 +1,64 @@
+import json
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+from pyphlite import PhRun, PhSession
+from pyphlite_parallel import parse_records, parse_run_records
+from pyphlite_standin import ParseHubStandIn, make_records
+
+API_KEY = '<OFFLINE API KEY>' #only ever sent to the local test server
+
+def make_run_data(rows, indent=None):
+    #records that trip up naive splitting: "}, {" inside strings and nested lists of objects, non-ASCII text
+    records = [{'title': 'Movie %s' % i, 'plot': 'a}, {"b": %s}, {c' % i, 'cast': [{'name': 'Actor %s' % j} for j in range(i % 4)],
+                'director': 'Réalisateur ☃ %s' % i, 'rating': i / 10.0}
+               for i in range(rows)]
+    return json.dumps({'status': {'pages': [1, 2]}, 'movies': records, 'links': [{'url': 'x'}]}, indent=indent,
+                      ensure_ascii=bool(indent)).encode('utf-8'), records
+
+class TestParseRecordsOffline(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.executor = ProcessPoolExecutor(3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+
+    def test_same_as_json_loads(self):
+        for indent in (None, 2):
+            data, records = make_run_data(500, indent)
+            for min_share in (1, 100, 5000, len(data)):
+                self.assertEqual(parse_records(data, 'movies', processes=3, executor=self.executor, min_share=min_share), records)
+        self.assertEqual(parse_records(bytearray(data), processes=1), records)
+        self.assertEqual(parse_records(data, 'links', processes=3, executor=self.executor, min_share=1), [{'url': 'x'}])
+
+    def test_aggregate(self):
+        data, records = make_run_data(1000)
+        counts = parse_records(data, 'movies', processes=3, executor=self.executor, min_share=1000, aggregate=len)
+        self.assertTrue(len(counts) > 1)
+        self.assertEqual(sum(counts), 1000)
+        self.assertEqual(sum(parse_records(data, 'movies', processes=2, min_share=1000, aggregate=len)), 1000)
+
+    def test_edge_cases(self):
+        self.assertEqual(parse_records(b'{"movies": []}', processes=3, min_share=1), [])
+        self.assertEqual(parse_records(b'{}', processes=3, min_share=1, aggregate=len), [0])
+        numbers = json.dumps({'ids': list(range(5000))}).encode('utf-8') #no "}, {" to guess from
+        self.assertEqual(parse_records(numbers, processes=3, executor=self.executor, min_share=100), list(range(5000)))
+        self.assertRaises(KeyError, parse_records, b'{"movies": []}', 'episodes')
+
+        data, records = make_run_data(200)
+        self.assertRaises(ValueError, parse_records, data[:len(data) // 2], processes=3, executor=self.executor, min_share=100)
+        self.assertRaises(ValueError, parse_records, data.replace(b'}, {', b'} {', 150), processes=3,
+                          executor=self.executor, min_share=100)
+
+    def test_run_records(self):
+        with ParseHubStandIn(rows=3000) as hub:
+            session = PhSession(API_KEY, base_url=hub.base_url)
+            run = PhRun(API_KEY, list(hub.runs)[0], session=session)
+            self.assertEqual(parse_run_records(run, 'movies', processes=3, executor=self.executor, min_share=10000),
+                             make_records(3000))
+            session.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,299 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import hashlib
+import json
+import threading
+import time
+import zlib
+
+import requests
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlencode, urlparse
+except ImportError: #Py2
+    from urllib import urlencode
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+# Local stand-in for the ParseHub v2 endpoints used by pyphlite, for benchmarks and offline experiments:
+#       with ParseHubStandIn(projects=100, rows=10000, polls_until_ready=3) as hub:
+#           session = PhSession(API_KEY, base_url=hub.base_url)
+#           acct = PhAccount(API_KEY, session=session)
+# - GET /projects (offset/limit paging, limit capped at max_page_size; total_projects=False leaves the
+#   total out of the listing), GET /projects/{token} (run_list paged by offset, run_page_size runs a page;
+#   answers If-None-Match with HTTP 304 while its ETag still matches),
+#   POST /projects/{token}/run, GET /projects/{token}/last_ready_run/data, GET /runs/{token},
+#   GET /runs/{token}/data, POST /runs/{token}/cancel and DELETE /runs/{token}
+# - every project starts with runs_per_project complete runs; a started run answers its first
+#   limited_polls polls with HTTP 429 (Retry-After: retry_after), then becomes ready polls_until_ready
+#   polls later; add_run() adds runs with their own status, start_time or poll counts
+# - every run serves the same generated dataset of `rows` movies, as JSON ({"movies": [...]}) or CSV
+# - latency seconds are slept before every response; requests lists every (method, path) served
+# - api_key: when set, requests without that api_key get HTTP 401
+# - gzip: run data is sent gzip-encoded to clients that accept it, as ParseHub does
+# - webhook: a URL that every run status change is POSTed to (the run object, form encoded), as ParseHub
+#   does for a project's webhook; finish_run() completes a run without waiting for polls
+
+RUN_LIST_PAGE_SIZE = 20
+
+def make_records(rows):
+    return [
+        {'title': 'Movie %s' % i, 'plot': 'Plot, "quoted"\nline %s' % i, 'year': str(1900 + i % 120),
+         'rating': '%.1f' % (i % 100 / 10.0)}
+        for i in range(rows)
+    ]
+
+def _csv_field(value):
+    if any(c in value for c in ',"\r\n'):
+        return '"%s"' % value.replace('"', '""')
+    return value
+
+def make_datasets(rows):
+    #{format: body bytes} of the same records, flattened to movies_<key> columns for CSV like ParseHub does
+    records = make_records(rows)
+    keys = ['title', 'plot', 'year', 'rating']
+    csv_lines = [','.join('movies_%s' % k for k in keys)]
+    csv_lines.extend(','.join(_csv_field(record[k]) for k in keys) for record in records)
+    return {
+        'json': json.dumps({'movies': records}).encode('utf-8'),
+        'csv': ('\n'.join(csv_lines) + '\n').encode('utf-8'),
+    }
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' #keep-alive, like the real API
+    disable_nagle_algorithm = True #headers and body are written separately
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b'', headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        hub = self.server.standin
+        accepts_gzip = 'gzip' in (self.headers.get('Accept-Encoding') or '')
+        hub.requests.append((method, url.path))
+        if hub.latency:
+            time.sleep(hub.latency)
+
+        if hub.api_key is not None and query.get('api_key') != hub.api_key:
+            return self._reply(401, {'error': 'invalid api_key'})
+        reply = hub.respond(method, url.path.strip('/').split('/'), query)
+        if reply is None:
+            return self._reply(404, {'error': 'not found'})
+        etag = reply[2].get('ETag') if len(reply) > 2 else None
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            return self._reply(304, b'', {'ETag': etag})
+        if hub.gzip and accepts_gzip and reply[0] == 200 and isinstance(reply[1], bytes) and reply[1]:
+            return self._reply(200, hub.gzipped(reply[1]), {'Content-Encoding': 'gzip'})
+        self._reply(*reply)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+class ParseHubStandIn(object):
+    def __init__(self, projects=3, runs_per_project=3, rows=100, latency=0, polls_until_ready=2,
+                 limited_polls=0, retry_after=0, api_key=None, gzip=False, webhook=None, max_page_size=None,
+                 total_projects=True, run_page_size=RUN_LIST_PAGE_SIZE, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.polls_until_ready = polls_until_ready
+        self.limited_polls = limited_polls
+        self.retry_after = retry_after
+        self.api_key = api_key
+        self.gzip = gzip
+        self.webhook = webhook
+        self.max_page_size = max_page_size
+        self.total_projects = total_projects
+        self.run_page_size = run_page_size
+        self.requests = []
+        self.datasets = make_datasets(rows)
+        self._gzipped = {}
+        self._md5sum = hashlib.md5(self.datasets['json']).hexdigest()
+        self._lock = threading.Lock()
+        self._host, self._port = host, port
+        self._server = None
+        self._started = 0
+
+        self.projects = collections.OrderedDict((
+            ('tProject%s' % p, {'token': 'tProject%s' % p, 'title': 'Project %s' % p, 'main_site': 'http://www.example.com',
+                                'main_template': 'main_template', 'options_json': '{}', 'output_type': 'json',
+                                'syntax_version': 1, 'webhook': '', 'templates_json': '[]'})
+            for p in range(projects)
+        ))
+        self.runs = {} #token: run jdata
+        self._run_order = dict((token, []) for token in self.projects) #project token: run tokens, newest first
+        self._polls = {} #run token: polls so far
+        self._poll_limits = {} #run token: (limited_polls, polls_until_ready) when not the hub's
+        for token in self.projects:
+            for r in range(runs_per_project):
+                self._add_run(token, status='complete')
+
+    @property
+    def base_url(self):
+        return 'http://%s:%s' % self._server.server_address[:2]
+
+    def start(self):
+        self._server = _ThreadingHTTPServer((self._host, self._port), _StandInHandler)
+        self._server.standin = self
+        thread = threading.Thread(target=self._server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def gzipped(self, body):
+        #gzip encoding of a response body, compressed once per distinct body
+        with self._lock:
+            if body not in self._gzipped:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                self._gzipped[body] = compressor.compress(body) + compressor.flush()
+            return self._gzipped[body]
+
+    def add_run(self, project_token, status='running', start_time=None, limited_polls=None, polls_until_ready=None):
+        #a new run of the project, newest in its run_list; limited_polls/polls_until_ready override the hub's
+        #for this run
+        with self._lock:
+            return self._add_run(project_token, status, start_time, limited_polls, polls_until_ready)
+
+    def _add_run(self, project_token, status='running', start_time=None, limited_polls=None, polls_until_ready=None):
+        self._started += 1
+        run_token = 'tRun%s' % self._started
+        ready = status == 'complete'
+        if start_time is None:
+            start_time = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(1460390163 + self._started))
+        self.runs[run_token] = {
+            'project_token': project_token,
+            'run_token': run_token,
+            'status': status,
+            'data_ready': ready,
+            'start_time': start_time,
+            'end_time': None if status == 'running' else start_time,
+            'pages': 1,
+            'md5sum': self._md5sum if ready else None,
+            'start_url': self.projects[project_token]['main_site'],
+            'start_template': 'main_template',
+            'start_value': '{}',
+            'is_empty': False,
+        }
+        self._polls[run_token] = 0
+        if limited_polls is not None or polls_until_ready is not None:
+            self._poll_limits[run_token] = (self.limited_polls if limited_polls is None else limited_polls,
+                                            self.polls_until_ready if polls_until_ready is None else polls_until_ready)
+        self._run_order[project_token].insert(0, run_token)
+        return self.runs[run_token]
+
+    def _project_jdata(self, token, offset):
+        run_tokens = self._run_order[token]
+        ready = [t for t in run_tokens if self.runs[t]['data_ready']]
+        return dict(
+            self.projects[token],
+            last_run=self.runs[run_tokens[0]] if run_tokens else None,
+            last_ready_run=self.runs[ready[0]] if ready else None,
+            run_list=[self.runs[t] for t in run_tokens[offset:offset + self.run_page_size]],
+        )
+
+    def _etag(self, body):
+        return '"%s"' % hashlib.md5(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _poll(self, run_token):
+        self._polls[run_token] += 1
+        polls = self._polls[run_token]
+        run = self.runs[run_token]
+        limited_polls, polls_until_ready = self._poll_limits.get(run_token, (self.limited_polls, self.polls_until_ready))
+        if run['status'] == 'running':
+            if polls <= limited_polls:
+                return (429, b'', {'Retry-After': str(self.retry_after)})
+            if polls - limited_polls > polls_until_ready:
+                self._set_status(run, 'complete')
+        return (200, run)
+
+    def _set_status(self, run, status):
+        run['status'] = status
+        if status == 'complete':
+            run.update(data_ready=True, end_time=run['start_time'], md5sum=self._md5sum)
+        if self.webhook is not None:
+            body = urlencode(dict((k, '' if v is None else str(v).lower() if isinstance(v, bool) else v) for k, v in run.items()))
+            thread = threading.Thread(target=requests.post, args=(self.webhook,),
+                                      kwargs={'data': body, 'headers': {'Content-Type': 'application/x-www-form-urlencoded'}})
+            thread.daemon = True
+            thread.start()
+
+    def finish_run(self, run_token, status='complete'):
+        with self._lock:
+            self._set_status(self.runs[run_token], status)
+
+    def respond(self, method, parts, query):
+        #(status, body, headers) for a request, or None for 404
+        with self._lock:
+            if parts[0] == 'projects':
+                if method == 'GET' and len(parts) == 1:
+                    offset, limit = int(query.get('offset', 0)), int(query.get('limit', 20))
+                    if self.max_page_size is not None:
+                        limit = min(limit, self.max_page_size)
+                    projects = list(self.projects.values())
+                    listing = {'projects': projects[offset:offset + limit]}
+                    if self.total_projects:
+                        listing['total_projects'] = len(projects)
+                    return (200, listing)
+                if len(parts) < 2 or parts[1] not in self.projects:
+                    return None
+                token = parts[1]
+                if method == 'GET' and len(parts) == 2:
+                    project = self._project_jdata(token, int(query.get('offset', 0)))
+                    return (200, project, {'ETag': self._etag(project)})
+                if method == 'POST' and parts[2:] == ['run']:
+                    return (200, self._add_run(token))
+                if method == 'GET' and parts[2:] == ['last_ready_run', 'data']:
+                    return (200, self.datasets[query.get('format', 'json')])
+
+            elif parts[0] == 'runs' and len(parts) >= 2 and parts[1] in self.runs:
+                run_token = parts[1]
+                if method == 'GET' and len(parts) == 2:
+                    return self._poll(run_token)
+                if method == 'GET' and parts[2:] == ['data']:
+                    if not self.runs[run_token]['data_ready']:
+                        return (404, {'error': 'data not ready'})
+                    return (200, self.datasets[query.get('format', 'json')])
+                if method == 'POST' and parts[2:] == ['cancel']:
+                    self._set_status(self.runs[run_token], 'cancelled')
+                    return (200, self.runs[run_token])
+                if method == 'DELETE' and len(parts) == 2:
+                    run = self.runs.pop(run_token)
+                    self._run_order[run['project_token']].remove(run_token)
+                    return (200, {'run_token': run_token})
+        return None
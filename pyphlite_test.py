@@ -1,12 +1,25 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import calendar
+import email.utils
+import gzip
 import hashlib
+import io
+import json
 import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
 import time
 import unittest
 import warnings
-from pyphlite import PhAccount, PhProject, PhRun
+import pyphlite
+import requests
+from pyphlite_standin import ParseHubStandIn, make_records
+from pyphlite import Cassette, DatasetCache, DiffEntry, FanOut, FileRateLimiter, MetadataCache, MetricsCollector, PhAccount, PhProject, PhRun, PhSession, PollPolicy, ProjectIndex, RateLimiter, RunScheduler, WebhookReceiver, endpoint_class, convert_run_data, diff_runs, gunzip_chunks, gzip_chunks, iter_completed_runs, iter_csv_rows, iter_json_records, iter_run_data_records, read_chunks, wait_for_runs
 
 DO_END_TO_END_TEST = True #Run an end-to-end test (with data run in the middle)?
 
@@ -38,6 +51,1156 @@ class Py2and3CompatibleUnitTest(unittest.TestCase):
         if not hasattr(self, 'assertRaisesRegex'): 
             self.assertRaisesRegex = self.assertRaisesRegexp
 
+OFFLINE_API_KEY = '<OFFLINE API KEY>' #never sent anywhere; offline tests only use jdata
+
+offline_project_jdata = {
+    'token': 'tOfflineProject',
+    'title': 'Offline Project',
+    'last_run': {'run_token': 'tOfflineRun2', 'status': 'complete', 'data_ready': True},
+    'last_ready_run': {'run_token': 'tOfflineRun2', 'status': 'complete', 'data_ready': True},
+    'run_list': [
+        {'run_token': 'tOfflineRun2', 'status': 'complete', 'data_ready': True},
+        {'run_token': 'tOfflineRun1', 'status': 'complete', 'data_ready': True},
+    ],
+}
+
+offline_run_jdata = dict(offline_project_jdata['last_run'], project_token='tOfflineProject')
+
+#Starts a ParseHubStandIn with hub_options for every test, with a session on it and a scratch directory
+class StandInTestCase(Py2and3CompatibleUnitTest):
+    hub_options = {'projects': 1, 'runs_per_project': 1, 'rows': 2000} #tProject0 with one ready run, tRun1
+
+    def setUp(self):
+        self.hub = ParseHubStandIn(**self.hub_options).start()
+        self.session = PhSession(OFFLINE_API_KEY, base_url=self.hub.base_url)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.session.close()
+        self.hub.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def started_run(self, **options):
+        #a thin PhRun for a new run of tProject0, options as for ParseHubStandIn.add_run
+        jdata = self.hub.add_run('tProject0', **options)
+        return PhRun(OFFLINE_API_KEY, jdata['run_token'], thin=True, session=self.session)
+
+class TestStreamingOffline(StandInTestCase):
+    def test_iter_data_chunks(self):
+        run = PhRun(OFFLINE_API_KEY, 'tRun1', thin=True, session=self.session)
+        chunks = list(run.iter_data(chunk_size=1024, format='csv'))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(len(c) <= 1024 for c in chunks))
+        self.assertEqual(b''.join(chunks), self.hub.datasets['csv'])
+
+    def test_save_data_to_path_and_file(self):
+        run = PhRun(OFFLINE_API_KEY, 'tRun1', thin=True, session=self.session)
+        path = os.path.join(self.tmpdir, 'data.json')
+        written = run.save_data(path)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.hub.datasets['json'])
+        self.assertEqual(written, len(self.hub.datasets['json']))
+
+        proj = PhProject(OFFLINE_API_KEY, 'tProject0', thin=True, session=self.session)
+        buf = io.BytesIO()
+        proj.save_last_ready_data(buf, chunk_size=100, format='csv')
+        self.assertEqual(buf.getvalue().decode('utf-8'), proj.get_last_ready_data(format='csv'))
+
+class TestJsonRecordsOffline(StandInTestCase):
+    def chunked(self, text, size):
+        data = text.encode('utf-8')
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def test_iter_json_records_chunk_boundaries(self):
+        text = ('{"url": "http://x", "count": 12345, "empty": [], "movies": [{"title": "Caf\u00e9 \u2603", "year": 1994,'
+                ' "cast": [{"name": "A"}, {"name": "B"}]}, {"title": "Two", "year": 2001.5}, 7], "after": {"x": [1]}}')
+        expected = json.loads(text)['movies']
+        for size in (1, 2, 3, 7, 64, 4096):
+            self.assertEqual(list(iter_json_records(self.chunked(text, size), base_list='movies')), expected)
+        self.assertEqual(list(iter_json_records(self.chunked(text, 5))), [])
+        self.assertEqual(list(iter_json_records(self.chunked('{}', 1))), [])
+        with self.assertRaises(KeyError):
+            list(iter_json_records(self.chunked(text, 5), base_list='missing'))
+
+    def test_numbers_across_chunk_boundaries(self):
+        text = ('{"count": 2001.5, "scale": -2e5, "movies": [2001.5, 2e5, -1.25E-3, 0, {"rating": 7.75e+1}, 10], '
+                '"after": 3.5e2}')
+        expected = json.loads(text)['movies']
+        data = text.encode('utf-8')
+        for i in range(1, len(data)): #every split position
+            self.assertEqual(list(iter_json_records([data[:i], data[i:]], base_list='movies')), expected)
+        for size in (1, 2, 7):
+            self.assertEqual(list(iter_json_records(self.chunked(text, size), base_list='movies')), expected)
+        self.assertEqual(list(iter_json_records(self.chunked('{"ids": [1, 22, 333]}', 1))), [1, 22, 333])
+
+    def test_iter_records(self):
+        expected = make_records(2000)
+        run = PhRun(OFFLINE_API_KEY, 'tRun1', thin=True, session=self.session)
+        self.assertEqual(list(run.iter_records(chunk_size=512)), expected)
+
+        proj = PhProject(OFFLINE_API_KEY, 'tProject0', thin=True, session=self.session)
+        records = proj.iter_last_ready_records(base_list='movies')
+        self.assertEqual(next(records), expected[0])
+        records.close()
+
+class TestCsvRowsOffline(StandInTestCase):
+    def test_iter_csv_rows_chunk_boundaries(self):
+        text = '\ufefftitle,plot\r\n"Caf\u00e9","multi\r\nline, ""quoted"""\r\nlast,\u2603\r\n'
+        data = text.encode('utf-8')
+        for size in (1, 2, 5, 1024):
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            self.assertEqual(list(iter_csv_rows(chunks)), [
+                ('title', 'plot'),
+                ('Caf\u00e9', 'multi\r\nline, "quoted"'),
+                ('last', '\u2603'),
+            ])
+            self.assertEqual(list(iter_csv_rows(chunks, as_dict=True))[0]['plot'], 'multi\r\nline, "quoted"')
+
+    def test_iter_csv_rows(self):
+        run = PhRun(OFFLINE_API_KEY, 'tRun1', thin=True, session=self.session)
+        rows = list(run.iter_csv_rows(as_dict=True, chunk_size=100))
+        self.assertEqual(len(rows), 2000)
+        self.assertEqual(rows[7], {'movies_title': 'Movie 7', 'movies_plot': 'Plot, "quoted"\nline 7', 'movies_year': '1907',
+                                   'movies_rating': '0.7'})
+
+        proj = PhProject(OFFLINE_API_KEY, 'tProject0', thin=True, session=self.session)
+        rows = list(proj.iter_last_ready_csv_rows())
+        self.assertEqual(rows[0], ('movies_title', 'movies_plot', 'movies_year', 'movies_rating'))
+        self.assertEqual(len(rows), 2001)
+
+class TestWaitForRunsOffline(StandInTestCase):
+    def pending_runs(self, *polls):
+        #runs that are ready after that many polls each
+        return [self.started_run(polls_until_ready=p) for p in polls]
+
+    def test_completion_order(self):
+        runs = self.pending_runs(3, 0, 1)
+        done = list(iter_completed_runs(runs, wait_increment=0.01, wait_timeout=5))
+        self.assertEqual(done, [runs[1], runs[2], runs[0]])
+        self.assertEqual([r._update_count for r in runs], [4, 1, 2])
+
+    def test_wait_for_runs(self):
+        runs = self.pending_runs(2, 1)
+        self.assertEqual(wait_for_runs(runs, wait_increment=0.01), runs)
+        self.assertTrue(all(r.data_ready for r in runs))
+
+        #already finished runs are not polled again
+        wait_for_runs(runs, wait_increment=0.01)
+        self.assertEqual(len(self.hub.requests), 5)
+
+    def test_timeout(self):
+        with self.assertRaisesRegex(Exception, 'Timed out waiting for 1 run.*'):
+            wait_for_runs(self.pending_runs(99), wait_increment=0.01, wait_timeout=0.1)
+
+    def test_update_limit(self):
+        run, = self.pending_runs(1)
+        run._update_count = pyphlite.RUN_UPDATE_FREE_LIMIT - 1
+        start = time.time()
+        wait_for_runs([run], poll_policy=PollPolicy(interval=0.01, limited_interval=0.3))
+        self.assertTrue(time.time() - start >= 0.3)
+
+class TestPollPolicyOffline(StandInTestCase):
+    def test_delays(self):
+        policy = PollPolicy(interval=1, backoff=2, max_interval=5)
+        self.assertEqual([policy.next_delay(a) for a in range(5)], [1, 2, 4, 5, 5])
+        policy = PollPolicy(interval=10, jitter=0.5)
+        self.assertTrue(all(5 <= policy.next_delay(0) <= 15 for i in range(100)))
+        policy = PollPolicy(interval=1, limited_interval=100)
+        self.assertTrue(policy.next_delay(0, update_count=25, last_update_time=time.time()) > 99)
+        self.assertEqual(policy.next_delay(0, update_count=24, last_update_time=time.time()), 1)
+
+    def test_retry_after(self):
+        class FakeResponse(object):
+            def __init__(self, headers):
+                self.headers = headers
+        policy = PollPolicy(limited_interval=180, max_429_retries=2)
+        self.assertEqual(policy.retry_after(FakeResponse({'Retry-After': '7'}), 0), 7)
+        self.assertEqual(policy.retry_after(FakeResponse({}), 1), 180)
+        self.assertEqual(policy.retry_after(FakeResponse({}), 2), None)
+        retry_date = email.utils.formatdate(time.time() + 60, usegmt=True)
+        self.assertTrue(55 < policy.retry_after(FakeResponse({'Retry-After': retry_date}), 0) <= 60)
+
+    def test_429_is_waited_out(self):
+        run = self.started_run(limited_polls=2, polls_until_ready=0)
+        run.update(poll_policy=PollPolicy(max_429_retries=2))
+        self.assertEqual(run.status, 'complete')
+        self.assertEqual(run._update_count, 3)
+
+        run = self.started_run(limited_polls=2, polls_until_ready=0)
+        with self.assertRaisesRegex(Exception, '429.*'):
+            run.update(poll_policy=PollPolicy(max_429_retries=1))
+
+        #one-shot updates without a PollPolicy do not wait 429s out
+        run = self.started_run(limited_polls=1, polls_until_ready=0)
+        with self.assertRaisesRegex(Exception, '429.*'):
+            run.update()
+        self.assertEqual(run._update_count, 1)
+
+    def test_wait_until_ready_with_backoff(self):
+        run = self.started_run(polls_until_ready=3)
+        run.wait_until_ready(poll_policy=PollPolicy(interval=0.01, backoff=2, jitter=0.1, timeout=5))
+        self.assertTrue(run.data_ready)
+        self.assertEqual(run._update_count, 4)
+
+    def test_wall_clock_timeout(self):
+        run = self.started_run(polls_until_ready=99)
+        start = time.time()
+        with self.assertRaisesRegex(Exception, 'Timed out waiting for data.*'):
+            run.wait_until_ready(wait_increment=0.05, wait_timeout=0.2)
+        self.assertTrue(time.time() - start < 1)
+
+class TestRateLimitOffline(StandInTestCase):
+    def test_token_bucket(self):
+        limiter = RateLimiter(20, burst=2)
+        self.assertEqual([limiter.reserve() for i in range(2)], [0, 0])
+        self.assertAlmostEqual(limiter.reserve(), 0.05, places=2)
+        self.assertAlmostEqual(limiter.reserve(), 0.10, places=2)
+
+    def test_file_bucket_is_shared(self):
+        path = os.path.join(self.tmpdir, 'shared.bucket')
+        first, second = FileRateLimiter(path, 1, burst=1), FileRateLimiter(path, 1, burst=1)
+        self.assertEqual(first.reserve(), 0)
+        self.assertAlmostEqual(second.reserve(), 1.0, places=1)
+        self.assertAlmostEqual(first.reserve(), 2.0, places=1)
+
+        limiter = FileRateLimiter.for_api_key(OFFLINE_API_KEY, '*', 1, directory=self.tmpdir)
+        self.assertEqual(limiter.path, FileRateLimiter.for_api_key(OFFLINE_API_KEY, '*', 1, directory=self.tmpdir).path)
+        self.assertNotIn(OFFLINE_API_KEY, limiter.path)
+
+    def test_endpoint_classes(self):
+        self.assertEqual(endpoint_class('GET', '/runs/tRun'), 'status')
+        self.assertEqual(endpoint_class('GET', '/runs/tRun/data'), 'data')
+        self.assertEqual(endpoint_class('GET', '/projects/tProject/last_ready_run/data'), 'data')
+        self.assertEqual(endpoint_class('POST', '/projects/tProject/run'), 'run')
+        self.assertEqual(endpoint_class('GET', '/projects'), 'other')
+
+    def test_session_throttles_requests(self):
+        self.session.rate_limits = {'data': RateLimiter(20, burst=1), '*': RateLimiter(1000)}
+        run = PhRun(OFFLINE_API_KEY, 'tRun1', session=self.session)
+        start = time.time()
+        for i in range(3):
+            run.get_data(blocking=False, format='csv')
+        self.assertTrue(time.time() - start >= 0.1)
+
+class TestMetadataCacheOffline(StandInTestCase):
+    hub_options = {'projects': 1, 'runs_per_project': 1, 'polls_until_ready': 0}
+
+    def test_ttl_hits(self):
+        self.session.cache = MetadataCache(ttl=60)
+        for i in range(3):
+            proj = PhProject(OFFLINE_API_KEY, 'tProject0', session=self.session)
+            self.assertEqual(proj.title, 'Project 0')
+        self.assertEqual(self.hub.requests, [('GET', '/projects/tProject0')])
+
+    def test_conditional_revalidation(self):
+        self.session.cache = MetadataCache(ttl=0)
+        proj = PhProject(OFFLINE_API_KEY, 'tProject0', session=self.session)
+        proj.update()
+        self.assertEqual(proj.title, 'Project 0')
+        self.assertEqual(len(self.hub.requests), 2)
+
+    def test_lru_eviction(self):
+        self.session.cache = MetadataCache(ttl=60, max_entries=1)
+        PhProject(OFFLINE_API_KEY, 'tProject0', session=self.session)
+        PhAccount(OFFLINE_API_KEY, session=self.session)
+        PhProject(OFFLINE_API_KEY, 'tProject0', session=self.session)
+        self.assertEqual(len(self.hub.requests), 3)
+        self.assertEqual(len(self.session.cache), 1)
+
+    def test_per_account_copies(self):
+        self.session.cache = MetadataCache(ttl=60)
+        proj = PhProject(OFFLINE_API_KEY, 'tProject0', session=self.session)
+        proj._jdata['title'] = 'Changed'
+        self.assertEqual(PhProject(OFFLINE_API_KEY, 'tProject0', session=self.session).title, 'Project 0')
+        self.assertEqual(len(self.hub.requests), 1)
+
+        #another account never gets this one's responses
+        PhProject('<OTHER API KEY>', 'tProject0', session=self.session)
+        self.assertEqual(len(self.hub.requests), 2)
+
+    def test_invalidation_and_polling(self):
+        self.session.cache = MetadataCache(ttl=60)
+        proj = PhProject(OFFLINE_API_KEY, 'tProject0', session=self.session)
+        PhAccount(OFFLINE_API_KEY, session=self.session)
+        run = proj.run()
+        self.assertEqual(len(self.session.cache), 0)
+        proj.update()
+        self.assertEqual(self.hub.requests.count(('GET', '/projects/tProject0')), 2)
+
+        #waiting for a run always goes to the server
+        for i in range(2):
+            run.wait_until_ready()
+        self.assertEqual(self.hub.requests.count(('GET', '/runs/%s' % run.run_token)), 2)
+
+class TestDatasetCacheOffline(StandInTestCase):
+    def setUp(self):
+        super(TestDatasetCacheOffline, self).setUp()
+        self.session.dataset_cache = DatasetCache(os.path.join(self.tmpdir, 'datasets'))
+
+    def test_downloaded_once(self):
+        run = PhRun(OFFLINE_API_KEY, 'tRun1', thin=True, session=self.session)
+        self.assertEqual(run.get_data(format='csv'), self.hub.datasets['csv'].decode('utf-8'))
+        requests_after_download = len(self.hub.requests)
+        self.assertEqual(run.get_data(format='csv'), self.hub.datasets['csv'].decode('utf-8'))
+        self.assertEqual(b''.join(run.iter_data(chunk_size=100, format='csv')), self.hub.datasets['csv'])
+        self.assertEqual(len(list(run.iter_records())), 2000)
+        self.assertEqual(len(self.hub.requests), requests_after_download + 2) #only the json download + its status check
+
+        #another job on the same host (new session, same directory) reuses the files
+        other_session = PhSession(OFFLINE_API_KEY, base_url=self.session.base_url,
+                                  dataset_cache=DatasetCache(self.session.dataset_cache.directory))
+        proj = PhProject(OFFLINE_API_KEY, 'tProject0', thin=True, session=other_session)
+        self.assertEqual(proj.get_last_ready_data(format='csv'), self.hub.datasets['csv'].decode('utf-8'))
+        self.assertEqual(self.hub.requests[-1], ('GET', '/projects/tProject0'))
+        other_session.close()
+
+    def test_abandoned_download_is_not_cached(self):
+        run = PhRun(OFFLINE_API_KEY, 'tRun1', thin=True, session=self.session)
+        chunks = run.iter_data(chunk_size=100)
+        next(chunks)
+        chunks.close()
+        self.assertEqual(os.listdir(self.session.dataset_cache.directory), [])
+        self.assertFalse(self.session.dataset_cache.contains('tRun1'))
+
+    def test_lru_eviction(self):
+        cache = self.session.dataset_cache
+        cache.max_bytes = len(self.hub.datasets['json']) + len(self.hub.datasets['csv']) - 1
+        run = PhRun(OFFLINE_API_KEY, 'tRun1', thin=True, session=self.session)
+        run.get_data(format='json')
+        os.utime(cache.path('tRun1', 'json'), (time.time() - 60, time.time() - 60))
+        run.get_data(format='csv')
+        self.assertFalse(cache.contains('tRun1', 'json'))
+        self.assertTrue(cache.contains('tRun1', 'csv'))
+        self.assertEqual(cache.read('tRun1', 'csv'), self.hub.datasets['csv'])
+
+def split_chunks(data, size=1000):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def convert(data, from_format, to_format, **kwargs):
+    return b''.join(convert_run_data(split_chunks(data), from_format, to_format, **kwargs))
+
+class TestConvertOffline(StandInTestCase):
+    def test_round_trips(self):
+        json_data, csv_data = self.hub.datasets['json'], self.hub.datasets['csv']
+        self.assertEqual(convert(json_data, 'json', 'csv'), csv_data) #ParseHub's own CSV layout
+        self.assertEqual(convert(csv_data, 'csv', 'json'), json_data)
+        for output_format in ('ndjson', 'phb'):
+            data = convert(json_data, 'json', output_format)
+            self.assertEqual(convert(data, output_format, 'json', base_list='movies'), json_data)
+            self.assertEqual(convert(data, output_format, 'csv', base_list='movies'), csv_data)
+        self.assertEqual(convert(json_data, 'json', 'ndjson').count(b'\n'), 2000)
+        self.assertTrue(len(convert(json_data, 'json', 'phb')) < len(json_data) * 2 / 3)
+        self.assertEqual(convert(b'{}', 'json', 'phb'), b'PHB1\x00')
+        self.assertRaises(ValueError, convert_run_data, [json_data], 'json', 'xml')
+
+    def test_nested_values(self):
+        records = [{'title': 'A', 'cast': [{'name': 'X', 'age': 30}, {'name': 'Y'}], 'info': {'color': True, 'note': None},
+                    'rating': 1.5, 'rank': -7, 'big': 2 ** 70, 'text': 'Ünïcode, "quoted"\nlines'}, {'title': 'B'}]
+        data = json.dumps({'url': 'http://www.example.com', 'movies': records}).encode('utf-8')
+        self.assertEqual(list(iter_run_data_records(split_chunks(convert(data, 'json', 'phb'), 7), 'phb')), records)
+        self.assertEqual(list(iter_run_data_records(convert(data, 'json', 'ndjson').splitlines(True), 'ndjson')), records)
+        self.assertEqual(convert(data, 'json', 'csv').decode('utf-8'),
+                         'movies_title,movies_cast_name,movies_cast_age,movies_info_color,movies_info_note,movies_rating,'
+                         'movies_rank,movies_big,movies_text\n'
+                         'A,X,30,true,,1.5,-7,1180591620717411303424,"Ünïcode, ""quoted""\nlines"\n'
+                         ',Y,,,,,,,\n'
+                         'B,,,,,,,,\n')
+        self.assertEqual(list(iter_run_data_records([convert(data, 'json', 'csv')], 'csv'))[1], {'cast_name': 'Y'})
+
+    def test_local_formats(self):
+        run = PhRun(OFFLINE_API_KEY, 'tRun1', thin=True, session=self.session)
+        ndjson = run.get_data(format='ndjson')
+        self.assertEqual(json.loads(ndjson.splitlines()[5]), make_records(6)[5])
+        self.assertEqual(convert(run.get_data(format='phb'), 'phb', 'json', base_list='movies'), self.hub.datasets['json'])
+        proj = PhProject(OFFLINE_API_KEY, 'tProject0', thin=True, session=self.session)
+        self.assertEqual(proj.get_last_ready_data(format='ndjson'), ndjson)
+        self.assertNotIn('ndjson', ''.join(path for method, path in self.hub.requests))
+
+    def test_cache_converts(self):
+        self.session.dataset_cache = DatasetCache(os.path.join(self.tmpdir, 'datasets'), convert=True)
+        run = PhRun(OFFLINE_API_KEY, 'tRun1', thin=True, session=self.session)
+        self.assertEqual(run.get_data(format='csv'), self.hub.datasets['csv'].decode('utf-8'))
+        self.assertEqual(run.get_data(format='json'), self.hub.datasets['json'].decode('utf-8'))
+        run.get_data(format='phb')
+        self.assertEqual(self.hub.requests.count(('GET', '/runs/tRun1/data')), 1) #one download for every format
+        self.assertTrue(self.session.dataset_cache.contains('tRun1', 'phb'))
+
+class TestProjectListOffline(StandInTestCase):
+    hub_options = {'projects': 45, 'runs_per_project': 0}
+
+    def test_lazy_paging(self):
+        acct = PhAccount(OFFLINE_API_KEY, session=self.session, page_size=20)
+        self.assertEqual(len(self.hub.requests), 1)
+        self.assertEqual(len(acct.projects), 45)
+        self.assertEqual(len(acct.projects._projects), 0)
+
+        self.assertEqual(acct.projects[-1].token, 'tProject44')
+        self.assertEqual(len(self.hub.requests), 2)
+        self.assertEqual(len(acct.projects._projects), 1)
+
+        self.assertEqual([p.token for p in acct.projects[19:22]], ['tProject19', 'tProject20', 'tProject21'])
+        self.assertEqual(len(self.hub.requests), 3)
+        self.assertIs(acct.projects[0], acct.projects[0])
+        with self.assertRaises(IndexError):
+            acct.projects[45]
+
+    def test_early_termination(self):
+        acct = PhAccount(OFFLINE_API_KEY, session=self.session, page_size=10)
+        for i, proj in enumerate(acct.projects):
+            if proj.token == 'tProject12':
+                break
+        self.assertEqual(i, 12)
+        self.assertEqual(len(self.hub.requests), 2)
+        self.assertEqual(len(acct.projects._projects), 13)
+
+    def test_full_iteration(self):
+        acct = PhAccount(OFFLINE_API_KEY, session=self.session, page_size=7)
+        self.assertEqual([p.token for p in acct.projects], list(self.hub.projects))
+        self.assertEqual(len(self.hub.requests), 7)
+
+    def test_capped_pages_without_total(self):
+        with ParseHubStandIn(projects=45, runs_per_project=0, max_page_size=15, total_projects=False) as hub:
+            session = PhSession(OFFLINE_API_KEY, base_url=hub.base_url)
+            acct = PhAccount(OFFLINE_API_KEY, session=session, page_size=20)
+            self.assertEqual(acct.projects[30].token, 'tProject30') #loaded before the page in between
+            self.assertEqual(len(acct.projects), 45)
+            self.assertEqual([p.token for p in acct.projects], list(hub.projects))
+            self.assertRaises(IndexError, acct.projects.__getitem__, 45)
+            session.close()
+
+class TestIterRunsOffline(StandInTestCase):
+    hub_options = {'projects': 1, 'runs_per_project': 0, 'run_page_size': 5}
+
+    def setUp(self):
+        super(TestIterRunsOffline, self).setUp()
+        #23 runs, newest first, one started per day; every third run errored
+        self.history = [
+            self.hub.add_run('tProject0', status='error' if i % 3 == 0 else 'complete',
+                             start_time='2016-04-%02dT12:00:00' % (30 - i))
+            for i in reversed(range(23))
+        ]
+        self.history.reverse()
+        self.proj = PhProject(OFFLINE_API_KEY, 'tProject0', thin=True, session=self.session)
+
+    def test_full_history(self):
+        for prefetch in (True, False):
+            runs = list(self.proj.iter_runs(prefetch=prefetch))
+            self.assertEqual([r.run_token for r in runs], [r['run_token'] for r in self.history])
+            self.assertTrue(all(isinstance(r, PhRun) and r._session is self.session for r in runs))
+        self.assertEqual(self.hub.requests.count(('GET', '/projects/tProject0')), 2 * 6)
+
+    def test_filters(self):
+        complete = list(self.proj.iter_runs(status='complete'))
+        self.assertEqual(len(complete), 15)
+        self.assertTrue(all(r.status == 'complete' for r in complete))
+
+        since = [r.run_token for r in self.proj.iter_runs(since='2016-04-25T00:00:00')]
+        self.assertEqual(since, [r['run_token'] for r in self.history[:6]])
+
+        errors = self.proj.iter_runs(where=lambda run: run['status'] == 'error',
+                                     until=lambda run: run['run_token'] == self.history[10]['run_token'])
+        self.assertEqual([r.run_token for r in errors], [self.history[i]['run_token'] for i in (0, 3, 6, 9)])
+
+    def test_early_stop_bounds_requests(self):
+        for run in self.proj.iter_runs(prefetch=False):
+            if run.run_token == self.history[7]['run_token']:
+                break
+        self.assertEqual(self.hub.requests.count(('GET', '/projects/tProject0')), 2)
+
+class TestObjectModelOffline(Py2and3CompatibleUnitTest):
+    def setUp(self):
+        self.session = PhSession(OFFLINE_API_KEY)
+
+    def test_slotted_fields(self):
+        run = PhRun(OFFLINE_API_KEY, 'tOfflineRun2', jdata=dict(offline_run_jdata, pages=12, custom_key='x'), session=self.session)
+        self.assertFalse(hasattr(run, '__dict__'))
+        self.assertEqual((run.run_token, run.status, run.data_ready, run.pages), ('tOfflineRun2', 'complete', True, 12))
+        self.assertEqual(run.custom_key, 'x') #unknown keys are still reachable
+        with self.assertRaises(AttributeError):
+            run.end_time
+        with self.assertRaises(AttributeError):
+            run.not_a_key
+        with self.assertRaises(AttributeError):
+            run.undefined = 1
+
+        run.update(jdata=dict(offline_run_jdata, status='cancelled'))
+        self.assertEqual(run.status, 'cancelled')
+
+    def test_thin_objects(self):
+        proj = PhProject(OFFLINE_API_KEY, 'tOfflineProject', thin=True, session=self.session)
+        for name in ('title', 'unknown_key'):
+            with self.assertRaisesRegex(Warning, 'Attempted to access.*'):
+                getattr(proj, name)
+        self.assertIn('tOfflineProject', repr(proj))
+
+        proj.update(jdata=offline_project_jdata)
+        self.assertEqual(proj.title, 'Offline Project')
+        self.assertIn('title="Offline Project"', repr(proj))
+        self.assertEqual([r.run_token for r in proj.run_list], ['tOfflineRun2', 'tOfflineRun1'])
+
+class RecordingInstrument(object):
+    def __init__(self):
+        self.calls = []
+
+    def before_request(self, event):
+        self.calls.append(('before_request', dict(event)))
+
+    def after_request(self, event):
+        self.calls.append(('after_request', dict(event)))
+
+    def after_parse(self, event):
+        self.calls.append(('after_parse', dict(event)))
+
+class Unprintable(object):
+    def __repr__(self):
+        raise AssertionError('formatted a log message that is not enabled')
+
+class TestInstrumentationOffline(StandInTestCase):
+    def setUp(self):
+        super(TestInstrumentationOffline, self).setUp()
+        self.recorder, self.metrics = RecordingInstrument(), MetricsCollector()
+        self.session.instruments = [self.recorder, self.metrics]
+
+    def test_request_events(self):
+        PhProject(OFFLINE_API_KEY, 'tProject0', session=self.session)
+        self.assertEqual([hook for hook, event in self.recorder.calls], ['before_request', 'after_request', 'after_parse'])
+
+        before, after, parsed = [event for hook, event in self.recorder.calls]
+        self.assertEqual((before['endpoint'], before['project_token'], before['run_token']),
+                         ('GET /projects/{project_token}', 'tProject0', None))
+        self.assertEqual(before['status_code'], None)
+        self.assertEqual((after['status_code'], after['error'], after['from_cache'], after['retries']), (200, None, False, 0))
+        self.assertEqual(after['bytes'], len(requests.get(self.hub.base_url + '/projects/tProject0').content))
+        self.assertTrue(after['connect'] > 0) #the session's first connection
+        self.assertTrue(0 < after['ttfb'] <= after['total'])
+        self.assertTrue(parsed['parse'] >= 0)
+
+    def test_retries_and_errors(self):
+        run_token = self.hub.add_run('tProject0', limited_polls=2, polls_until_ready=0)['run_token']
+        PhRun(OFFLINE_API_KEY, run_token, thin=True, session=self.session,
+              poll_policy=PollPolicy(interval=0.01)).wait_until_ready()
+        after = [event for hook, event in self.recorder.calls if hook == 'after_request']
+        self.assertEqual([(e['status_code'], e['retries'], e['endpoint']) for e in after],
+                         [(429, 0, 'GET /runs/{run_token}'), (429, 1, 'GET /runs/{run_token}'), (200, 2, 'GET /runs/{run_token}')])
+
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        self.session.base_url = 'http://127.0.0.1:%s' % closed.getsockname()[1]
+        closed.close()
+        with self.assertRaises(Exception):
+            self.session.get('/projects')
+        self.assertIsInstance(self.recorder.calls[-1][1]['error'], Exception)
+        self.assertEqual(self.recorder.calls[-1][1]['status_code'], None)
+
+    def test_metrics_collector(self):
+        for i in range(3):
+            PhProject(OFFLINE_API_KEY, 'tProject0', session=self.session)
+        PhRun(OFFLINE_API_KEY, 'tRun1', session=self.session)
+
+        dump = self.metrics.dump()
+        counters = dict(((c['name'], tuple(sorted(c['labels'].items()))), c['value']) for c in dump['counters'])
+        self.assertEqual(counters[('requests', (('endpoint', 'GET /projects/{project_token}'), ('status', '200')))], 3)
+        self.assertEqual(counters[('requests', (('endpoint', 'GET /runs/{run_token}'), ('status', '200')))], 1)
+        self.assertEqual(counters[('project_requests', (('project_token', 'tProject0'),))], 3)
+        totals = [h for h in dump['histograms'] if h['name'] == 'total_seconds']
+        self.assertEqual(sorted(h['count'] for h in totals), [1, 3])
+        self.assertEqual(len(totals[0]['counts']), len(MetricsCollector.LATENCY_BUCKETS) + 1)
+
+        text = self.metrics.prometheus_text()
+        self.assertIn('# TYPE pyphlite_requests_total counter\n', text)
+        self.assertIn('pyphlite_requests_total{endpoint="GET /projects/{project_token}",status="200"} 3\n', text)
+        self.assertIn('pyphlite_total_seconds_bucket{endpoint="GET /projects/{project_token}",le="+Inf"} 3\n', text)
+        self.assertIn('pyphlite_parse_seconds_count{endpoint="GET /runs/{run_token}"} 1\n', text)
+
+        self.metrics.reset()
+        self.assertEqual(self.metrics.dump(), {'counters': [], 'histograms': []})
+
+    def test_lazy_logging(self):
+        #arguments are only formatted when the level is enabled
+        PhRun(OFFLINE_API_KEY, 'tRun1', thin=True, session=self.session, unprintable=Unprintable())
+
+class TestStandInOffline(StandInTestCase):
+    hub_options = {'projects': 25, 'runs_per_project': 22, 'rows': 50, 'polls_until_ready': 2, 'limited_polls': 1,
+                   'api_key': OFFLINE_API_KEY}
+
+    def test_listing_and_hydration(self):
+        acct = PhAccount(OFFLINE_API_KEY, session=self.session)
+        self.assertEqual(len(acct.projects), 25)
+        proj = PhProject(OFFLINE_API_KEY, acct.projects[24].token, session=self.session)
+        self.assertEqual(proj.title, 'Project 24')
+        self.assertEqual(len(proj.run_list), 20)
+        self.assertEqual(len(list(proj.iter_runs())), 22)
+        self.assertEqual(proj.last_ready_run.run_token, proj.run_list[0].run_token)
+
+        with self.assertRaises(Exception):
+            PhAccount('<WRONG API KEY>', session=PhSession('<WRONG API KEY>', base_url=self.hub.base_url))
+
+    def test_run_lifecycle(self):
+        proj = PhProject(OFFLINE_API_KEY, 'tProject0', thin=True, session=self.session)
+        run = proj.run()
+        self.assertEqual(run.status, 'running')
+        run.wait_until_ready(poll_policy=PollPolicy(interval=0.01))
+        self.assertEqual(run._update_count, 4) #one 429, two not ready, then ready
+        self.assertEqual([r['title'] for r in run.iter_records()], ['Movie %s' % i for i in range(50)])
+        self.assertEqual(list(run.iter_csv_rows(as_dict=True))[1]['movies_plot'], 'Plot, "quoted"\nline 1')
+        self.assertEqual(run.md5sum, hashlib.md5(self.hub.datasets['json']).hexdigest())
+
+        self.assertEqual(run.cancel()['status'], 'cancelled')
+        run.delete()
+        self.assertNotIn(run.run_token, self.hub.runs)
+        self.assertIn(('DELETE', '/runs/%s' % run.run_token), self.hub.requests)
+
+class TestCassetteOffline(Py2and3CompatibleUnitTest):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def scenario(self, session, poll_policy):
+        proj = PhAccount(OFFLINE_API_KEY, session=session).projects[1]
+        proj.update()
+        run = proj.run()
+        run.wait_until_ready(poll_policy=poll_policy)
+        return {
+            'run_list': [r.run_token for r in proj.run_list],
+            'polls': run._update_count,
+            'records': list(run.iter_records()),
+            'csv': run.get_data(format='csv'),
+            'cancelled': run.cancel()['status'],
+            'deleted': run.delete(),
+        }
+
+    def test_record_and_replay(self):
+        path = os.path.join(self.tmpdir, 'cassette.json.gz')
+        with ParseHubStandIn(rows=20, polls_until_ready=2, limited_polls=1, api_key=OFFLINE_API_KEY) as hub:
+            cassette = Cassette(path)
+            self.assertEqual(cassette.mode, 'record')
+            session = PhSession(OFFLINE_API_KEY, base_url=hub.base_url, cassette=cassette)
+            recorded = self.scenario(session, PollPolicy(interval=0.05))
+            session.close()
+            base_url = hub.base_url
+
+        with gzip.open(path, 'rb') as f:
+            self.assertNotIn(b'OFFLINE API KEY', f.read())
+
+        cassette = Cassette(path)
+        self.assertEqual(cassette.mode, 'replay')
+        session = PhSession(OFFLINE_API_KEY, base_url=base_url, cassette=cassette) #server is gone
+        start = time.time()
+        replayed = self.scenario(session, PollPolicy(interval=30, timeout=600))
+        self.assertTrue(time.time() - start < 5) #waits are skipped
+        self.assertTrue(session.time() - time.time() > 59) #two 30s polling waits, skipped
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(replayed['polls'], 4)
+
+        with self.assertRaisesRegex(Exception, 'no recorded response'):
+            session.get('/projects/tUnknown', params={'api_key': OFFLINE_API_KEY})
+
+    def test_scrubbing_and_matching(self):
+        path = os.path.join(self.tmpdir, 'cassette.json')
+        cassette = Cassette(path, mode='record')
+        url = 'http://127.0.0.1/api/v2/runs/tRun?format=csv&api_key=%s' % OFFLINE_API_KEY
+        for status in ('running', 'complete'):
+            cassette.record('GET', url, 200, 'OK', {'ETag': OFFLINE_API_KEY, 'Content-Length': '1'},
+                            json.dumps({'status': status, 'key': OFFLINE_API_KEY}).encode('utf-8'), OFFLINE_API_KEY)
+        cassette.save()
+        with open(path, 'rb') as f:
+            self.assertNotIn(OFFLINE_API_KEY.encode('utf-8'), f.read())
+
+        cassette = Cassette(path, mode='replay')
+        other_url = 'https://example.com/api/v2/runs/tRun?api_key=other&format=csv'
+        statuses = [json.loads(cassette.play('GET', other_url)[3].decode('utf-8'))['status'] for i in range(3)]
+        self.assertEqual(statuses, ['running', 'complete', 'complete'])
+        self.assertEqual(cassette.play('GET', other_url)[2], {'ETag': '<API_KEY>'})
+
+class TestFanOutOffline(StandInTestCase):
+    hub_options = {'projects': 8, 'rows': 20, 'latency': 0.2, 'polls_until_ready': 1}
+
+    def setUp(self):
+        super(TestFanOutOffline, self).setUp()
+        self.acct = PhAccount(OFFLINE_API_KEY, thin=True, session=self.session)
+        self.tokens = list(self.hub.projects)
+
+    def test_run_then_fetch(self):
+        start = time.time()
+        runs = [r.value for r in self.acct.run_projects(self.tokens)]
+        self.assertTrue(time.time() - start < 8 * 0.2) #not one after the other
+        self.assertEqual([r.project_token for r in runs], self.tokens)
+
+        results = list(self.acct.get_data_for_runs(runs, poll_policy=PollPolicy(interval=0.01)))
+        self.assertTrue(all(r.error is None and json.loads(r.value)['movies'][0]['title'] == 'Movie 0' for r in results))
+
+        data = self.acct.get_last_ready_data_for_projects(self.tokens, max_workers=2, ordered=False, format='csv')
+        self.assertEqual(sorted(r.item for r in data), sorted(self.tokens))
+
+    def test_errors_and_order(self):
+        results = list(self.acct.get_projects(['tProject1', 'tMissing', 'tProject0'], max_workers=3))
+        self.assertEqual([r.item for r in results], ['tProject1', 'tMissing', 'tProject0'])
+        self.assertEqual([r.index for r in results], [0, 1, 2])
+        self.assertEqual(results[0].value.title, 'Project 1')
+        self.assertEqual(results[1].value, None)
+        self.assertIn('404', str(results[1].error))
+
+    def test_cancel(self):
+        fan_out = FanOut(lambda i: time.sleep(0.05) or i, range(20), max_workers=2, ordered=False)
+        for result in fan_out:
+            break
+        results = list(FanOut(lambda i: i * 2, range(50), max_workers=4))
+        self.assertEqual([r.value for r in results], [i * 2 for i in range(50)])
+
+        fan_out = FanOut(lambda i: time.sleep(0.05) or i, range(10), max_workers=1)
+        fan_out.cancel()
+        results = list(fan_out)
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(r.error is not None for r in results[1:]))
+
+    def test_iterating_again(self):
+        fan_out = self.acct.get_projects(self.tokens[:3])
+        results = list(fan_out)
+        self.assertEqual(list(fan_out), results)
+        self.assertEqual(self.hub.requests.count(('GET', '/projects/tProject0')), 1)
+
+        fan_out = FanOut(lambda i: i, range(10), max_workers=2, ordered=False)
+        for result in fan_out:
+            break
+        self.assertEqual(sorted(r.index for r in fan_out), list(range(10))) #the rest, run or cancelled
+
+    def test_rate_limits_hold(self):
+        self.hub.latency = 0
+        self.session.rate_limits = {'run': RateLimiter(20, burst=1)}
+        start = time.time()
+        list(self.acct.run_projects(self.tokens))
+        self.assertTrue(time.time() - start >= 7 / 20.0 - 0.01)
+
+class TestCompressionOffline(StandInTestCase):
+    hub_options = {'projects': 1, 'rows': 2000, 'gzip': True}
+
+    def setUp(self):
+        super(TestCompressionOffline, self).setUp()
+        self.metrics = MetricsCollector()
+        self.session.instruments = [self.metrics]
+        self.run = PhRun(OFFLINE_API_KEY, list(self.hub.runs)[0], session=self.session)
+
+    def data_bytes(self):
+        return sum(c['value'] for c in self.metrics.dump()['counters'] if c['name'] == 'bytes' and 'data' in c['labels']['endpoint'])
+
+    def test_gzip_transfer(self):
+        self.assertEqual(self.run.get_data(format='csv').encode('utf-8'), self.hub.datasets['csv'])
+        self.assertEqual(len(list(self.run.iter_records())), 2000)
+        self.assertEqual(self.data_bytes(), len(self.hub.gzipped(self.hub.datasets['csv'])) + len(self.hub.gzipped(self.hub.datasets['json'])))
+        self.assertTrue(self.data_bytes() * 5 < len(self.hub.datasets['csv']) + len(self.hub.datasets['json']))
+
+        uncompressed = PhSession(OFFLINE_API_KEY, base_url=self.hub.base_url, compress=False)
+        self.assertEqual(PhRun(OFFLINE_API_KEY, self.run.run_token, session=uncompressed).get_data(), self.hub.datasets['json'].decode('utf-8'))
+        uncompressed.close()
+
+    def test_save_compressed(self):
+        path = os.path.join(self.tmpdir, 'latest_data.csv.gz')
+        self.run.save_data(path, format='csv')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.hub.gzipped(self.hub.datasets['csv'])) #as received, not recompressed
+        self.assertEqual(b''.join(read_chunks(path, chunk_size=100)), self.hub.datasets['csv'])
+        self.assertEqual(list(iter_csv_rows(read_chunks(path)))[1][0], 'Movie 0')
+
+        self.hub.gzip = False #compressed here instead
+        buf = io.BytesIO()
+        self.run.save_data(buf, compress=True)
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(buf.getvalue())).read(), self.hub.datasets['json'])
+        self.run.save_data(os.path.join(self.tmpdir, 'plain.json'))
+        self.assertEqual(b''.join(read_chunks(os.path.join(self.tmpdir, 'plain.json'))), self.hub.datasets['json'])
+
+        proj = PhProject(OFFLINE_API_KEY, self.run.project_token, thin=True, session=self.session)
+        proj.save_last_ready_data(os.path.join(self.tmpdir, 'last.ndjson.gz'), format='ndjson')
+        self.assertEqual(len(list(iter_run_data_records(read_chunks(os.path.join(self.tmpdir, 'last.ndjson.gz')), 'ndjson'))), 2000)
+
+    def test_compressed_cache(self):
+        self.session.dataset_cache = cache = DatasetCache(os.path.join(self.tmpdir, 'datasets'), compress=True)
+        self.assertEqual(self.run.get_data(format='csv').encode('utf-8'), self.hub.datasets['csv'])
+        with open(cache.path(self.run.run_token, 'csv'), 'rb') as f:
+            self.assertEqual(f.read(), self.hub.gzipped(self.hub.datasets['csv']))
+        self.assertEqual(cache.read(self.run.run_token, 'csv'), self.hub.datasets['csv'])
+        self.assertEqual(self.run.get_data(format='csv').encode('utf-8'), self.hub.datasets['csv'])
+        self.assertEqual(b''.join(self.run.iter_data(format='csv', compressed=True)), self.hub.gzipped(self.hub.datasets['csv']))
+        self.assertEqual(self.hub.requests.count(('GET', '/runs/%s/data' % self.run.run_token)), 1)
+
+        self.session.dataset_cache = DatasetCache(cache.directory) #reads compressed entries just the same
+        self.assertEqual(len(list(self.run.iter_csv_rows())), 2001)
+
+    def test_chunk_helpers(self):
+        data = b'{"movies": []}' * 1000
+        members = b''.join(gzip_chunks([data[:5000]])) + b''.join(gzip_chunks([data[5000:]], compresslevel=1))
+        self.assertEqual(b''.join(gunzip_chunks(members[i:i + 1] for i in range(len(members)))), data)
+        self.assertEqual(b''.join(gzip_chunks([members])), members)
+        self.assertEqual(list(gunzip_chunks([b'{', b'}'])), [b'{}'])
+        self.assertEqual(list(gunzip_chunks([])), [])
+        self.assertRaises(ValueError, list, gunzip_chunks([members[:-10]]))
+
+class TestDiffOffline(StandInTestCase):
+    hub_options = {'projects': 1, 'rows': 1000}
+
+    def setUp(self):
+        super(TestDiffOffline, self).setUp()
+        self.old = make_records(1000)
+        self.new = [dict(r) for r in self.old if r['title'] not in ('Movie 3', 'Movie 500')]
+        self.new[10]['rating'] = '0.1'
+        self.new[20] = dict((k, self.new[20][k]) for k in reversed(list(self.new[20]))) #same record, other key order
+        self.new.append({'title': 'Movie 1000', 'year': '2020'})
+
+    def test_diff(self):
+        entries = list(diff_runs(self.old, self.new, key='title'))
+        self.assertEqual(entries, [
+            DiffEntry('added', 'Movie 1000', self.new[-1]),
+            DiffEntry('changed', 'Movie 11', self.new[10]),
+            DiffEntry('removed', 'Movie 3', self.old[3]),
+            DiffEntry('removed', 'Movie 500', self.old[500]),
+        ])
+        self.assertEqual([(e.op, e.key) for e in diff_runs(self.old, self.new, key=('title', 'year'), removed=False)],
+                         [('added', ('Movie 1000', '2020')), ('changed', ('Movie 11', '1911'))])
+        self.assertEqual(sorted(e.op for e in diff_runs(self.old, self.new)), ['added', 'added', 'removed', 'removed', 'removed'])
+        self.assertEqual(list(diff_runs(self.old, list(reversed(self.old)), key='title')), [])
+        self.assertEqual([e.op for e in diff_runs([], self.old[:3], key='title')], ['added'] * 3)
+
+    def test_duplicate_keys(self):
+        old = [{'id': 1, 'v': 'a'}, {'id': 1, 'v': 'b'}, {'id': 2, 'v': 'c'}]
+        self.assertEqual(list(diff_runs(old, [{'id': 1, 'v': 'b'}, {'id': 1, 'v': 'a'}, {'id': 2, 'v': 'c'}], key='id')), [])
+        self.assertEqual(list(diff_runs(old, [{'id': 1, 'v': 'b'}, {'id': 1, 'v': 'x'}, {'id': 2, 'v': 'c'}], key='id')),
+                         [DiffEntry('changed', 1, {'id': 1, 'v': 'x'})])
+        self.assertEqual(list(diff_runs(old, [{'id': 1, 'v': 'a'}, {'id': 2, 'v': 'c'}], key='id')),
+                         [DiffEntry('removed', 1, {'id': 1, 'v': 'b'})])
+
+        #identical records pair up first, whatever their order
+        self.assertEqual(list(diff_runs(old, [{'id': 1, 'v': 'x'}, {'id': 1, 'v': 'a'}, {'id': 2, 'v': 'c'}], key='id')),
+                         [DiffEntry('changed', 1, {'id': 1, 'v': 'x'})])
+        self.assertEqual(list(diff_runs(old[:1], [{'id': 1, 'v': 'x'}, {'id': 1, 'v': 'a'}], key='id')),
+                         [DiffEntry('added', 1, {'id': 1, 'v': 'x'})])
+
+    def test_runs_and_snapshots(self):
+        run = PhRun(OFFLINE_API_KEY, list(self.hub.runs)[0], session=self.session)
+        snapshot = os.path.join(self.tmpdir, 'snapshot.csv.gz')
+        run.save_data(snapshot, format='csv')
+        self.assertEqual(list(diff_runs(snapshot, run, key='title', base_list='movies')), [])
+        downloads = self.hub.requests.count(('GET', '/runs/%s/data' % run.run_token))
+        changes = list(diff_runs(run, self.new, key='title'))
+        self.assertEqual(self.hub.requests.count(('GET', '/runs/%s/data' % run.run_token)), downloads + 1) #removed read back from a spool
+        self.assertEqual([(e.op, e.key) for e in changes],
+                         [('added', 'Movie 1000'), ('changed', 'Movie 11'), ('removed', 'Movie 3'), ('removed', 'Movie 500')])
+
+        proj = PhProject(OFFLINE_API_KEY, run.project_token, thin=True, session=self.session)
+        self.assertEqual(list(proj.diff_last_ready_runs(key='title')), []) #every stand-in run has the same data
+
+class TestWebhookOffline(StandInTestCase):
+    hub_options = {'projects': 1, 'polls_until_ready': 1000}
+
+    def setUp(self):
+        super(TestWebhookOffline, self).setUp()
+        self.receiver = WebhookReceiver(host='127.0.0.1', secret='s3cret', fallback_interval=60).start()
+        self.hub.webhook = self.receiver.url
+        self.session.webhook = self.receiver
+        self.proj = PhProject(OFFLINE_API_KEY, 'tProject0', thin=True, session=self.session)
+
+    def tearDown(self):
+        super(TestWebhookOffline, self).tearDown()
+        self.receiver.stop()
+
+    def polls(self, run):
+        return self.hub.requests.count(('GET', '/runs/%s' % run.run_token))
+
+    def test_wait_until_ready(self):
+        notified = []
+        self.receiver.callbacks.append(notified.append)
+        run = self.proj.run()
+        threading.Timer(0.2, self.hub.finish_run, [run.run_token]).start()
+        start = time.time()
+        self.assertEqual(len(run.get_data()), len(self.hub.datasets['json']))
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(self.polls(run), 1)
+        self.assertEqual(run.status, 'complete')
+        self.assertIs(run.data_ready, True)
+        self.assertEqual(run.pages, 1)
+        self.assertEqual([jdata['run_token'] for jdata in notified], [run.run_token])
+
+        run.wait_until_ready() #already notified, no request
+        self.assertEqual(self.polls(run), 1)
+
+        cancelled = self.proj.run()
+        threading.Timer(0.2, cancelled.cancel).start()
+        self.assertRaisesRegex(Exception, 'finished without data', cancelled.wait_until_ready)
+
+    def test_iter_completed_runs(self):
+        runs = [self.proj.run() for i in range(3)]
+        for i, run in enumerate([runs[2], runs[0], runs[1]]):
+            threading.Timer(0.1 * (i + 1), self.hub.finish_run, [run.run_token]).start()
+        done = list(iter_completed_runs(runs, wait_increment=0.05))
+        self.assertEqual(done, [runs[2], runs[0], runs[1]])
+        self.assertTrue(all(run.data_ready for run in done))
+        self.assertEqual(sum(self.polls(run) for run in runs), 3) #first polls only
+
+    def test_polling_fallback(self):
+        self.receiver.fallback_interval = 0.05
+        self.hub.polls_until_ready = 2
+        run = self.proj.run()
+        self.assertTrue(run.wait_until_ready(wait_increment=0.01, wait_timeout=5).data_ready)
+        self.assertEqual(self.polls(run), 3)
+
+    def test_without_secret(self):
+        self.assertEqual(WebhookReceiver()._host, '127.0.0.1')
+        receiver = WebhookReceiver(fallback_interval=60).start()
+        self.session.webhook = receiver
+        self.hub.webhook = receiver.url
+        run = self.proj.run()
+        forged = {'run_token': run.run_token, 'status': 'complete', 'data_ready': 'true'}
+        threading.Timer(0.1, requests.post, [receiver.url], {'data': forged}).start()
+        self.assertRaisesRegex(Exception, 'Timed out', run.wait_until_ready, wait_timeout=1)
+        self.assertEqual(self.polls(run), 3) #first poll, the poll confirming the notification, the last one at the timeout
+        self.assertFalse(run.data_ready)
+
+        threading.Timer(0.1, self.hub.finish_run, [run.run_token]).start()
+        self.assertTrue(run.wait_until_ready(wait_timeout=5).data_ready)
+        self.assertEqual(self.polls(run), 5) #confirming the stale forged notification, then the real one
+        receiver.stop()
+
+    def test_bad_requests(self):
+        url = self.receiver.url
+        self.assertEqual(requests.post(url.replace('s3cret', 'guess'), data={'run_token': 'tRun1'}).status_code, 403)
+        self.assertEqual(requests.post(url.replace('/?', '/other?'), data={'run_token': 'tRun1'}).status_code, 404)
+        self.assertEqual(requests.post(url, data={'status': 'complete'}).status_code, 400)
+        self.assertEqual(requests.post(url, data='[1, 2]', headers={'Content-Type': 'application/json'}).status_code, 400)
+        self.assertEqual(requests.post(url, json={'run_token': 'tRun1', 'data_ready': True}).status_code, 200)
+        self.assertEqual(self.receiver.latest('tRun1'), {'run_token': 'tRun1', 'data_ready': True})
+        self.assertEqual(self.receiver.wait_for('tRun2', 0.01), (0, None))
+        self.assertEqual(self.receiver.updates(0)[1], {'tRun1': {'run_token': 'tRun1', 'data_ready': True}})
+
+class TestRunSchedulerOffline(StandInTestCase):
+    hub_options = {'projects': 3, 'polls_until_ready': 1}
+
+    def setUp(self):
+        super(TestRunSchedulerOffline, self).setUp()
+        self.path = os.path.join(self.tmpdir, 'runs.db')
+        self.completed = []
+
+    def scheduler(self, **kwargs):
+        kwargs.setdefault('on_complete', lambda run, job: self.completed.append((run.run_token, job['id'])))
+        kwargs.setdefault('poll_interval', 0)
+        return RunScheduler(OFFLINE_API_KEY, self.path, session=self.session, **kwargs)
+
+    def started(self, project_token):
+        return self.hub.requests.count(('POST', '/projects/%s/run' % project_token))
+
+    def test_limits_and_hand_off(self):
+        with self.scheduler(max_running=2) as scheduler:
+            ids = [scheduler.enqueue(token, start_url='http://www.example.com/%s' % i)
+                   for i, token in enumerate(['tProject0', 'tProject0', 'tProject1', 'tProject2'])]
+            scheduler.tick()
+            self.assertEqual([job['state'] for job in scheduler.jobs()], ['running', 'queued', 'running', 'queued'])
+            self.assertEqual(self.started('tProject0'), 1)
+            scheduler.tick() #first poll, not ready yet
+            scheduler.tick()
+            self.assertEqual([job['state'] for job in scheduler.jobs()], ['done', 'running', 'done', 'running'])
+            for i in range(4):
+                scheduler.tick()
+            jobs = scheduler.jobs()
+            self.assertEqual([job['state'] for job in jobs], ['done'] * 4)
+            self.assertEqual(sorted(self.completed), sorted((job['run_token'], job['id']) for job in jobs))
+            self.assertEqual([job['id'] for job in jobs], ids)
+            self.assertTrue(all(job['run_jdata']['data_ready'] for job in jobs))
+            self.assertEqual(jobs[1]['params'], {'start_url': 'http://www.example.com/1'})
+
+    def test_restart(self):
+        scheduler = self.scheduler(retry_delay=0)
+        scheduler.enqueue('tProject0')
+        scheduler.tick()
+        run_token = scheduler.jobs()[0]['run_token']
+        scheduler.close()
+
+        scheduler = self.scheduler(retry_delay=0)
+        for i in range(3):
+            scheduler.tick()
+        self.assertEqual([(job['state'], job['run_token']) for job in scheduler.jobs()], [('done', run_token)])
+        self.assertEqual(self.started('tProject0'), 1)
+
+        #died between starting a run and recording it: the run is adopted, not started again
+        started_at = calendar.timegm(time.strptime(self.hub.runs[run_token]['start_time'], '%Y-%m-%dT%H:%M:%S'))
+        scheduler._db.execute("UPDATE jobs SET state = 'starting', run_token = NULL, started_at = ?", (started_at,))
+        scheduler._db.execute("INSERT INTO jobs (project_token, params, due_time, state, started_at) VALUES ('tProject1', '{}', 0, 'starting', ?)",
+                              (started_at + 3600,))
+        scheduler._db.commit()
+        scheduler.tick()
+        jobs = scheduler.jobs()
+        self.assertEqual((jobs[0]['state'], jobs[0]['run_token']), ('done', run_token))
+        self.assertEqual(self.completed[-1], (run_token, jobs[0]['id']))
+        self.assertEqual(jobs[1]['state'], 'running') #no run of tProject1 started since: queued again and started
+        self.assertEqual(self.started('tProject1'), 1)
+        scheduler.close()
+
+    def test_schedules(self):
+        with self.scheduler(on_complete=None) as scheduler:
+            scheduler.add_schedule('tProject0', 10, start_time=0)
+            scheduler.add_schedule('tProject0', 20, start_time=0, start_url='http://www.example.com') #updated in place
+            self.assertEqual(scheduler.schedules(), [{'name': 'tProject0', 'project_token': 'tProject0', 'interval': 20,
+                                                      'next_time': 0, 'params': {'start_url': 'http://www.example.com'}}])
+            self.hub.polls_until_ready = 1000
+            scheduler.tick(now=5)
+            scheduler.tick(now=25) #still running: skips its turn
+            self.assertEqual(len(scheduler.jobs()), 1)
+            self.assertEqual(scheduler.schedules()[0]['next_time'], 40)
+            self.hub.finish_run(scheduler.jobs()[0]['run_token'])
+            scheduler.tick(now=30)
+            scheduler.tick(now=85) #turns missed meanwhile are not caught up
+            self.assertEqual([job['state'] for job in scheduler.jobs()], ['done', 'running'])
+            self.assertEqual(scheduler.schedules()[0]['next_time'], 100)
+            self.assertTrue(scheduler.remove_schedule('tProject0'))
+            self.assertEqual(scheduler.schedules(), [])
+
+    def test_webhook_notifications(self):
+        with WebhookReceiver() as receiver, self.scheduler(poll_interval=1000) as scheduler:
+            self.session.webhook = receiver
+            self.hub.polls_until_ready = 1000
+            scheduler.enqueue('tProject0', due_time=0)
+            scheduler.tick(now=0)
+            run_token = scheduler.jobs()[0]['run_token']
+            receiver.notify({'run_token': run_token, 'status': 'complete', 'data_ready': True}) #forged: no secret
+            scheduler.tick(now=1)
+            self.assertEqual(self.hub.requests.count(('GET', '/runs/%s' % run_token)), 1) #confirmed by a poll
+            self.assertEqual(scheduler.jobs()[0]['state'], 'running')
+            scheduler.tick(now=2) #nothing new: no poll
+            self.assertEqual(self.hub.requests.count(('GET', '/runs/%s' % run_token)), 1)
+
+            receiver.secret = 's3cret'
+            receiver.notify({'run_token': run_token, 'status': 'complete', 'data_ready': True})
+            scheduler.tick(now=3)
+            self.assertEqual(scheduler.jobs()[0]['state'], 'done')
+            self.assertEqual(self.hub.requests.count(('GET', '/runs/%s' % run_token)), 1)
+
+    def test_lost_starts(self):
+        unreachable = socket.socket()
+        unreachable.bind(('127.0.0.1', 0))
+        unreachable_url = 'http://127.0.0.1:%s' % unreachable.getsockname()[1]
+        unreachable.close()
+        now = max(calendar.timegm(time.strptime(run['start_time'], '%Y-%m-%dT%H:%M:%S'))
+                  for run in self.hub.runs.values() if run['project_token'] == 'tProject0')
+        with self.scheduler(max_attempts=2, retry_delay=10) as scheduler:
+            scheduler.enqueue('tProject0', due_time=0, start_url='http://www.example.com/other')
+            for attempt in range(2):
+                self.session.base_url = unreachable_url
+                scheduler.tick(now=now + 20 * attempt)
+                self.assertEqual(scheduler.jobs()[0]['state'], 'starting')
+                #the project's runs started around then with another start_url are not adopted
+                self.session.base_url = self.hub.base_url
+                scheduler.tick(now=now + 20 * attempt + 1)
+            job = scheduler.jobs()[0]
+            self.assertEqual((job['state'], job['attempts'], job['run_token']), ('failed', 2, None))
+            self.assertTrue(job['error'])
+            self.assertEqual(self.started('tProject0'), 0)
+
+    def test_failures(self):
+        failing = []
+        def on_complete(run, job):
+            if not failing:
+                failing.append(job['id'])
+                raise Exception('Download failed.')
+        with self.scheduler(on_complete=on_complete, max_attempts=2, retry_delay=10) as scheduler:
+            job_id = scheduler.enqueue('tMissingProject', due_time=0)
+            scheduler.tick(now=0)
+            self.assertEqual(scheduler.jobs()[0]['state'], 'queued')
+            scheduler.tick(now=5)
+            self.assertEqual(self.started('tMissingProject'), 1)
+            scheduler.tick(now=10)
+            job = scheduler.jobs()[0]
+            self.assertEqual((job['state'], job['attempts']), ('failed', 2))
+            self.assertIn('404', job['error'])
+
+            scheduler.enqueue('tProject0', due_time=0)
+            for now in (20, 21, 22):
+                scheduler.tick(now=now)
+            self.assertEqual(scheduler.jobs(state='ready')[0]['id'], failing[0]) #retried on the next tick
+            scheduler.tick(now=23)
+            self.assertEqual(len(scheduler.jobs(state='done')), 1)
+            self.assertEqual(scheduler.jobs(project_token='tMissingProject')[0]['id'], job_id)
+
+class TestProjectIndexOffline(StandInTestCase):
+    hub_options = {'projects': 3, 'runs_per_project': 3, 'polls_until_ready': 1000}
+
+    def setUp(self):
+        super(TestProjectIndexOffline, self).setUp()
+        self.index = ProjectIndex(OFFLINE_API_KEY, os.path.join(self.tmpdir, 'parsehub.db'), session=self.session)
+
+    def tearDown(self):
+        self.index.close()
+        super(TestProjectIndexOffline, self).tearDown()
+
+    def test_lookups(self):
+        self.assertEqual(self.index.refreshed_at, None)
+        self.assertEqual(self.index.refresh(), 9)
+        requests_made = len(self.hub.requests)
+
+        proj = self.index.project_by_title('Project 1')
+        self.assertEqual((proj.token, proj.title), ('tProject1', 'Project 1'))
+        self.assertEqual(proj.last_ready_run.run_token, 'tRun6')
+        self.assertEqual(self.index.project('tProject2').main_site, 'http://www.example.com')
+        self.assertEqual(self.index.project_by_title('Project 9'), None)
+        self.assertEqual([p.token for p in self.index.projects(title_like='Project %')], ['tProject0', 'tProject1', 'tProject2'])
+        self.assertEqual(len(self.index), 3)
+
+        runs = self.index.runs()
+        self.assertEqual([r.run_token for r in runs], ['tRun%s' % i for i in range(9, 0, -1)])
+        self.assertTrue(all(r.data_ready and r.status == 'complete' for r in runs))
+        self.assertEqual([r.run_token for r in self.index.runs('tProject0', limit=2)], ['tRun3', 'tRun2'])
+        since, until = self.hub.runs['tRun4']['start_time'], self.hub.runs['tRun7']['start_time']
+        self.assertEqual([r.run_token for r in self.index.runs(since=since, until=until)], ['tRun6', 'tRun5', 'tRun4'])
+        self.assertEqual(self.index.runs(status=('running', 'error')), [])
+        self.assertEqual(self.index.run('tRun2').pages, 1)
+        self.assertEqual(self.index.last_ready_run('tProject2').run_token, 'tRun9')
+        self.assertEqual(len(self.hub.requests), requests_made) #all local
+
+        reopened = ProjectIndex(OFFLINE_API_KEY, self.index.path, session=self.session)
+        self.assertEqual(reopened.project_by_title('Project 1').token, 'tProject1')
+        self.assertEqual(len(reopened.runs()), 9)
+        reopened.close()
+
+    def test_incremental_refresh(self):
+        self.index.refresh()
+        proj = PhProject(OFFLINE_API_KEY, 'tProject0', thin=True, session=self.session)
+        run = proj.run()
+        self.hub.requests[:] = []
+        self.assertEqual(self.index.refresh(), 1)
+        self.assertEqual(len(self.hub.requests), 4) #the listing and one page of runs per project
+        self.assertEqual(self.index.runs(status='running')[0].run_token, run.run_token)
+        self.assertEqual(self.index.project('tProject0').last_run.run_token, run.run_token)
+        self.assertEqual(self.index.refresh(), 0)
+
+        self.hub.finish_run(run.run_token)
+        self.assertEqual(self.index.refresh(), 1)
+        self.assertEqual(self.index.last_ready_run('tProject0').run_token, run.run_token)
+        self.assertEqual(self.index.runs(data_ready=False), [])
+
+        PhRun(OFFLINE_API_KEY, 'tRun1', thin=True, session=self.session).delete()
+        self.index.refresh()
+        self.assertNotEqual(self.index.run('tRun1'), None) #only a full refresh notices deleted runs
+        self.assertEqual(self.index.refresh(full=True), 0)
+        self.assertEqual(self.index.run('tRun1'), None)
+
+        del self.hub.projects['tProject2']
+        self.hub._run_order.pop('tProject2')
+        self.index.refresh(runs=False)
+        self.assertEqual([p.token for p in self.index.projects()], ['tProject0', 'tProject1'])
+        self.assertEqual(self.index.runs('tProject2'), [])
+
+class TestPhSessionOffline(Py2and3CompatibleUnitTest):
+    def test_one_session_per_api_key(self):
+        self.assertIs(PhSession.for_api_key(OFFLINE_API_KEY), PhSession.for_api_key(OFFLINE_API_KEY))
+        self.assertIsNot(PhSession.for_api_key(OFFLINE_API_KEY), PhSession.for_api_key(OFFLINE_API_KEY + '2'))
+
+    def test_children_inherit_session(self):
+        session = PhSession(OFFLINE_API_KEY, pool_maxsize=2)
+        acct = PhAccount(OFFLINE_API_KEY, jdata={'projects': [offline_project_jdata]}, session=session)
+        proj = acct.projects[0]
+        self.assertIs(proj._session, session)
+        self.assertIs(proj.last_run._session, session)
+        self.assertIs(proj.last_ready_run._session, session)
+        self.assertTrue(all(r._session is session for r in proj.run_list))
+        self.assertIs(acct.get_a_run('tOfflineRun1', thin=True)._session, session)
+
 class TestPhAccountStatic(Py2and3CompatibleUnitTest):
     def test_list_projects(self, thin=False):
         acct = PhAccount(API_KEY, thin=thin)